@@ -21,6 +21,23 @@ except ImportError:
         loop.run_until_complete(coro)
 
 
+event_loops = ('asyncio', 'uvloop')
+
+
+def install_event_loop(name):
+    '''
+    Use uvloop (if name is "uvloop" and it is installed) for the event loops created by run().
+    '''
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning('uvloop is not installed, using the default asyncio event loop')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.debug('Using uvloop %s', uvloop.__version__)
+
+
 try:
     from asyncio import create_task
 except ImportError:
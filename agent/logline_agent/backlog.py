@@ -0,0 +1,118 @@
+'''
+Catch-up prioritisation.
+
+After an outage or an agent restart many files have a backlog to upload and
+they compete for the memory budget. Which file reads its next chunk first is
+decided by the priority of its acquire:
+
+- the priority class of the first matching `catch_up.priorities` glob
+  (lower is more important; files not matching any glob have class
+  `catch_up.default_priority`),
+- then, with the `smallest_lag_first` policy, the number of bytes the file
+  is behind, so that files with a small backlog (usually the live tail
+  needed for incident response) are caught up first and don't wait behind
+  a few huge ones; with the `fifo` policy the files are served in order.
+
+The lag and the estimated time to catch up of every lagging file are
+exported in the metrics file.
+'''
+
+from fnmatch import fnmatch
+
+
+policies = ('smallest_lag_first', 'fifo')
+
+
+class FileProgress:
+
+    def __init__(self, path, inode, priority_class):
+        self.path = path
+        self.inode = inode
+        self.priority_class = priority_class
+        self.position = 0
+        self.size = 0
+        self.rate = None # bytes per second, EWMA
+
+    @property
+    def lag(self):
+        return max(0, self.size - self.position)
+
+    def update(self, position, size):
+        self.position = position
+        self.size = size
+
+    def record_sent(self, length, duration):
+        '''
+        Called after a chunk was acknowledged; duration includes waiting for the memory budget.
+        '''
+        rate = length / max(duration, 1e-3)
+        self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
+
+    def catch_up_time(self):
+        '''
+        Return estimated seconds until the file is caught up, or None if not known yet.
+        '''
+        if not self.lag:
+            return 0
+        if not self.rate:
+            return None
+        return self.lag / self.rate
+
+
+class Backlog:
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.files = set()
+
+    def register(self, path, inode):
+        progress = FileProgress(path, inode, self.priority_class(path))
+        self.files.add(progress)
+        return progress
+
+    def unregister(self, progress):
+        self.files.discard(progress)
+
+    def reclassify(self):
+        '''
+        Apply changed priority globs (configuration reload).
+        '''
+        for progress in self.files:
+            progress.priority_class = self.priority_class(progress.path)
+
+    def priority_class(self, path):
+        for glob_str, priority_class in self.conf.catch_up_priorities:
+            if fnmatch(str(path), glob_str):
+                return priority_class
+        return self.conf.catch_up_default_priority
+
+    def priority(self, progress):
+        '''
+        Return priority of the memory budget acquire for reading the next chunk of the file.
+        '''
+        if self.conf.catch_up_policy == 'smallest_lag_first':
+            return (progress.priority_class, progress.lag)
+        return (progress.priority_class, 0)
+
+    def metrics_text(self):
+        lines = [
+            '# HELP logline_agent_file_lag_bytes Bytes of the file not yet sent to the server',
+            '# TYPE logline_agent_file_lag_bytes gauge',
+        ]
+        eta_lines = [
+            '# HELP logline_agent_file_catch_up_seconds Estimated time until the file is sent to the server',
+            '# TYPE logline_agent_file_catch_up_seconds gauge',
+        ]
+        for progress in sorted(self.files, key=lambda p: (str(p.path), p.inode)):
+            if not progress.lag:
+                continue
+            labels = 'path="{}",inode="{}"'.format(escape_label(str(progress.path)), progress.inode)
+            lines.append(f'logline_agent_file_lag_bytes{{{labels}}} {progress.lag}')
+            catch_up_time = progress.catch_up_time()
+            if catch_up_time is not None:
+                eta_lines.append(f'logline_agent_file_catch_up_seconds{{{labels}}} {catch_up_time:.3f}')
+        return ''.join(line + '\n' for line in lines + eta_lines)
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
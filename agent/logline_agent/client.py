@@ -5,45 +5,84 @@ Client for the Logline Server
 from asyncio import open_connection, wait_for
 from base64 import b64encode
 import gzip
-from logging import getLogger
+import hashlib
+from logging import DEBUG, getLogger
+import os
 import re
 from reprlib import repr as smart_repr
+import socket
 from socket import getfqdn
+import struct
 from time import monotonic as monotime
 import json
+from zlib import crc32
 
 from .asyncio_helpers import to_thread
+from .sharding import ServerSelector
+from .tracing import trace
 
 
 logger = getLogger(__name__)
 
 socket_timeout = 300
 
+# Binary framing of data commands, see Protocol.md
+framing_name = 'binary-v1'
+frame_header = struct.Struct('<BBBxQII')
+frame_type_data = 1
+flag_crc32 = 1
+codec_ids = {None: 0, 'gzip': 1, 'lzma': 2, 'zst': 3}
+
+# Verification by range hashes: ranges that differ are split into this many parts,
+# until they are at most verify_leaf_size bytes long and are re-sent
+verify_fanout = 16
+verify_leaf_size = 2**16
+verify_max_ranges = 256 # per hashes command
+
+# Files per logline-lengths-v1 query (the server accepts at most 1000)
+lengths_query_batch = 500
+
 
 class ClientError (Exception):
-    pass
 
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        # seconds, when the server asked us to wait before reconnecting
+        self.retry_after = retry_after
+
+
+class ResyncRequired (ClientError):
+    '''
+    The server does not have the data preceding the sent chunk;
+    continue sending from the given length.
+    '''
+
+    def __init__(self, length):
+        super().__init__(f'Server requested resync from offset {length}')
+        self.length = length
 
-async def connect_to_server(conf, log_path, log_prefix):
+
+async def connect_to_server(conf, log_path, log_prefix, selector=None):
     '''
-    Connect to the server specified in the configuration.
+    Connect to the server specified in the configuration (selected by the selector
+    if there are more servers).
     Initial header is sent to the server, containing some metadata and log file prefix.
     '''
     assert isinstance(log_prefix, bytes)
-    assert isinstance(conf.client_token, str)
-    logger.debug('Connecting to %s:%s', conf.server_host, conf.server_port)
-    if conf.use_tls:
-        from ssl import create_default_context, Purpose
-        logger.debug('Using TLS; cafile: %s', conf.tls_cert_file or '-')
-        ssl_context = create_default_context(
-            purpose=Purpose.SERVER_AUTH,
-            cafile=str(conf.tls_cert_file) if conf.tls_cert_file else None)
-    else:
-        ssl_context = None
-    reader, writer = await open_connection(conf.server_host, conf.server_port, ssl=ssl_context)
-    cc = ClientConnection(reader, writer)
+    hostname = getfqdn()
+    selector = selector or ServerSelector(conf)
+    server = selector.select(hostname, str(log_path))
+    try:
+        reader, writer = await _open_connection(conf, server)
+    except OSError:
+        selector.failed(server)
+        raise
+    cc = ClientConnection(reader, writer, ChunkSizer(
+        initial_size=conf.chunk_initial_size,
+        min_size=conf.chunk_min_size,
+        max_size=conf.chunk_max_size))
     await cc.send_header({
-        'hostname': getfqdn(),
+        'hostname': hostname,
         'path': str(log_path),
         'prefix': {
             'length': len(log_prefix),
@@ -52,59 +91,192 @@ async def connect_to_server(conf, log_path, log_prefix):
         'auth': {
             'client_token': conf.client_token,
         },
+        'framing': [framing_name],
     })
     assert cc.header_reply
+    selector.succeeded(server)
     return cc
 
 
+async def query_lengths(conf, files, selector=None):
+    '''
+    Return lengths of the server copies of the files - list of (path, prefix) -
+    or None for the files the server does not have with the same prefix.
+    Many files are queried in one round-trip (per server) instead of a handshake per file.
+    '''
+    hostname = getfqdn()
+    selector = selector or ServerSelector(conf)
+    server_files = {} # server -> list of (index, path, prefix)
+    for i, (path, prefix) in enumerate(files):
+        server_files.setdefault(selector.select(hostname, str(path)), []).append((i, path, prefix))
+    lengths = [None] * len(files)
+    for server, items in server_files.items():
+        for i in range(0, len(items), lengths_query_batch):
+            batch = items[i:i + lengths_query_batch]
+            reader, writer = await _open_connection(conf, server)
+            cc = ClientConnection(reader, writer)
+            try:
+                reply = await cc._send_command('logline-lengths-v1', {
+                    'hostname': hostname,
+                    'files': [
+                        {'path': str(path), 'prefix': {'length': len(prefix), 'sha1': sha1_b64(prefix)}}
+                        for _, path, prefix in batch
+                    ],
+                    'auth': {
+                        'client_token': conf.client_token,
+                    },
+                })
+            finally:
+                cc.close()
+            for (index, _, _), length in zip(batch, reply['lengths']):
+                lengths[index] = length
+    return lengths
+
+
+async def _open_connection(conf, server):
+    assert isinstance(conf.client_token, str)
+    host, port = server
+    logger.debug('Connecting to %s:%s', host, port)
+    if conf.use_tls:
+        from ssl import create_default_context, Purpose
+        logger.debug('Using TLS; cafile: %s', conf.tls_cert_file or '-')
+        ssl_context = create_default_context(
+            purpose=Purpose.SERVER_AUTH,
+            cafile=str(conf.tls_cert_file) if conf.tls_cert_file else None)
+    else:
+        ssl_context = None
+    reader, writer = await open_connection(host, port, ssl=ssl_context)
+    set_tcp_keepalive(writer.get_extra_info('socket'))
+    return reader, writer
+
+
 class ClientConnection:
     '''
     Use connect_to_server() to create instance of this class.
     '''
 
-    def __init__(self, reader, writer):
+    def __init__(self, reader, writer, chunk_sizer=None):
         self.reader = reader
         self.writer = writer
         self.header_reply = None
+        self.last_reply_time = monotime()
+        self.chunk_sizer = chunk_sizer or ChunkSizer()
+
+    @property
+    def chunk_size(self):
+        '''
+        How many bytes to read from the file for the next send_data().
+        '''
+        return self.chunk_sizer.chunk_size
 
     def close(self):
         self.writer.close()
 
+    async def ping(self):
+        await self._send_command('ping', {})
+
+    async def goodbye(self):
+        '''
+        Tell the server that this connection is going to be closed on purpose.
+        '''
+        await self._send_command('bye', {})
+
     async def send_header(self, header):
         self.header_reply = await self._send_command('logline-agent-v1', header)
 
-    async def send_data(self, offset, content):
+    async def send_data(self, offset, content, repair=False):
         assert isinstance(offset, int)
         assert isinstance(content, bytes)
+        content_crc32 = crc32(content)
+        content_size = len(content)
         metadata = {
             'offset': offset,
             'compression': None,
+            'crc32': content_crc32,
         }
+        if repair:
+            metadata['repair'] = True
+        t_compress = trace.start('compress')
         content_gz = await to_thread(gzip.compress, content)
+        trace.stop('compress', t_compress)
         if len(content_gz) < len(content):
             metadata['compression'] = 'gzip'
             content = content_gz
-        await self._send_command('data', metadata, content)
+        t0 = monotime()
+        if self.header_reply.get('framing') == framing_name and not repair:
+            reply = await self._send_data_frame(offset, content, metadata['compression'], content_crc32)
+        else:
+            reply = await self._send_command('data', metadata, content)
+        self.chunk_sizer.record_data(len(content), content_size, monotime() - t0)
+        return reply
+
+    async def get_range_hashes(self, ranges):
+        reply = await self._send_command('hashes', {'ranges': ranges})
+        return reply['hashes']
+
+    async def verify_and_repair(self, file_stream, length):
+        '''
+        Compare the first length bytes of the file with the server copy
+        and re-send the regions that differ. Returns number of re-sent bytes.
+        If the server cannot repair them (not the plain storage format),
+        the differences are only logged.
+        '''
+        fd = file_stream.fileno()
+        pending = [(0, length)] if length else []
+        divergent = []
+        while pending:
+            batch, pending = pending[:verify_max_ranges], pending[verify_max_ranges:]
+            remote_hashes = await self.get_range_hashes(batch)
+            local_hashes = await to_thread(lambda: [range_hash(fd, start, end) for start, end in batch])
+            for (start, end), remote_hash, local_hash in zip(batch, remote_hashes, local_hashes):
+                if remote_hash == local_hash:
+                    continue
+                if end - start <= verify_leaf_size:
+                    divergent.append((start, end))
+                    continue
+                part_size = max(verify_leaf_size, -(-(end - start) // verify_fanout))
+                pending.extend((pos, min(end, pos + part_size)) for pos in range(start, end, part_size))
+        resent = 0
+        for start, end in divergent:
+            logger.info('Re-sending divergent range %d-%d of fd %s', start, end, fd)
+            reply = await self.send_data(start, os.pread(fd, end - start, start), repair=True)
+            if reply and reply.get('repaired') is False:
+                logger.warning('Server cannot repair divergent range %d-%d of fd %s', start, end, fd)
+                continue
+            resent += end - start
+        return resent
+
+    async def _send_data_frame(self, offset, data, compression, data_crc32):
+        logger.debug('Sending: binary data offset %d compression %s + %d B data', offset, compression, len(data))
+        t0 = monotime()
+        self.writer.write(encode_data_frame_header(offset, len(data), compression, data_crc32))
+        self.writer.write(data)
+        await wait_for(self.writer.drain(), timeout=socket_timeout)
+        return await self._recv_reply(t0)
 
     async def _send_command(self, command, metadata, data=None):
         assert isinstance(command, str)
         assert isinstance(metadata, dict)
         md_json = json.dumps(metadata)
-        md_json_safe = obfuscate_secrets(md_json)
         md_bytes = md_json.encode()
         md_bytes += b'\n'
         t0 = monotime()
         if data is None:
-            logger.debug('Sending: %s %s', command, md_json_safe)
+            if logger.isEnabledFor(DEBUG):
+                logger.debug('Sending: %s %s', command, obfuscate_secrets(md_json))
             self.writer.write('{} {}\n'.format(command, len(md_bytes)).encode('ascii'))
             self.writer.write(md_bytes)
         else:
             assert isinstance(data, bytes)
-            logger.debug('Sending: %s %s + %d B data', command, md_json_safe, len(data))
+            if logger.isEnabledFor(DEBUG):
+                logger.debug('Sending: %s %s + %d B data', command, obfuscate_secrets(md_json), len(data))
             self.writer.write('{} {} {}\n'.format(command, len(md_bytes), len(data)).encode('ascii'))
             self.writer.write(md_bytes)
             self.writer.write(data)
         await wait_for(self.writer.drain(), timeout=socket_timeout)
+        return await self._recv_reply(t0)
+
+    async def _recv_reply(self, t0):
         reply_line = await wait_for(self.reader.readline(), timeout=socket_timeout)
         #logger.debug('Received reply line %r', reply_line)
         reply_line_parts = reply_line.decode('ascii').split()
@@ -120,17 +292,103 @@ class ClientConnection:
             del reply_json
         else:
             reply = None
-        duration_ms = int((monotime() - t0) * 1000)
+        self.last_reply_time = monotime()
+        self.chunk_sizer.record_rtt(self.last_reply_time - t0)
+        duration_ms = int((self.last_reply_time - t0) * 1000)
         if reply_status == 'ok':
-            logger.debug('Received reply in %d ms: %s %s', duration_ms, reply_status, '-' if reply is None else repr(reply))
+            if logger.isEnabledFor(DEBUG):
+                logger.debug('Received reply in %d ms: %s %s', duration_ms, reply_status, '-' if reply is None else repr(reply))
             return reply
         elif reply_status == 'error':
             logger.warning('Received reply in %d ms: %s %s', duration_ms, reply_status, '-' if reply is None else repr(reply))
-            raise ClientError('Error reply: {}'.format(reply))
+            raise ClientError('Error reply: {}'.format(reply), retry_after=(reply or {}).get('retry_after'))
+        elif reply_status == 'resync':
+            logger.info('Received reply in %d ms: %s %r', duration_ms, reply_status, reply)
+            raise ResyncRequired(reply['length'])
         else:
             raise ClientError('Protocol error')
 
 
+class ChunkSizer:
+    '''
+    Chooses the data chunk size from the measured round-trip time and bandwidth.
+
+    The agent waits for the reply to every data command before sending the next
+    one, so to use the link well a chunk must take several round-trip times to
+    transfer (target_rtts x bandwidth-delay product). On the other hand a chunk
+    should not take longer than max_duration seconds, so that slow links do not
+    stall on huge chunks and do not retransmit too much after a failure.
+    '''
+
+    def __init__(self, initial_size=2**18, min_size=2**14, max_size=2**22, target_rtts=4, max_duration=2):
+        self.chunk_size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_rtts = target_rtts
+        self.max_duration = max_duration
+        self.rtt = None # seconds, the lowest reply time seen
+        self.bandwidth = None # bytes per second on the wire, EWMA
+        self.compression_ratio = 1 # wire size / data size, EWMA
+
+    def record_rtt(self, duration):
+        if self.rtt is None or duration < self.rtt:
+            self.rtt = duration
+
+    def record_data(self, wire_size, size, duration):
+        if not size:
+            return
+        self.compression_ratio = 0.7 * self.compression_ratio + 0.3 * wire_size / size
+        if size < self.chunk_size // 2 or self.rtt is None:
+            # small chunk (end of file reached) - the duration is mostly the round-trip time
+            return
+        transfer_time = max(duration - self.rtt, duration / 10, 1e-6)
+        sample = wire_size / transfer_time
+        self.bandwidth = sample if self.bandwidth is None else 0.7 * self.bandwidth + 0.3 * sample
+        wire_target = min(
+            self.bandwidth * max(self.rtt, 1e-3) * self.target_rtts,
+            self.bandwidth * self.max_duration)
+        new_size = int(wire_target / max(self.compression_ratio, 1e-3))
+        new_size = max(self.min_size, min(self.max_size, new_size))
+        if new_size != self.chunk_size:
+            logger.debug(
+                'Chunk size %d -> %d (rtt %.1f ms, bandwidth %.0f kB/s, compression ratio %.2f)',
+                self.chunk_size, new_size, self.rtt * 1000, self.bandwidth / 1000, self.compression_ratio)
+            self.chunk_size = new_size
+
+
+def set_tcp_keepalive(sock, idle=60, interval=10, count=6):
+    '''
+    Same as set_tcp_keepalive() in logline_server.util
+    '''
+    if sock is None:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
+def range_hash(fd, start, end):
+    '''
+    Must be the same as range_hash() in logline_server.verification.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    pos = start
+    while pos < end:
+        data = os.pread(fd, min(2**20, end - pos), pos)
+        if not data:
+            break
+        h.update(data)
+        pos += len(data)
+    return h.hexdigest()
+
+
+def encode_data_frame_header(offset, length, compression=None, data_crc32=None):
+    flags = 0 if data_crc32 is None else flag_crc32
+    return frame_header.pack(frame_type_data, flags, codec_ids[compression], offset, length, data_crc32 or 0)
+
+
 def sha1_b64(data):
     import hashlib
     assert isinstance(data, bytes)
@@ -2,6 +2,10 @@ from logging import getLogger
 import os
 from pathlib import Path
 import re
+from tempfile import gettempdir
+
+from .asyncio_helpers import event_loops
+from .backlog import policies
 
 
 logger = getLogger(__name__)
@@ -19,6 +23,8 @@ class Configuration:
     '''
 
     def __init__(self, args):
+        # kept for configuration reload
+        self.args = args
         if args.conf:
             cfg_path = Path(args.conf)
             cfg_dir = cfg_path.parent
@@ -34,6 +40,11 @@ class Configuration:
         else:
             self.log_file = None
 
+        # level of messages written to the log file; "info" avoids the cost of debug logging
+        self.log_level = cfg.get('log', {}).get('level', 'debug')
+        if self.log_level not in ('debug', 'info', 'warning', 'error'):
+            raise ConfigurationError('Unknown log level: {}'.format(self.log_level))
+
         self.scan_globs = []
         if args.scan:
             self.scan_globs.extend(args.scan)
@@ -41,7 +52,24 @@ class Configuration:
             assert isinstance(cfg['scan'], list)
             self.scan_globs.extend(cfg['scan'])
         logger.debug('scan_globs: %r', self.scan_globs)
-        if not self.scan_globs:
+
+        # log lines received on Unix sockets or named pipes, spooled to files (see listen.py)
+        self.listen_sources = []
+        for item in cfg.get('listen') or []:
+            if bool(item.get('socket')) == bool(item.get('pipe')):
+                raise ConfigurationError('Each listen item must have either socket or pipe: {!r}'.format(item))
+            if not item.get('spool'):
+                raise ConfigurationError('Listen item has no spool file: {!r}'.format(item))
+            self.listen_sources.append({
+                'socket': cfg_dir / item['socket'] if item.get('socket') else None,
+                'pipe': cfg_dir / item['pipe'] if item.get('pipe') else None,
+                'spool': cfg_dir / item['spool'],
+                'spool_max_size': int(item.get('spool_max_size', 2**30)), # in bytes
+                'max_line_length': int(item.get('max_line_length', 2**20)), # in bytes
+            })
+        logger.debug('listen_sources: %r', self.listen_sources)
+
+        if not self.scan_globs and not self.listen_sources:
             raise ConfigurationError('No log sources were configured')
 
         self.exclude_globs = []
@@ -56,10 +84,14 @@ class Configuration:
             self.exclude_if_file_present.extend(cfg['exclude_if_file_present'])
         logger.debug('exclude_if_file_present: %r', self.exclude_if_file_present)
 
+        # files are sharded across the servers, see sharding.py
         if args.server:
-            self.server_host, self.server_port = parse_address(args.server)
+            self.servers = [parse_address(s) for s in args.server]
+        elif cfg.get('servers'):
+            assert isinstance(cfg['servers'], list)
+            self.servers = [parse_address(s) for s in cfg['servers']]
         elif cfg.get('server'):
-            self.server_host, self.server_port = parse_address(cfg['server'])
+            self.servers = [parse_address(cfg['server'])]
         else:
             raise ConfigurationError('No server address configured')
 
@@ -89,13 +121,79 @@ class Configuration:
         else:
             raise ConfigurationError('Client token is not configured')
 
-        self.prefix_length = 50 # in bytes
+        # The file prefix used as its fingerprint is at least prefix_length bytes
+        # and the first prefix_lines lines, but at most max_prefix_length bytes
+        self.prefix_length = int(cfg.get('prefix', {}).get('length', 50)) # in bytes
+        self.prefix_lines = int(cfg.get('prefix', {}).get('lines', 2))
+        self.max_prefix_length = int(cfg.get('prefix', {}).get('max_length', 1024)) # in bytes
         self.min_prefix_length = 20 # in bytes
 
+        # size of the data chunks is adapted to the link, within these bounds
+        chunk_cfg = cfg.get('chunk') or {}
+        self.chunk_initial_size = int(chunk_cfg.get('initial_size', 2**18)) # in bytes
+        self.chunk_min_size = int(chunk_cfg.get('min_size', 2**14)) # in bytes
+        self.chunk_max_size = int(chunk_cfg.get('max_size', 2**22)) # in bytes
+
+        # "uvloop" (if installed) or the default "asyncio"
+        self.event_loop = cfg.get('event_loop', 'asyncio')
+        if self.event_loop not in event_loops:
+            raise ConfigurationError('Unknown event_loop: {}'.format(self.event_loop))
+
+        # limit of memory held by data read from all followed files together
+        self.memory_budget = int(cfg.get('memory_budget', 2**26)) # in bytes
+
+        # file with the acknowledged offsets of the followed files, for fast restarts
+        if cfg.get('state_file'):
+            self.state_file = cfg_dir / cfg['state_file']
+        else:
+            self.state_file = None
+
+        # rotated files not sent yet are hardlinked into this directory (see spool.py);
+        # it must be on the same filesystem as the log files
+        rotated_cfg = cfg.get('rotated_spool') or {}
+        if rotated_cfg.get('directory'):
+            self.rotated_spool_directory = cfg_dir / rotated_cfg['directory']
+        else:
+            self.rotated_spool_directory = None
+        # how many rotated files are sent to the server at the same time
+        self.rotated_drain_concurrency = int(rotated_cfg.get('drain_concurrency', 4))
+        if self.rotated_drain_concurrency < 1:
+            raise ConfigurationError('rotated_spool.drain_concurrency must be at least 1')
+
+        # order in which files with a backlog are read (see backlog.py)
+        catch_up_cfg = cfg.get('catch_up') or {}
+        self.catch_up_policy = catch_up_cfg.get('policy', 'smallest_lag_first')
+        if self.catch_up_policy not in policies:
+            raise ConfigurationError('Unknown catch_up.policy: {}'.format(self.catch_up_policy))
+        self.catch_up_priorities = [(item['glob'], int(item['priority'])) for item in catch_up_cfg.get('priorities') or []]
+        self.catch_up_default_priority = int(catch_up_cfg.get('default_priority', 100))
+
+        # write metrics in the Prometheus text format to this file periodically
+        if cfg.get('metrics', {}).get('file'):
+            self.metrics_file = cfg_dir / cfg['metrics']['file']
+        else:
+            self.metrics_file = None
+        self.metrics_interval = cfg.get('metrics', {}).get('interval', 15)
+
+        # on SIGUSR1 the agent is profiled for this many seconds, see tracing.py
+        profiler_cfg = cfg.get('profiler') or {}
+        if profiler_cfg.get('directory'):
+            self.profiler_directory = cfg_dir / profiler_cfg['directory']
+        else:
+            self.profiler_directory = Path(gettempdir())
+        self.profiler_duration = profiler_cfg.get('duration', 30)
+
+        # compare the already sent part of the file with the server copy
+        # by range hashes after each connect and re-send what differs
+        self.verify_on_connect = bool(cfg.get('verify_on_connect', False))
+
         # All these intervals are in seconds (int or float)
         self.tail_read_interval = 1
         self.scan_new_files_interval = 1
         self.rotated_files_inactivity_threshold = 600
+        # ping the server when there was no data to send for this long,
+        # must be lower than the server idle timeout
+        self.keepalive_interval = cfg.get('keepalive_interval', 60)
 
 
 def parse_address(s):
@@ -0,0 +1,120 @@
+'''
+Log sources that are not files: Unix sockets and named pipes.
+
+High-rate producers can write their log lines to a Unix stream socket or a
+named pipe instead of a file. The agent appends the received lines to a
+local spool file, which is then followed like any other log file - so the
+server sees an ordinary append-only file and its `length` handshake works
+as usual. Only whole lines are appended, so lines from concurrent producers
+never interleave. A line longer than `max_line_length` is not buffered
+indefinitely - it is split and its beginning appended as a line.
+
+After every append the follow_file() task of the spool file is woken up
+directly, instead of finding the new data by polling. When the spool file
+exceeds `spool_max_size`, it is renamed to `<spool>.1` (the previous one is
+replaced) and a new one is started; the agent finishes sending the renamed
+file through the descriptor it has open, like after any log rotation.
+'''
+
+from asyncio import Event, StreamReader, StreamReaderProtocol, start_unix_server
+from logging import getLogger
+import os
+import stat
+
+from .asyncio_helpers import create_task, get_running_loop
+
+
+logger = getLogger(__name__)
+
+read_size = 2**16
+
+
+class SpoolSource:
+
+    def __init__(self, socket_path, pipe_path, spool_path, spool_max_size, max_line_length=2**20):
+        self.socket_path = socket_path
+        self.pipe_path = pipe_path
+        self.spool_path = spool_path
+        self.spool_max_size = spool_max_size
+        self.max_line_length = max_line_length
+        self.spool_file = None
+        # set after data were appended to the spool file
+        self.new_data = Event()
+
+    async def start(self):
+        self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+        self.spool_file = self.spool_path.open('ab')
+        if self.socket_path:
+            if self.socket_path.is_socket():
+                # left after previous run
+                self.socket_path.unlink()
+            self.server = await start_unix_server(self.handle_producer, str(self.socket_path))
+            logger.info('Listening on %s, spooling to %s', self.socket_path, self.spool_path)
+        else:
+            self.pipe_task = create_task(self.read_pipe())
+            logger.info('Reading pipe %s, spooling to %s', self.pipe_path, self.spool_path)
+
+    async def handle_producer(self, reader, writer):
+        try:
+            await self.copy_lines(reader)
+        except Exception as e:
+            logger.warning('Failed to receive log data on %s: %r', self.socket_path, e)
+        finally:
+            writer.close()
+
+    async def read_pipe(self):
+        if not self.pipe_path.exists():
+            os.mkfifo(self.pipe_path)
+        elif not stat.S_ISFIFO(self.pipe_path.stat().st_mode):
+            raise Exception('Not a named pipe: {}'.format(self.pipe_path))
+        # opened also for writing, so that the pipe does not reach EOF when the producers close it
+        pipe = open(os.open(self.pipe_path, os.O_RDWR | os.O_NONBLOCK), 'rb', buffering=0)
+        reader = StreamReader(limit=read_size)
+        await get_running_loop().connect_read_pipe(lambda: StreamReaderProtocol(reader), pipe)
+        await self.copy_lines(reader)
+
+    async def copy_lines(self, reader):
+        partial_line = b''
+        while True:
+            data = await reader.read(read_size)
+            if not data:
+                break
+            data = partial_line + data
+            end = data.rfind(b'\n') + 1
+            partial_line = data[end:]
+            if end:
+                self.append(data[:end])
+            if len(partial_line) >= self.max_line_length:
+                logger.warning(
+                    'Line longer than %d bytes received for %s, splitting it',
+                    self.max_line_length, self.spool_path)
+                self.append(partial_line + b'\n')
+                partial_line = b''
+        if partial_line:
+            # the producer disconnected in the middle of a line
+            self.append(partial_line + b'\n')
+
+    def append(self, data):
+        self.spool_file.write(data)
+        self.spool_file.flush()
+        if self.spool_file.tell() > self.spool_max_size:
+            self.rotate()
+        self.new_data.set()
+
+    def rotate(self):
+        logger.info('Rotating spool file %s', self.spool_path)
+        self.spool_file.close()
+        self.spool_path.replace(self.spool_path.with_name(self.spool_path.name + '.1'))
+        self.spool_file = self.spool_path.open('ab')
+
+
+async def start_listen_sources(conf):
+    '''
+    Return dict spool path -> SpoolSource.
+    '''
+    sources = {}
+    for item in conf.listen_sources:
+        source = SpoolSource(item['socket'], item['pipe'], item['spool'], item['spool_max_size'], item['max_line_length'])
+        await source.start()
+        sources[source.spool_path.resolve()] = source
+    return sources
@@ -1,15 +1,24 @@
 from argparse import ArgumentParser
-from asyncio import sleep
+from asyncio import CancelledError, Event, sleep, wait_for, TimeoutError as AsyncTimeoutError
 from functools import partial
 from glob import glob
 from logging import getLogger
+import os
 from os import fstat
 from pathlib import Path
+import signal
 from time import monotonic as monotime
 
-from .asyncio_helpers import run, create_task
+from .asyncio_helpers import run, create_task, get_running_loop, install_event_loop
+from .backlog import Backlog
 from .configuration import Configuration
-from .client import connect_to_server
+from .client import ResyncRequired, connect_to_server
+from .listen import start_listen_sources
+from .memory import MemoryBudget, metrics_text
+from .sharding import ServerSelector
+from .spool import RotatedSpool
+from .state import AgentState
+from .tracing import Profiler, trace
 
 
 logger = getLogger(__name__)
@@ -21,7 +30,7 @@ def get_argument_parser():
     p.add_argument('--log', help='path to log file')
     p.add_argument('--verbose', '-v', action='store_true')
     p.add_argument('--scan', action='append')
-    p.add_argument('--server')
+    p.add_argument('--server', action='append', help='address of the server (host:port), can be repeated')
     p.add_argument('--tls', action='store_true')
     p.add_argument('--tls-cert', help='path to the file with certificate in PEM format')
     p.add_argument('--token-file', help='path to the file containing client token')
@@ -32,10 +41,12 @@ def agent_main():
     args = get_argument_parser().parse_args()
     setup_logging(verbose=args.verbose)
     conf = Configuration(args=args)
-    setup_log_file(conf.log_file)
+    setup_log_file(conf.log_file, conf.log_level)
     logger.info('Logline Agent starting')
+    install_event_loop(conf.event_loop)
     try:
-        run(async_main(conf), debug=True)
+        # the asyncio debug mode costs CPU time even when idle
+        run(async_main(conf), debug=args.verbose)
     except Exception as e:
         logger.exception('Logline Agent failed: %r', e)
     except BaseException as e:
@@ -62,28 +73,65 @@ def setup_logging(verbose):
     stderr_log_handler = h
 
 
-def setup_log_file(log_file_path):
+def setup_log_file(log_file_path, level='debug'):
     from logging import DEBUG, INFO, ERROR, getLogger, Formatter
     from logging.handlers import WatchedFileHandler
-    if not log_file_path:
-        return
-    h = WatchedFileHandler(str(log_file_path))
-    h.setFormatter(Formatter(log_format))
-    h.setLevel(DEBUG)
-    getLogger('').addHandler(h)
-    own_log_files.add(Path(log_file_path).resolve())
-    if stderr_log_handler:
-        # decrease stderr handler level since we are logging into file instead
-        if stderr_log_handler.level == INFO:
-            stderr_log_handler.setLevel(ERROR)
+    if log_file_path:
+        h = WatchedFileHandler(str(log_file_path))
+        h.setFormatter(Formatter(log_format))
+        h.setLevel(level.upper())
+        getLogger('').addHandler(h)
+        own_log_files.add(Path(log_file_path).resolve())
+        if stderr_log_handler:
+            # decrease stderr handler level since we are logging into file instead
+            if stderr_log_handler.level == INFO:
+                stderr_log_handler.setLevel(ERROR)
+    # when no handler wants debug messages, logger.debug() returns immediately
+    getLogger('').setLevel(min((h.level for h in getLogger('').handlers), default=DEBUG))
 
 
 async def async_main(conf):
     watched_paths = {}
-    assert conf.server_host
-    assert conf.server_port
-    client_factory = partial(connect_to_server, conf=conf)
+    assert conf.servers
+    selector = ServerSelector(conf)
+    client_factory = partial(connect_to_server, conf=conf, selector=selector)
+    memory_budget = MemoryBudget(conf.memory_budget)
+    backlog = Backlog(conf)
+    state = AgentState(conf.state_file)
+    if conf.state_file:
+        state.load()
+        await state.check_with_server(conf, selector)
+        create_task(state.save_periodically())
+    spool = RotatedSpool(conf.rotated_spool_directory, conf.rotated_drain_concurrency)
+    for file_path, file_inode, f in spool.load():
+        create_task(follow_file(conf, file_path, f, file_inode, lambda: None, client_factory, memory_budget, backlog, state, spool))
+    create_task(write_metrics_periodically(conf, memory_budget, backlog, spool))
+    reload_requested = Event()
+    get_running_loop().add_signal_handler(signal.SIGHUP, reload_requested.set)
+    profiler = Profiler('logline-agent', conf.profiler_directory, conf.profiler_duration)
+    get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.start)
+    # spool files of the socket and pipe sources are followed without glob discovery
+    listen_sources = await start_listen_sources(conf)
+    for p, source in listen_sources.items():
+        watched_paths[str(p)] = create_task(watch_path(conf, p, client_factory, memory_budget, backlog, state, spool, source.new_data))
     while True:
+        if reload_requested.is_set():
+            reload_requested.clear()
+            old_files = set(iter_files(conf))
+            try:
+                changed = reload_configuration(conf)
+            except Exception as e:
+                logger.exception('Failed to reload configuration, keeping the current one: %r', e)
+            else:
+                logger.info('Configuration reloaded; changed: %s', ', '.join(changed) or '-')
+                memory_budget.resize(conf.memory_budget)
+                backlog.reclassify()
+                # stop following only the files that are not matched by the new globs
+                for p in sorted(old_files - set(iter_files(conf))):
+                    p_task = watched_paths.pop(str(p), None)
+                    if p_task:
+                        logger.info('Stopping following %s', p)
+                        p_task.cancel()
         for p in iter_files(conf):
             p_task = watched_paths.get(str(p))
             if p_task and p_task.done():
@@ -91,9 +139,53 @@ async def async_main(conf):
                 p_task = None
             if p_task is None:
                 #logger.debug('Found out new path %s from glob %s', p, glob_str)
-                watched_paths[str(p)] = create_task(watch_path(conf, p, client_factory))
+                watched_paths[str(p)] = create_task(watch_path(conf, p, client_factory, memory_budget, backlog, state, spool))
+
+        try:
+            await wait_for(reload_requested.wait(), conf.scan_new_files_interval)
+        except AsyncTimeoutError:
+            pass
+
+
+# Settings that are used only when the agent starts
+restart_required_settings = (
+    'log_file', 'log_level', 'state_file', 'event_loop', 'listen_sources',
+    'rotated_spool_directory', 'rotated_drain_concurrency')
 
-        await sleep(conf.scan_new_files_interval)
+
+def reload_configuration(conf):
+    '''
+    Read the configuration again and update conf in place, so that the running
+    tasks use the new values. Return names of the changed settings.
+
+    Connections that are already open keep their server address, token and
+    chunk size bounds; new connections use the new values.
+    '''
+    new_conf = Configuration(args=conf.args)
+    changed = sorted(name for name, value in vars(new_conf).items() if getattr(conf, name, None) != value)
+    for name in restart_required_settings:
+        if name in changed:
+            logger.warning('Change of %s is applied only after restart', name)
+            setattr(new_conf, name, getattr(conf, name))
+            changed.remove(name)
+    vars(conf).update(vars(new_conf))
+    return changed
+
+
+async def write_metrics_periodically(conf, memory_budget, backlog, spool):
+    while True:
+        # the metrics file can be enabled or changed by configuration reload
+        if conf.metrics_file:
+            tmp_path = conf.metrics_file.with_name(conf.metrics_file.name + '.tmp')
+            try:
+                # write and rename, so that the collector never reads a partial file
+                tmp_path.write_text(
+                    metrics_text(memory_budget) + backlog.metrics_text() + spool.metrics_text() +
+                    trace.metrics_text('logline_agent'))
+                tmp_path.replace(conf.metrics_file)
+            except Exception as e:
+                logger.warning('Failed to write metrics file %s: %r', conf.metrics_file, e)
+        await sleep(conf.metrics_interval)
 
 
 def iter_files(conf):
@@ -109,11 +201,27 @@ def iter_files(conf):
     return sorted(paths)
 
 
-async def watch_path(conf, file_path, client_factory):
+async def watch_path(conf, file_path, client_factory, memory_budget, backlog, state, spool, new_data=None):
+    '''
+    new_data: optional asyncio.Event that is set when data were appended to the file,
+    so that they are sent without waiting for the next tail_read_interval poll
+    '''
     assert file_path == file_path.resolve()
+    follow_tasks = []
+    try:
+        await _watch_path(conf, file_path, client_factory, memory_budget, backlog, state, spool, new_data, follow_tasks)
+    except CancelledError:
+        # stopped after configuration reload
+        for task in follow_tasks:
+            task.cancel()
+        raise
+
+
+async def _watch_path(conf, file_path, client_factory, memory_budget, backlog, state, spool, new_data, follow_tasks):
     last_inode = None
     last_stat_log_message = None
     last_fd = None
+    last_stream = None
     last_task = None
     while True:
         if last_task is not None and last_task.done():
@@ -155,81 +263,176 @@ async def watch_path(conf, file_path, client_factory):
             logger.info('Detected file: %s (inode: %s fd: %s)', file_path, f_inode, f.fileno())
         else:
             logger.info('File rotated: %s (inode: %s -> %s fd: %s)', file_path, last_inode, f_inode, f.fileno())
+            # the previous file may be deleted before it is sent completely
+            spool.keep(file_path, last_inode, last_stream)
 
         # Run follow_file() for this newly opened file
         last_inode = f_inode
         last_fd = f.fileno()
-        last_task = create_task(follow_file(conf, file_path, f, f_inode, lambda: last_inode, client_factory))
+        last_stream = f
+        last_task = create_task(follow_file(conf, file_path, f, f_inode, lambda: last_inode, client_factory, memory_budget, backlog, state, spool, new_data))
+        follow_tasks[:] = [task for task in follow_tasks if not task.done()] + [last_task]
         del f # opened file f will be closed in the just created task
 
 
-async def follow_file(conf, file_path, file_stream, file_inode, get_current_inode, client_factory):
+def fingerprint_length(conf, head, known_length=None):
+    '''
+    Return length of the file prefix sent as its fingerprint.
+
+    Only the first prefix_length bytes would make files with the same header
+    (CSV header, banner line...) look the same, so the prefix covers also the
+    first prefix_lines lines, up to max_prefix_length bytes. The prefix must
+    not be longer than what the server already has (known_length), otherwise
+    the server would not recognize the file and would rotate it - so until the
+    server has confirmed a length, it is only prefix_length bytes.
+    '''
+    if known_length is None:
+        return min(conf.prefix_length, conf.max_prefix_length, len(head))
+    length = conf.prefix_length
+    pos = 0
+    for _ in range(conf.prefix_lines):
+        pos = head.find(b'\n', pos) + 1
+        if not pos:
+            break
+        length = max(length, pos)
+    length = min(length, conf.max_prefix_length, len(head))
+    if known_length is not None:
+        length = min(length, known_length)
+    return length
+
+
+async def wait_for_new_data(conf, new_data):
+    if new_data is None:
+        await sleep(conf.tail_read_interval)
+        return
+    try:
+        await wait_for(new_data.wait(), conf.tail_read_interval)
+    except AsyncTimeoutError:
+        pass
+    # all the follow_file() tasks of the path were woken up, they read everything appended so far
+    new_data.clear()
+
+
+async def follow_file(conf, file_path, file_stream, file_inode, get_current_inode, client_factory, memory_budget, backlog, state, spool, new_data=None):
+    progress = backlog.register(file_path, file_inode)
+    try:
+        await _follow_file(
+            conf, file_path, file_stream, file_inode, get_current_inode, client_factory, memory_budget, backlog, state, spool, new_data, progress)
+    finally:
+        backlog.unregister(progress)
+        file_stream.close()
+    # the file was rotated and closed
+    state.forget(file_path, file_inode)
+    spool.release(file_path, file_inode)
+
+
+async def _follow_file(conf, file_path, file_stream, file_inode, get_current_inode, client_factory, memory_budget, backlog, state, spool, new_data, progress):
     last_data_read_timestamp = monotime()
+    # how much of the file the server is known to have (and with which prefix)
+    known_length = acked_length = state.restore(file_path, file_inode, file_stream.fileno())
     while True:
         try:
             file_too_small_last_logged_size = None
             while True:
-                file_stream.seek(0)
-                prefix = file_stream.read(conf.prefix_length)
-                if len(prefix) < conf.min_prefix_length:
-                    if file_too_small_last_logged_size != len(prefix):
-                        logger.debug('File is too small (%d bytes): %s (fd: %s)', len(prefix), file_path, file_stream.fileno())
-                        file_too_small_last_logged_size = len(prefix)
-                    if file_inode != get_current_inode():
-                        inactive_for = monotime() - last_data_read_timestamp
-                        if inactive_for > conf.rotated_files_inactivity_threshold:
-                            logger.debug(
-                                'Rotated file %s (fd: %s) was inactive for %.3f s, closing',
-                                file_path, file_stream.fileno(), inactive_for)
-                            file_stream.close()
-                            return
-                    await sleep(conf.tail_read_interval)
-                    continue
+                head = os.pread(file_stream.fileno(), conf.max_prefix_length, 0)
+                if len(head) < conf.min_prefix_length:
+                    if file_too_small_last_logged_size != len(head):
+                        logger.debug('File is too small (%d bytes): %s (fd: %s)', len(head), file_path, file_stream.fileno())
+                        file_too_small_last_logged_size = len(head)
+                elif acked_length is not None and fstat(file_stream.fileno()).st_size <= acked_length:
+                    # the server has all the data already - connect only when there are new data
+                    pass
                 else:
                     last_data_read_timestamp = monotime()
                     break
+                if file_inode != get_current_inode():
+                    inactive_for = monotime() - last_data_read_timestamp
+                    if inactive_for > conf.rotated_files_inactivity_threshold:
+                        logger.debug(
+                            'Rotated file %s (fd: %s) was inactive for %.3f s, closing',
+                            file_path, file_stream.fileno(), inactive_for)
+                        file_stream.close()
+                        return
+                await wait_for_new_data(conf, new_data)
+            prefix = head[:fingerprint_length(conf, head, known_length)]
             logger.debug('File %s (fd: %s) prefix: %r', file_path, file_stream.fileno(), prefix)
             assert prefix
-            logger.debug('Connecting to server for file %s (fd: %s)', file_path, file_stream.fileno())
-            client = await client_factory(log_path=file_path, log_prefix=prefix)
-            try:
-                server_length = client.header_reply['length']
-                file_stream.seek(server_length)
-                if file_stream.tell() != server_length:
-                    # This should never happen? Even seeks beyond file end work
-                    # (that's how sparse files are created after all)
-                    logger.warning('Failed to seek %s (fd: %s) to %s - got to %s', file_path, file_stream.fileno(), server_length, file_stream.tell())
-                    raise Exception('Failed to seek {} to {}'.format(file_path, server_length))
-                else:
-                    logger.debug('Seeked %s (fd: %s) to %s', file_path, file_stream.fileno(), server_length)
-                while True:
-                    pos = file_stream.tell()
-                    chunk = file_stream.read(2**20)
-                    assert isinstance(chunk, bytes)
-                    if not chunk:
-                        # nothing was read
-                        #logger.debug('No new content was read from %s (fd: %s) pos %s', file_path, file_stream.fileno(), pos)
-                        if file_inode != get_current_inode():
-                            inactive_for = monotime() - last_data_read_timestamp
-                            if inactive_for > conf.rotated_files_inactivity_threshold:
-                                logger.debug(
-                                    'Rotated file %s (fd: %s) was inactive for %.3f s, closing',
-                                    file_path, file_stream.fileno(), inactive_for)
-                                file_stream.close()
-                                return
-                        await sleep(conf.tail_read_interval)
-                        continue
-                    last_data_read_timestamp = monotime()
-                    logger.debug('Read %d bytes from %s (fd: %s) position %s', len(chunk), file_path, file_stream.fileno(), pos)
-                    await client.send_data(pos, chunk)
-                    #logger.debug('client.send_data(%r, %r) done', pos, chunk)
-                    if file_path in own_log_files:
-                        # do not process our own logfile too often to avoid too much noise
-                        await sleep(60)
-            finally:
-                client.close()
+            async with spool.drain_slot(rotated=file_inode != get_current_inode()):
+                logger.debug('Connecting to server for file %s (fd: %s)', file_path, file_stream.fileno())
+                client = await client_factory(log_path=file_path, log_prefix=prefix)
+                try:
+                    server_length = client.header_reply['length']
+                    known_length = max(len(prefix), server_length)
+                    acked_length = server_length
+                    state.acked(file_path, file_inode, prefix, acked_length)
+                    file_stream.seek(server_length)
+                    if file_stream.tell() != server_length:
+                        # This should never happen? Even seeks beyond file end work
+                        # (that's how sparse files are created after all)
+                        logger.warning('Failed to seek %s (fd: %s) to %s - got to %s', file_path, file_stream.fileno(), server_length, file_stream.tell())
+                        raise Exception('Failed to seek {} to {}'.format(file_path, server_length))
+                    else:
+                        logger.debug('Seeked %s (fd: %s) to %s', file_path, file_stream.fileno(), server_length)
+                    if conf.verify_on_connect:
+                        resent = await client.verify_and_repair(file_stream, server_length)
+                        logger.info('Verified %s (fd: %s): %d bytes re-sent', file_path, file_stream.fileno(), resent)
+                    while True:
+                        pos = file_stream.tell()
+                        progress.update(pos, fstat(file_stream.fileno()).st_size)
+                        read_length = 0
+                        if progress.lag:
+                            t0 = monotime()
+                            # the read chunk and its compressed copy
+                            reserved = 2 * min(client.chunk_size, progress.lag)
+                            await memory_budget.acquire(reserved, priority=backlog.priority(progress))
+                            try:
+                                t_read = trace.start('read')
+                                chunk = file_stream.read(reserved // 2)
+                                trace.stop('read', t_read)
+                                assert isinstance(chunk, bytes)
+                                read_length = len(chunk)
+                                if chunk:
+                                    last_data_read_timestamp = monotime()
+                                    logger.debug('Read %d bytes from %s (fd: %s) position %s', len(chunk), file_path, file_stream.fileno(), pos)
+                                    t_send = trace.start('send_data')
+                                    await client.send_data(pos, chunk)
+                                    trace.stop('send_data', t_send)
+                                    known_length = max(known_length, pos + len(chunk))
+                                    acked_length = pos + len(chunk)
+                                    state.acked(file_path, file_inode, prefix, acked_length)
+                                    progress.record_sent(len(chunk), monotime() - t0)
+                            except ResyncRequired as e:
+                                logger.info('Resyncing %s (fd: %s) from %s to %s', file_path, file_stream.fileno(), pos, e.length)
+                                file_stream.seek(e.length)
+                                acked_length = e.length
+                                state.acked(file_path, file_inode, prefix, acked_length)
+                                continue
+                            finally:
+                                chunk = None
+                                memory_budget.release(reserved)
+                        if not read_length:
+                            # nothing was read
+                            #logger.debug('No new content was read from %s (fd: %s) pos %s', file_path, file_stream.fileno(), pos)
+                            if file_inode != get_current_inode():
+                                # rotated file was sent completely - free the drain slot and wait
+                                # for more data (or inactivity) without connection
+                                logger.debug('Rotated file %s (fd: %s) was sent completely, disconnecting', file_path, file_stream.fileno())
+                                try:
+                                    await client.goodbye()
+                                except Exception as e:
+                                    logger.debug('Failed to say goodbye: %r', e)
+                                break
+                            if monotime() - client.last_reply_time > conf.keepalive_interval:
+                                await client.ping()
+                            await wait_for_new_data(conf, new_data)
+                            continue
+                        if file_path in own_log_files:
+                            # do not process our own logfile too often to avoid too much noise
+                            await sleep(60)
+                finally:
+                    client.close()
         except Exception as e:
             logger.exception('Failed to follow file %s (fd: %r): %r', file_path, file_stream.fileno(), e)
-            await sleep(10)
+            await sleep(getattr(e, 'retry_after', None) or 10)
             logger.info('Trying again to follow file %s (fd: %r)', file_path, file_stream.fileno())
             continue
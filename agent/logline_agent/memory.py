@@ -0,0 +1,118 @@
+'''
+Accounting of memory used by data read from the followed files.
+
+Every follow_file() task holds a chunk of the file and its compressed copy
+until the server acknowledges it, and the data stay in the asyncio write
+buffer until drain(). When many files catch up at once (after an outage),
+this adds up, so before reading a chunk its size (times two, for the
+compressed copy) must be acquired from the agent-wide MemoryBudget, and it
+is released after the chunk was sent. When the budget is exhausted, the
+tasks wait instead of the agent allocating more memory.
+'''
+
+from heapq import heappop, heappush
+from itertools import count
+import os
+import resource
+
+from .asyncio_helpers import get_running_loop
+
+
+class MemoryBudget:
+    '''
+    Waiting acquires are granted in order of their priority (lower first),
+    so that the files selected by the catch-up policy are read first.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.peak = 0
+        self.waits = 0
+        self.waiters = [] # heap of [priority, sequence number, size, future]
+        self.sequence = count()
+
+    def _fits(self, size):
+        # a chunk larger than the whole budget waits until nothing else is held
+        return self.used + size <= self.max_bytes or self.used == 0
+
+    async def acquire(self, size, priority=0):
+        '''
+        Wait until size bytes are available.
+        '''
+        if not self.waiters and self._fits(size):
+            self._charge(size)
+            return
+        self.waits += 1
+        waiter = [priority, next(self.sequence), size, get_running_loop().create_future()]
+        heappush(self.waiters, waiter)
+        try:
+            await waiter[3]
+        except BaseException:
+            if waiter[3].done() and not waiter[3].cancelled():
+                # granted, but the task was cancelled at the same time
+                self.release(size)
+            else:
+                self.waiters.remove(waiter)
+                self.waiters.sort()
+                self._grant()
+            raise
+
+    def release(self, size):
+        self.used -= size
+        self._grant()
+
+    def resize(self, max_bytes):
+        '''
+        Change the limit (configuration reload); already acquired memory stays acquired.
+        '''
+        self.max_bytes = max_bytes
+        self._grant()
+
+    def _charge(self, size):
+        self.used += size
+        self.peak = max(self.peak, self.used)
+
+    def _grant(self):
+        while self.waiters and self._fits(self.waiters[0][2]):
+            _, _, size, future = heappop(self.waiters)
+            self._charge(size)
+            future.set_result(None)
+
+
+def get_rss():
+    '''
+    Return current resident set size of this process in bytes, or None if not available.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def get_max_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def metrics_text(memory_budget):
+    '''
+    Return metrics in the Prometheus text format (for the node_exporter textfile collector).
+    '''
+    metrics = [
+        ('logline_agent_memory_budget_bytes', 'gauge', 'Limit of memory held by read data', memory_budget.max_bytes),
+        ('logline_agent_memory_budget_used_bytes', 'gauge', 'Memory held by read data', memory_budget.used),
+        ('logline_agent_memory_budget_peak_bytes', 'gauge', 'Peak of memory held by read data', memory_budget.peak),
+        ('logline_agent_memory_budget_waits_total', 'counter', 'Reads that waited for the memory budget', memory_budget.waits),
+        ('logline_agent_resident_memory_bytes', 'gauge', 'Resident set size of the agent process', get_rss()),
+        ('logline_agent_max_resident_memory_bytes', 'gauge', 'Peak resident set size of the agent process', get_max_rss()),
+    ]
+    lines = []
+    for name, metric_type, help_text, value in metrics:
+        if value is None:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.append(f'{name} {value}')
+    return ''.join(line + '\n' for line in lines)
@@ -0,0 +1,62 @@
+'''
+Client-side sharding of files across multiple servers.
+
+Every file (hostname and path) is sent to the server with the highest
+rendezvous hash of (server, hostname, path). Adding or removing a server
+remaps only the files that move to or from that server; all the others keep
+their server, so their mirror stays in one place.
+
+A server that could not be connected to is considered unhealthy for
+`unhealthy_interval` seconds and its files go to the next server in their
+rendezvous order meanwhile. The handshake on the other server starts from
+its own length, so both mirrors stay consistent (the other one may just
+contain the whole file again); when the original server is back, the files
+return to it and continue where they left off there.
+'''
+
+import hashlib
+from logging import getLogger
+from time import monotonic as monotime
+
+
+logger = getLogger(__name__)
+
+# seconds
+unhealthy_interval = 30
+
+
+def rendezvous_score(server, hostname, path):
+    host, port = server
+    key = f'{host}:{port}\0{hostname}\0{path}'.encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+
+class ServerSelector:
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.unhealthy_until = {} # (host, port) -> monotime
+
+    def servers_for(self, hostname, path):
+        '''
+        Return the configured servers in the order in which they should be used for the file.
+        '''
+        return sorted(self.conf.servers, key=lambda server: rendezvous_score(server, hostname, path), reverse=True)
+
+    def select(self, hostname, path):
+        servers = self.servers_for(hostname, path)
+        now = monotime()
+        for server in servers:
+            if self.unhealthy_until.get(server, 0) <= now:
+                return server
+        # all servers are unhealthy - try the preferred one anyway
+        return servers[0]
+
+    def failed(self, server):
+        if self.unhealthy_until.get(server, 0) <= monotime():
+            logger.warning('Server %s:%s is unhealthy', *server)
+        self.unhealthy_until[server] = monotime() + unhealthy_interval
+
+    def succeeded(self, server):
+        if self.unhealthy_until.pop(server, None):
+            logger.info('Server %s:%s is healthy again', *server)
@@ -0,0 +1,137 @@
+'''
+Spool of rotated files that were not sent completely yet.
+
+A rotated file is followed through the file descriptor opened before the
+rotation, so it is sent even after it was renamed or deleted - but only as
+long as the agent runs. When the server is unreachable for a long time, the
+rotated files are often deleted by logrotate before they could be sent, and
+an agent restart would lose them.
+
+So when a rotation is detected, the previous file is hardlinked into the
+spool directory (through /proc/self/fd, so it must be on the same
+filesystem), together with a small JSON file with its original path. The
+link is removed when the file was sent completely and closed. After a
+restart the agent resumes sending the files found in the spool directory.
+
+Rotated files catch up at most `drain_concurrency` at a time, so after an
+outage they do not compete with each other (and with the current files)
+for the server, and each one is finished in a predictable time. A rotated
+file disconnects when it has been sent completely and takes a slot again
+only when more data are appended to it.
+'''
+
+from asyncio import Semaphore
+from contextlib import asynccontextmanager
+import json
+from logging import getLogger
+import os
+from pathlib import Path
+
+
+logger = getLogger(__name__)
+
+
+class RotatedSpool:
+
+    def __init__(self, directory, drain_concurrency):
+        self.directory = directory
+        self.drain_semaphore = Semaphore(drain_concurrency)
+        self.files = {} # inode -> original path
+        self.draining = 0
+        self.waiting = 0
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def load(self):
+        '''
+        Return list of (original path, inode, opened file) of the files left in the spool.
+        '''
+        result = []
+        if not self.directory:
+            return result
+        for meta_path in sorted(self.directory.glob('*.json')):
+            link_path = meta_path.with_suffix('')
+            try:
+                file_path = Path(json.loads(meta_path.read_text())['path'])
+                f = link_path.open('rb')
+            except Exception as e:
+                logger.warning('Failed to load spooled file %s: %r', link_path, e)
+                self._remove(link_path)
+                continue
+            inode = os.fstat(f.fileno()).st_ino
+            self.files[inode] = file_path
+            result.append((file_path, inode, f))
+            logger.info('Resuming spooled rotated file %s (inode: %s)', file_path, inode)
+        return result
+
+    def keep(self, file_path, inode, file_stream):
+        '''
+        Hardlink the rotated file, so that it survives deletion and agent restart.
+        '''
+        if not self.directory or inode in self.files or file_stream.closed:
+            return
+        link_path = self.directory / str(inode)
+        try:
+            link_path.with_suffix('.json').write_text(json.dumps({'path': str(file_path)}))
+            # with dir_fd os.link() uses linkat() that follows the /proc symlink
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.link(f'/proc/self/fd/{file_stream.fileno()}', link_path.name, dst_dir_fd=dir_fd, follow_symlinks=True)
+            finally:
+                os.close(dir_fd)
+            if link_path.stat().st_ino != inode:
+                raise Exception('Linked a different file')
+        except Exception as e:
+            logger.warning('Failed to spool rotated file %s (inode: %s): %r', file_path, inode, e)
+            self._remove(link_path)
+            return
+        self.files[inode] = file_path
+        logger.debug('Spooled rotated file %s (inode: %s) as %s', file_path, inode, link_path)
+
+    def release(self, file_path, inode):
+        '''
+        Called when the file was sent completely and closed.
+        '''
+        if self.files.pop(inode, None):
+            self._remove(self.directory / str(inode))
+
+    def _remove(self, link_path):
+        for p in link_path, link_path.with_suffix('.json'):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+
+    @asynccontextmanager
+    async def drain_slot(self, rotated):
+        '''
+        Limit how many rotated files are sent at the same time; current files are not limited.
+        '''
+        if not rotated:
+            yield
+            return
+        self.waiting += 1
+        try:
+            await self.drain_semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.draining += 1
+        try:
+            yield
+        finally:
+            self.draining -= 1
+            self.drain_semaphore.release()
+
+    def metrics_text(self):
+        lines = [
+            '# HELP logline_agent_rotated_spool_files Rotated files kept in the spool directory',
+            '# TYPE logline_agent_rotated_spool_files gauge',
+            f'logline_agent_rotated_spool_files {len(self.files)}',
+            '# HELP logline_agent_rotated_draining_files Rotated files being sent',
+            '# TYPE logline_agent_rotated_draining_files gauge',
+            f'logline_agent_rotated_draining_files {self.draining}',
+            '# HELP logline_agent_rotated_waiting_files Rotated files waiting for a drain slot',
+            '# TYPE logline_agent_rotated_waiting_files gauge',
+            f'logline_agent_rotated_waiting_files {self.waiting}',
+        ]
+        return ''.join(line + '\n' for line in lines)
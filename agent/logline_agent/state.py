@@ -0,0 +1,131 @@
+'''
+Persistent agent state.
+
+The agent remembers for every followed file (path and inode) the prefix it
+was identified by and how much of it the server has acknowledged. The state
+is saved periodically to `state_file`.
+
+After a restart, the files whose inode and prefix still match are checked
+with the server in one `logline-lengths-v1` round-trip instead of a handshake
+per file, and follow_file() does not connect to the server for a file until
+it has new data. The server length from the handshake stays authoritative -
+a stale state only means that a file is connected to a bit earlier. If the
+query fails, the saved offsets are not used: the server may have lost data,
+so every file is handshaked, even if it does not grow.
+'''
+
+from asyncio import sleep, wait_for
+import json
+from logging import getLogger
+import os
+
+from .asyncio_helpers import to_thread
+from .client import query_lengths, sha1_b64
+
+
+logger = getLogger(__name__)
+
+# seconds between saves of the state file
+state_save_interval = 5
+
+# seconds for the lengths query at startup (connect included) - after that the files are handshaked one by one
+lengths_query_timeout = 30
+
+
+class AgentState:
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {} # "inode:path" -> {'path', 'inode', 'prefix_length', 'prefix_sha1', 'offset'}
+        self.dirty = False
+
+    def load(self):
+        try:
+            self.files = json.loads(self.path.read_text())['files']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning('Failed to load state file %s: %r', self.path, e)
+
+    def restore(self, file_path, inode, fd):
+        '''
+        Return length of the file the server has, if known and the file is still the same.
+        '''
+        item = self.files.get(f'{inode}:{file_path}')
+        if item is None:
+            return None
+        prefix = os.pread(fd, item['prefix_length'], 0)
+        if len(prefix) != item['prefix_length'] or sha1_b64(prefix) != item['prefix_sha1']:
+            self.forget(file_path, inode)
+            return None
+        return item['offset']
+
+    def acked(self, file_path, inode, prefix, offset):
+        self.files[f'{inode}:{file_path}'] = {
+            'path': str(file_path),
+            'inode': inode,
+            'prefix_length': len(prefix),
+            'prefix_sha1': sha1_b64(prefix),
+            'offset': offset,
+        }
+        self.dirty = True
+
+    def forget(self, file_path, inode):
+        if self.files.pop(f'{inode}:{file_path}', None):
+            self.dirty = True
+
+    async def check_with_server(self, conf, selector):
+        '''
+        Drop the files that changed or are gone and update the offsets from the server.
+        '''
+        files = []
+        for key, item in list(self.files.items()):
+            try:
+                with open(item['path'], 'rb') as f:
+                    if os.fstat(f.fileno()).st_ino != item['inode']:
+                        raise FileNotFoundError(item['path'])
+                    prefix = f.read(item['prefix_length'])
+            except OSError:
+                del self.files[key]
+                continue
+            if sha1_b64(prefix) != item['prefix_sha1']:
+                del self.files[key]
+                continue
+            files.append((key, item['path'], prefix))
+        self.dirty = True
+        if not files:
+            return
+        try:
+            lengths = await wait_for(
+                query_lengths(conf, [(path, prefix) for _, path, prefix in files], selector),
+                lengths_query_timeout)
+        except Exception as e:
+            # without the query the offsets would prevent the handshake of the files that do not grow
+            logger.warning('Failed to query file lengths from server: %r', e)
+            for key, _, _ in files:
+                self.files[key]['offset'] = None
+            return
+        for (key, _, _), length in zip(files, lengths):
+            if length is None:
+                del self.files[key]
+            else:
+                self.files[key]['offset'] = length
+        logger.info('Checked state of %d files with server', len(files))
+
+    async def save_periodically(self):
+        while True:
+            await sleep(state_save_interval)
+            if self.dirty:
+                self.dirty = False
+                try:
+                    await to_thread(self.save, json.dumps({'files': self.files}, sort_keys=True))
+                except Exception as e:
+                    logger.exception('Failed to save state file %s: %r', self.path, e)
+
+    def save(self, state_json):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with tmp_path.open('w') as f:
+            f.write(state_json)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path.replace(self.path)
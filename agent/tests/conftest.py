@@ -1,7 +1,20 @@
 from pathlib import Path
 from pytest import fixture
 
+from logline_agent.configuration import Configuration
+from logline_agent.main import get_argument_parser
+
 
 @fixture
 def temp_dir(tmpdir):
     return Path(tmpdir)
+
+
+@fixture
+def load_conf(temp_dir):
+    def load_conf(conf_yaml):
+        (temp_dir / 'configuration.yaml').write_text(conf_yaml)
+        args = get_argument_parser().parse_args(['--conf', str(temp_dir / 'configuration.yaml')])
+        conf = Configuration(args=args)
+        return conf
+    return load_conf
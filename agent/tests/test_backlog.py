@@ -0,0 +1,67 @@
+from asyncio import create_task, run, sleep
+from pathlib import Path
+
+from logline_agent.backlog import Backlog
+from logline_agent.memory import MemoryBudget
+
+
+def test_smallest_lag_first(load_conf):
+    conf = load_conf('''\
+        server: 127.0.0.1:9999
+        client_token: topsecret
+        scan:
+          - /var/log/*.log
+        catch_up:
+          priorities:
+            - glob: /var/log/important*.log
+              priority: 10
+    ''')
+    backlog = Backlog(conf)
+    big = backlog.register(Path('/var/log/big.log'), 1)
+    small = backlog.register(Path('/var/log/small.log'), 2)
+    important = backlog.register(Path('/var/log/important.log'), 3)
+    big.update(0, 10**9)
+    small.update(0, 10**3)
+    important.update(0, 10**8)
+    assert important.priority_class == 10
+    assert small.priority_class == 100
+
+    async def scenario():
+        budget = MemoryBudget(100)
+        granted = []
+        async def read(progress):
+            await budget.acquire(100, priority=backlog.priority(progress))
+            granted.append(progress)
+            budget.release(100)
+        await budget.acquire(100)
+        tasks = [create_task(read(p)) for p in (big, small, important)]
+        await sleep(0.01)
+        assert granted == []
+        budget.release(100)
+        for task in tasks:
+            await task
+        return granted
+
+    assert run(scenario()) == [important, small, big]
+
+
+def test_catch_up_time(load_conf):
+    conf = load_conf('''\
+        server: 127.0.0.1:9999
+        client_token: topsecret
+        scan:
+          - /var/log/*.log
+    ''')
+    backlog = Backlog(conf)
+    progress = backlog.register(Path('/var/log/example.log'), 1)
+    progress.update(1000, 11000)
+    assert progress.catch_up_time() is None
+    progress.record_sent(1000, 0.5)
+    assert progress.catch_up_time() == 5
+    text = backlog.metrics_text()
+    assert 'logline_agent_file_lag_bytes{path="/var/log/example.log",inode="1"} 10000\n' in text
+    assert 'logline_agent_file_catch_up_seconds{path="/var/log/example.log",inode="1"} 5.000\n' in text
+    progress.update(11000, 11000)
+    assert progress.catch_up_time() == 0
+    backlog.unregister(progress)
+    assert 'example.log' not in backlog.metrics_text()
@@ -0,0 +1,76 @@
+from asyncio import run
+import hashlib
+
+from logline_agent.client import ChunkSizer, ClientConnection
+
+
+class FakeConnection (ClientConnection):
+    '''
+    Server copy of the file is kept in memory.
+    '''
+
+    def __init__(self, server_copy):
+        super().__init__(None, None)
+        self.server_copy = bytearray(server_copy)
+        self.hashes_commands = 0
+
+    async def get_range_hashes(self, ranges):
+        self.hashes_commands += 1
+        return [hashlib.blake2b(bytes(self.server_copy[s:e]), digest_size=16).hexdigest() for s, e in ranges]
+
+    async def send_data(self, offset, content, repair=False):
+        assert repair
+        self.server_copy[offset:offset + len(content)] = content
+
+
+def test_verify_and_repair(temp_dir):
+    content = bytes(range(256)) * 40000
+    path = temp_dir / 'example.log'
+    path.write_bytes(content)
+    server_copy = bytearray(content)
+    server_copy[5000000:5000003] = b'xxx'
+    conn = FakeConnection(server_copy)
+    with path.open('rb') as f:
+        assert run(conn.verify_and_repair(f, len(content))) == 2**16
+        assert conn.server_copy == content
+        assert conn.hashes_commands <= 6
+        conn.hashes_commands = 0
+        assert run(conn.verify_and_repair(f, len(content))) == 0
+        assert conn.hashes_commands == 1
+
+
+class NoRepairConnection (FakeConnection):
+
+    async def send_data(self, offset, content, repair=False):
+        assert repair
+        return {'repaired': False}
+
+
+def test_verify_without_repair(temp_dir):
+    content = b'hello world\n'
+    path = temp_dir / 'example.log'
+    path.write_bytes(content)
+    conn = NoRepairConnection(b'hello WORLD\n')
+    with path.open('rb') as f:
+        assert run(conn.verify_and_repair(f, len(content))) == 0
+
+
+def simulate_link(sizer, rtt, bandwidth, rounds=30):
+    sizer.record_rtt(rtt)
+    for _ in range(rounds):
+        size = sizer.chunk_size
+        # data compress 1:4
+        sizer.record_data(size // 4, size, rtt + size / 4 / bandwidth)
+    return sizer.chunk_size
+
+
+def test_chunk_sizer_slow_wan():
+    # 100 ms, 100 kB/s - chunk should take at most 2 seconds
+    size = simulate_link(ChunkSizer(), 0.1, 100e3)
+    assert 100e3 * 4 * 0.4 * 0.9 < size < 100e3 * 4 * 2
+
+
+def test_chunk_sizer_fast_lan():
+    # 0.5 ms, 100 MB/s - bounded by max_size
+    assert simulate_link(ChunkSizer(max_size=2**22), 0.0005, 100e6) > 2**18
+    assert simulate_link(ChunkSizer(max_size=2**20), 0.002, 1e9) == 2**20
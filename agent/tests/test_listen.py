@@ -0,0 +1,88 @@
+from asyncio import open_unix_connection, run, sleep
+import os
+
+from logline_agent.listen import SpoolSource, start_listen_sources
+
+
+def test_socket_source_appends_whole_lines(temp_dir, load_conf):
+    conf = load_conf('''\
+        server: 127.0.0.1:9999
+        client_token: topsecret
+        listen:
+          - socket: app.sock
+            spool: spool/app.log
+    ''')
+    assert conf.scan_globs == []
+
+    async def scenario():
+        sources = await start_listen_sources(conf)
+        source, = sources.values()
+        assert not source.new_data.is_set()
+        _, writer1 = await open_unix_connection(str(temp_dir / 'app.sock'))
+        _, writer2 = await open_unix_connection(str(temp_dir / 'app.sock'))
+        writer1.write(b'first line\nsecond ')
+        await writer1.drain()
+        await sleep(0.05)
+        assert source.new_data.is_set()
+        writer2.write(b'other producer\n')
+        await writer2.drain()
+        await sleep(0.05)
+        writer1.write(b'line\nunterminated')
+        writer1.close()
+        writer2.close()
+        await sleep(0.05)
+        source.server.close()
+        return sources
+
+    sources = run(scenario())
+    assert list(sources) == [(temp_dir / 'spool/app.log').resolve()]
+    assert (temp_dir / 'spool/app.log').read_bytes() == b'first line\nother producer\nsecond line\nunterminated\n'
+
+
+def test_pipe_source(temp_dir):
+    source = SpoolSource(None, temp_dir / 'app.fifo', temp_dir / 'app.log', 2**20)
+
+    async def scenario():
+        await source.start()
+        await sleep(0.05)
+        for n in range(2):
+            # producers come and go, the pipe stays open
+            fd = os.open(temp_dir / 'app.fifo', os.O_WRONLY)
+            os.write(fd, b'line %d\n' % n)
+            os.close(fd)
+            await sleep(0.05)
+        source.pipe_task.cancel()
+
+    run(scenario())
+    assert (temp_dir / 'app.log').read_bytes() == b'line 0\nline 1\n'
+
+
+def test_spool_rotation(temp_dir):
+    source = SpoolSource(temp_dir / 'app.sock', None, temp_dir / 'app.log', 15)
+    source.spool_file = source.spool_path.open('ab')
+    source.append(b'first line\n')
+    assert not (temp_dir / 'app.log.1').exists()
+    source.append(b'second line\n')
+    source.append(b'third line\n')
+    source.spool_file.close()
+    assert (temp_dir / 'app.log.1').read_bytes() == b'first line\nsecond line\n'
+    assert (temp_dir / 'app.log').read_bytes() == b'third line\n'
+
+
+def test_long_line_is_split(temp_dir):
+    source = SpoolSource(temp_dir / 'app.sock', None, temp_dir / 'app.log', 2**20, max_line_length=100)
+
+    async def scenario():
+        await source.start()
+        _, writer = await open_unix_connection(str(temp_dir / 'app.sock'))
+        writer.write(b'x' * 150)
+        await writer.drain()
+        await sleep(0.05)
+        writer.write(b'y' * 10 + b'\nshort line\n')
+        await writer.drain()
+        writer.close()
+        await sleep(0.05)
+        source.server.close()
+
+    run(scenario())
+    assert (temp_dir / 'app.log').read_bytes() == b'x' * 150 + b'\n' + b'y' * 10 + b'\nshort line\n'
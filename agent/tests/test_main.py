@@ -1,17 +1,4 @@
-from logline_agent.configuration import Configuration
-from logline_agent.main import get_argument_parser, iter_files
-
-from pytest import fixture
-
-
-@fixture
-def load_conf(temp_dir):
-    def load_conf(conf_yaml):
-        (temp_dir / 'configuration.yaml').write_text(conf_yaml)
-        args = get_argument_parser().parse_args(['--conf', str(temp_dir / 'configuration.yaml')])
-        conf = Configuration(args=args)
-        return conf
-    return load_conf
+from logline_agent.main import fingerprint_length, iter_files, reload_configuration
 
 
 def test_iter_files(temp_dir, load_conf):
@@ -34,3 +21,46 @@ def test_iter_files(temp_dir, load_conf):
     (temp_dir / 'file-excluded' / 'skip').write_text('')
     (temp_dir / 'file-excluded' / 'not_this.log').write_text('This file should be also excluded\n')
     assert list(iter_files(conf)) == [(temp_dir / 'log' / 'example.log')]
+
+
+def test_fingerprint_length(load_conf):
+    conf = load_conf('''\
+        server: 127.0.0.1:9999
+        client_token: topsecret
+        scan:
+          - /nonexistent/*.log
+    ''')
+    header = b'timestamp,host,level,message,request_id,duration,status\n'
+    head = header + b'2021-02-22T17:00:00,web1,INFO,hello,abc,12,200\n' + b'x' * 2000
+    assert fingerprint_length(conf, head, known_length=10000) == head.index(b'\n', len(header)) + 1
+    # the server has not confirmed any length yet
+    assert fingerprint_length(conf, head) == 50
+    # no newline
+    assert fingerprint_length(conf, b'x' * 2000) == 50
+    # short file
+    assert fingerprint_length(conf, b'x' * 30) == 30
+    # the server has only part of the file
+    assert fingerprint_length(conf, head, known_length=40) == 40
+
+
+def test_reload_configuration(temp_dir, load_conf):
+    conf = load_conf(f'''\
+        server: 127.0.0.1:9999
+        client_token: topsecret
+        scan:
+          - {temp_dir}/*.log
+    ''')
+    (temp_dir / 'configuration.yaml').write_text(f'''\
+        server: 127.0.0.1:9999
+        client_token: topsecret
+        scan:
+          - {temp_dir}/*.log
+          - {temp_dir}/*.txt
+        keepalive_interval: 30
+        state_file: state.json
+    ''')
+    assert reload_configuration(conf) == ['keepalive_interval', 'scan_globs']
+    assert conf.scan_globs == [f'{temp_dir}/*.log', f'{temp_dir}/*.txt']
+    assert conf.keepalive_interval == 30
+    # applied only after restart
+    assert conf.state_file is None
@@ -0,0 +1,29 @@
+from asyncio import create_task, run, sleep
+
+from logline_agent.memory import MemoryBudget, metrics_text
+
+
+def test_memory_budget_waits_until_released():
+    async def scenario():
+        budget = MemoryBudget(100)
+        await budget.acquire(60)
+        task = create_task(budget.acquire(60))
+        await sleep(0.01)
+        assert not task.done()
+        assert budget.used == 60
+        budget.release(60)
+        await task
+        assert budget.used == 60
+        assert budget.waits == 1
+        budget.release(60)
+        # a chunk larger than the whole budget is allowed when nothing else is held
+        await budget.acquire(500)
+        assert budget.peak == 500
+        budget.release(500)
+        assert budget.used == 0
+        return budget
+    budget = run(scenario())
+    text = metrics_text(budget)
+    assert 'logline_agent_memory_budget_bytes 100\n' in text
+    assert 'logline_agent_memory_budget_used_bytes 0\n' in text
+    assert 'logline_agent_memory_budget_waits_total 1\n' in text
@@ -0,0 +1,37 @@
+from collections import Counter
+from types import SimpleNamespace
+
+from logline_agent.configuration import parse_address
+from logline_agent.sharding import ServerSelector
+
+
+def make_selector(addresses):
+    return ServerSelector(SimpleNamespace(servers=[parse_address(a) for a in addresses]))
+
+
+def test_rendezvous_distribution_and_remapping():
+    paths = [f'/var/log/app{i}.log' for i in range(1000)]
+    selector = make_selector(['s1:5645', 's2:5645', 's3:5645'])
+    before = {path: selector.select('web1', path) for path in paths}
+    counts = Counter(before.values())
+    assert len(counts) == 3
+    assert min(counts.values()) > 250
+    # adding a server moves only the files that now belong to it
+    selector = make_selector(['s1:5645', 's2:5645', 's3:5645', 's4:5645'])
+    after = {path: selector.select('web1', path) for path in paths}
+    moved = [path for path in paths if before[path] != after[path]]
+    assert all(after[path] == ('s4', 5645) for path in moved)
+    assert 150 < len(moved) < 350
+
+
+def test_unhealthy_server_is_skipped():
+    selector = make_selector(['s1:5645', 's2:5645'])
+    preferred, second = selector.servers_for('web1', '/var/log/app.log')
+    assert selector.select('web1', '/var/log/app.log') == preferred
+    selector.failed(preferred)
+    assert selector.select('web1', '/var/log/app.log') == second
+    selector.failed(second)
+    # all unhealthy - use the preferred one
+    assert selector.select('web1', '/var/log/app.log') == preferred
+    selector.succeeded(preferred)
+    assert selector.select('web1', '/var/log/app.log') == preferred
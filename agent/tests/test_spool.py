@@ -0,0 +1,59 @@
+from asyncio import create_task, run, sleep
+import os
+
+from logline_agent.spool import RotatedSpool
+
+
+def test_rotated_file_survives_deletion_and_restart(temp_dir):
+    log_path = temp_dir / 'app.log'
+    log_path.write_bytes(b'first line\n')
+    f = log_path.open('rb')
+    inode = os.fstat(f.fileno()).st_ino
+    spool = RotatedSpool(temp_dir / 'spool', 2)
+    # rotated and deleted
+    log_path.rename(temp_dir / 'app.log.1')
+    spool.keep(log_path, inode, f)
+    (temp_dir / 'app.log.1').unlink()
+    f.close()
+    assert 'logline_agent_rotated_spool_files 1\n' in spool.metrics_text()
+    # agent restart
+    spool = RotatedSpool(temp_dir / 'spool', 2)
+    (file_path, file_inode, f), = spool.load()
+    assert file_path == log_path
+    assert file_inode == inode
+    assert f.read() == b'first line\n'
+    f.close()
+    spool.release(file_path, file_inode)
+    assert list((temp_dir / 'spool').iterdir()) == []
+    assert spool.load() == []
+
+
+def test_keep_without_directory_does_nothing(temp_dir):
+    (temp_dir / 'app.log').write_bytes(b'first line\n')
+    spool = RotatedSpool(None, 2)
+    with (temp_dir / 'app.log').open('rb') as f:
+        spool.keep(temp_dir / 'app.log', os.fstat(f.fileno()).st_ino, f)
+    assert spool.files == {}
+    assert spool.load() == []
+
+
+def test_drain_slots_limit_only_rotated_files():
+    async def scenario():
+        spool = RotatedSpool(None, 2)
+        running = []
+
+        async def send(rotated):
+            async with spool.drain_slot(rotated=rotated):
+                running.append(rotated)
+                await sleep(0.05)
+
+        tasks = [create_task(send(True)) for _ in range(3)] + [create_task(send(False)) for _ in range(2)]
+        await sleep(0.01)
+        assert sorted(running) == [False, False, True, True]
+        assert (spool.draining, spool.waiting) == (2, 1)
+        for task in tasks:
+            await task
+        assert len(running) == 5
+        assert (spool.draining, spool.waiting) == (0, 0)
+
+    run(scenario())
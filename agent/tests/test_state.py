@@ -0,0 +1,75 @@
+from asyncio import run
+import json
+import os
+
+from logline_agent import state as state_module
+from logline_agent.state import AgentState
+
+
+def test_state_restore(temp_dir):
+    path = temp_dir / 'example.log'
+    path.write_bytes(b'first line of the file\nsecond line\n')
+    inode = os.stat(path).st_ino
+    state = AgentState(temp_dir / 'state.json')
+    state.acked(path, inode, b'first line of the file\n', 30)
+    state.save(json.dumps({'files': state.files}))
+    state = AgentState(temp_dir / 'state.json')
+    state.load()
+    with path.open('rb') as f:
+        assert state.restore(path, inode, f.fileno()) == 30
+        assert state.restore(path, inode + 1, f.fileno()) is None
+    # the same path and inode, but different content
+    path.write_bytes(b'another file\n' * 3)
+    with path.open('rb') as f:
+        assert state.restore(path, inode, f.fileno()) is None
+    assert state.files == {}
+
+
+def test_state_check_with_server(temp_dir, load_conf, monkeypatch):
+    conf = load_conf('''\
+        server: 127.0.0.1:9999
+        client_token: topsecret
+        scan:
+          - /nonexistent/*.log
+    ''')
+    queries = []
+
+    async def query_lengths(conf, files, selector):
+        queries.append(files)
+        return [1000 if path.endswith('a.log') else None for path, prefix in files]
+
+    monkeypatch.setattr(state_module, 'query_lengths', query_lengths)
+    state = AgentState(None)
+    for name in 'a.log', 'b.log', 'c.log':
+        (temp_dir / name).write_bytes(name.encode() * 1000)
+        state.acked(temp_dir / name, os.stat(temp_dir / name).st_ino, name.encode() * 4, 500)
+    # file replaced by another one
+    (temp_dir / 'c.log').unlink()
+    (temp_dir / 'c.log').write_bytes(b'C.LOG' * 1000)
+    run(state.check_with_server(conf, None))
+    # one query for all the files that still exist
+    assert [len(files) for files in queries] == [2]
+    assert [item['offset'] for item in state.files.values()] == [1000]
+
+
+def test_state_check_with_server_failed(temp_dir, load_conf, monkeypatch):
+    conf = load_conf('''\
+        server: 127.0.0.1:9999
+        client_token: topsecret
+        scan:
+          - /nonexistent/*.log
+    ''')
+
+    async def query_lengths(conf, files, selector):
+        raise ConnectionRefusedError()
+
+    monkeypatch.setattr(state_module, 'query_lengths', query_lengths)
+    path = temp_dir / 'a.log'
+    path.write_bytes(b'a.log' * 1000)
+    inode = os.stat(path).st_ino
+    state = AgentState(None)
+    state.acked(path, inode, b'a.log', 5000)
+    run(state.check_with_server(conf, None))
+    # the file gets handshaked although it has no new data
+    with path.open('rb') as f:
+        assert state.restore(path, inode, f.fileno()) is None
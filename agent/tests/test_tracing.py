@@ -0,0 +1,17 @@
+from logline_agent.tracing import Trace
+
+
+def test_trace_samples_calls():
+    trace = Trace(sample_every=4)
+    sampled = 0
+    for i in range(10):
+        t0 = trace.start('read')
+        if t0 is not None:
+            sampled += 1
+        trace.stop('read', t0)
+    assert sampled == 3
+    (name, calls, seconds), = trace.summary()
+    assert (name, calls) == ('read', 10)
+    assert seconds >= 0
+    text = trace.metrics_text('logline_agent')
+    assert 'logline_agent_trace_calls_total{point="read"} 10\n' in text
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+'''
+Benchmark of the event loop implementations - asyncio vs uvloop (if installed).
+
+Measures, for every available event loop:
+
+- server: throughput of handle_client() - agent connections sending data
+  commands as fast as they are acknowledged to a server in the same process
+- agent: CPU time used by logline-agent (a subprocess using the same event
+  loop) following idle files, after everything was sent to the server
+
+Usage: python3 benchmarks/bench_event_loop.py [--connections N] [--data-size N] [--duration S] [--idle-files N]
+(with logline-agent and logline-server installed, e.g. `make` venv;
+uvloop is optional: pip install uvloop)
+'''
+
+from argparse import ArgumentParser, Namespace
+import asyncio
+from functools import partial
+import hashlib
+import json
+from pathlib import Path
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter, process_time
+
+from logline_server.configuration import Configuration as ServerConfiguration
+from logline_server.loadgen import ProcessSampler
+from logline_server.main import handle_client, recv_command, send_command
+
+
+client_token = 'benchmark'
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('--connections', type=int, default=50, help='agent connections for the server benchmark')
+    p.add_argument('--data-size', type=int, default=2**14, help='payload size of a data command (bytes)')
+    p.add_argument('--duration', type=float, default=5, help='seconds of every measurement')
+    p.add_argument('--idle-files', type=int, default=500, help='files followed by the agent in the idle benchmark')
+    args = p.parse_args()
+    loops = [('asyncio', asyncio.new_event_loop)]
+    try:
+        import uvloop
+        loops.append(('uvloop', uvloop.new_event_loop))
+    except ImportError:
+        print('uvloop is not installed, measuring only asyncio')
+    for name, new_event_loop in loops:
+        with TemporaryDirectory() as temp_dir:
+            temp_dir = Path(temp_dir)
+            loop = new_event_loop()
+            try:
+                result = loop.run_until_complete(bench_server(args, temp_dir))
+                print(
+                    f'server {name:7}: {result["commands"] / result["wall"]:9.0f} commands/s '
+                    f'{result["bytes"] / result["wall"] / 2**20:8.1f} MiB/s '
+                    f'{result["cpu"] / result["commands"] * 1e6:7.1f} us CPU/command')
+                result = loop.run_until_complete(bench_agent_idle(args, temp_dir, name))
+                print(
+                    f'agent  {name:7}: {result["cpu_utilization"] * 100:9.2f} % CPU '
+                    f'following {args.idle_files} idle files')
+            finally:
+                loop.close()
+
+
+def server_conf(temp_dir):
+    args = Namespace(
+        conf=None, log=None, bind=None, dest=str(temp_dir / 'dest'),
+        tls_cert=None, tls_key=None, tls_key_password_file=None,
+        client_token_hash=[hashlib.sha1(client_token.encode()).hexdigest()],
+        storage=None)
+    (temp_dir / 'dest').mkdir(exist_ok=True)
+    conf = ServerConfiguration(args=args)
+    conf.bloom_index_enabled = False
+    conf.time_index_enabled = False
+    return conf
+
+
+async def bench_server(args, temp_dir):
+    conf = server_conf(temp_dir)
+    server = await asyncio.start_server(partial(handle_client, conf), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    data = b'2021-02-22T17:00:00.000000Z INFO request handled in 12 ms\n' * (args.data_size // 58 + 1)
+    data = data[:args.data_size]
+    counts = {'commands': 0, 'bytes': 0}
+    deadline = perf_counter() + args.duration
+
+    async def agent(n):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        send_command(writer, 'logline-agent-v1', {
+            'hostname': 'bench',
+            'path': f'/var/log/bench{n}.log',
+            'prefix': {'length': 0, 'sha1': hashlib.sha1(b'').hexdigest()},
+            'auth': {'client_token': client_token},
+        })
+        command, metadata, _ = await recv_command(reader)
+        assert command == 'ok', (command, metadata)
+        offset = metadata['length']
+        while perf_counter() < deadline:
+            send_command(writer, 'data', {'offset': offset, 'compression': None}, data)
+            await writer.drain()
+            command, metadata, _ = await recv_command(reader)
+            assert command == 'ok', (command, metadata)
+            offset += len(data)
+            counts['commands'] += 1
+            counts['bytes'] += len(data)
+        writer.close()
+
+    async with server:
+        t0, cpu0 = perf_counter(), process_time()
+        await asyncio.gather(*[agent(n) for n in range(args.connections)])
+        return dict(counts, wall=perf_counter() - t0, cpu=process_time() - cpu0)
+
+
+async def bench_agent_idle(args, temp_dir, event_loop):
+    '''
+    Run logline-agent in a subprocess and measure its CPU time once it has sent everything.
+    '''
+    conf = server_conf(temp_dir)
+    server = await asyncio.start_server(partial(handle_client, conf), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    (temp_dir / 'logs').mkdir()
+    for n in range(args.idle_files):
+        (temp_dir / 'logs' / f'idle{n}.log').write_text(f'first line of the idle file number {n}\n')
+    (temp_dir / 'agent.yaml').write_text(json.dumps({
+        'server': f'127.0.0.1:{port}',
+        'client_token': client_token,
+        'scan': [str(temp_dir / 'logs' / '*.log')],
+        'event_loop': event_loop,
+    }))
+    async with server:
+        agent = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', 'from logline_agent import agent_main; agent_main()',
+            '--conf', str(temp_dir / 'agent.yaml'),
+            stderr=asyncio.subprocess.DEVNULL)
+        try:
+            # let the agent connect and send everything
+            await asyncio.sleep(3 + args.idle_files / 500)
+            sampler = ProcessSampler(agent.pid)
+            await asyncio.sleep(args.duration)
+            return sampler.summary()
+        finally:
+            agent.terminate()
+            await agent.wait()
+
+
+if __name__ == '__main__':
+    main()
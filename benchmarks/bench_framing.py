@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+'''
+Microbenchmark of the data command framing - JSON (text) vs binary-v1.
+
+Measures encoding of the data command header on the agent side and parsing
+of the whole command by recv_command() on the server side.
+
+Usage: python3 benchmarks/bench_framing.py [--data-size N] [--count N]
+(with logline-agent and logline-server installed, e.g. `make` venv)
+'''
+
+from argparse import ArgumentParser
+from asyncio import StreamReader, run
+import json
+from time import perf_counter
+from zlib import crc32
+
+from logline_agent.client import encode_data_frame_header
+from logline_server.main import recv_command
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('--data-size', type=int, default=200, help='payload size of a data command (bytes)')
+    p.add_argument('--count', type=int, default=100000)
+    args = p.parse_args()
+    data = b'x' * args.data_size
+    n = args.count
+
+    def encode_json(offset):
+        md_bytes = json.dumps({'offset': offset, 'compression': None}).encode() + b'\n'
+        return 'data {} {}\n'.format(len(md_bytes), len(data)).encode('ascii') + md_bytes
+
+    def encode_binary(offset):
+        return encode_data_frame_header(offset, len(data), None, crc32(data))
+
+    for name, encode in ('json', encode_json), ('binary', encode_binary):
+        t0 = perf_counter()
+        for i in range(n):
+            encode(i)
+        duration = perf_counter() - t0
+        print(f'agent encode  {name:6}: {duration / n * 1e6:6.2f} us/frame')
+
+    for name, encode, binary in ('json', encode_json, False), ('binary', encode_binary, True):
+        stream = b''.join(encode(i) + data for i in range(n))
+        duration = run(decode_all(stream, n, binary))
+        print(f'server decode {name:6}: {duration / n * 1e6:6.2f} us/frame')
+
+
+async def decode_all(stream, n, binary):
+    reader = StreamReader(limit=2**20)
+    reader.feed_data(stream)
+    reader.feed_eof()
+    t0 = perf_counter()
+    for i in range(n):
+        command, metadata, data = await recv_command(reader, binary=binary)
+        assert metadata['offset'] == i
+    return perf_counter() - t0
+
+
+if __name__ == '__main__':
+    main()
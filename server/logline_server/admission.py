@@ -0,0 +1,131 @@
+'''
+Admission control - connection limits and byte rate limits.
+
+Connection limits (global, per client token and per host) are checked when
+an agent sends its header. If there is no free slot, the connection waits
+up to `limits.queue_timeout` seconds for one; after that it gets an `error`
+reply with a `retry_after` hint (in seconds).
+
+Byte rate limits (per client token and per host) are token buckets of the
+uncompressed data written. A connection over the limit is not disconnected,
+the reply to its data command is just delayed - the agent waits for the reply
+before sending more, so this slows it down to the allowed rate.
+'''
+
+from asyncio import Condition, sleep, wait_for, TimeoutError as AsyncTimeoutError
+from logging import getLogger
+from time import monotonic as monotime
+
+
+logger = getLogger(__name__)
+
+
+class AdmissionRejected (Exception):
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    '''
+    Token bucket; the burst size is one second worth of the rate.
+    '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last_time = monotime()
+
+    def consume(self, size):
+        '''
+        Return how long (seconds) to wait before the size can be considered sent.
+        '''
+        now = monotime()
+        self.tokens = min(self.rate, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        self.tokens -= size
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class AdmissionControl:
+
+    def __init__(self, conf):
+        self.max_connections = conf.limits_max_connections
+        self.max_connections_per_token = conf.limits_max_connections_per_token
+        self.max_connections_per_host = conf.limits_max_connections_per_host
+        self.bytes_per_second_per_token = conf.limits_bytes_per_second_per_token
+        self.bytes_per_second_per_host = conf.limits_bytes_per_second_per_host
+        self.queue_timeout = conf.limits_queue_timeout
+        self.retry_after = conf.limits_retry_after
+        self.connections = 0
+        self.token_connections = {} # token hash -> count
+        self.host_connections = {} # hostname -> count
+        self.token_limiters = {} # token hash -> RateLimiter
+        self.host_limiters = {} # hostname -> RateLimiter
+        self.released = Condition()
+
+    def _check(self, token_hash, hostname):
+        '''
+        Return reason why the connection cannot be admitted now, or None.
+        '''
+        if self.max_connections and self.connections >= self.max_connections:
+            return 'Too many connections'
+        if self.max_connections_per_token and self.token_connections.get(token_hash, 0) >= self.max_connections_per_token:
+            return 'Too many connections with this client token'
+        if self.max_connections_per_host and self.host_connections.get(hostname, 0) >= self.max_connections_per_host:
+            return f'Too many connections from host {hostname}'
+        return None
+
+    async def admit(self, token_hash, hostname):
+        '''
+        Wait for a free connection slot; raise AdmissionRejected on timeout.
+        Every successful admit() must be followed by release().
+        '''
+        reason = self._check(token_hash, hostname)
+        if reason and self.queue_timeout:
+            logger.debug('%s - waiting up to %s s for a free slot', reason, self.queue_timeout)
+            async with self.released:
+                try:
+                    await wait_for(
+                        self.released.wait_for(lambda: not self._check(token_hash, hostname)),
+                        self.queue_timeout)
+                except AsyncTimeoutError:
+                    pass
+            reason = self._check(token_hash, hostname)
+        if reason:
+            raise AdmissionRejected(reason, self.retry_after)
+        self.connections += 1
+        self.token_connections[token_hash] = self.token_connections.get(token_hash, 0) + 1
+        self.host_connections[hostname] = self.host_connections.get(hostname, 0) + 1
+
+    async def release(self, token_hash, hostname):
+        self.connections -= 1
+        _decrement(self.token_connections, token_hash)
+        _decrement(self.host_connections, hostname)
+        async with self.released:
+            self.released.notify_all()
+
+    async def throttle(self, token_hash, hostname, size):
+        '''
+        Sleep as long as needed to keep the byte rates within the limits.
+        '''
+        delay = 0
+        if self.bytes_per_second_per_token:
+            if token_hash not in self.token_limiters:
+                self.token_limiters[token_hash] = RateLimiter(self.bytes_per_second_per_token)
+            delay = max(delay, self.token_limiters[token_hash].consume(size))
+        if self.bytes_per_second_per_host:
+            if hostname not in self.host_limiters:
+                self.host_limiters[hostname] = RateLimiter(self.bytes_per_second_per_host)
+            delay = max(delay, self.host_limiters[hostname].consume(size))
+        if delay:
+            logger.debug('Throttling %s for %.3f s', hostname, delay)
+            await sleep(delay)
+        return delay
+
+
+def _decrement(counts, key):
+    counts[key] -= 1
+    if not counts[key]:
+        del counts[key]
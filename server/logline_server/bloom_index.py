@@ -0,0 +1,252 @@
+'''
+Per-segment token bloom filters of the mirrored files.
+
+The mirror file is split into fixed-size segments (by uncompressed offset).
+For every segment there is a bloom filter of the tokens (alphanumeric runs,
+lowercased) that start in that segment or in the first `segment_overlap`
+bytes of the next segment - so that all tokens of a search term occurrence
+starting in a segment are in its filter. The filters are stored in the
+sidecar file `<name>.bloom`:
+
+    header: magic, segment size, filter size, hash count, indexed length
+    filters: one filter of `filter size` bytes per segment
+
+Segments whose content was not (completely) seen by the indexer - data that
+existed before the indexing was enabled, or data lost during a crash - get
+a filter with all bits set, so they are always searched.
+'''
+
+from logging import getLogger
+import re
+import struct
+from zlib import crc32
+
+
+logger = getLogger(__name__)
+
+bloom_suffix = '.bloom'
+
+token_re = re.compile(rb'[A-Za-z0-9]+')
+token_run_re = re.compile(rb'[A-Za-z0-9]*')
+token_chars = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+
+# Tokens starting this many bytes after the segment end are added also to its filter
+segment_overlap = 256
+
+# Longer tokens are hashed just by their prefix (both when indexing and searching)
+max_token_length = 64
+
+header_struct = struct.Struct('<4sIIIQ')
+header_magic = b'LLBF'
+
+
+def tokenize(data):
+    return token_re.findall(data.lower())
+
+
+def token_hashes(token):
+    token = token[:max_token_length]
+    return crc32(token), crc32(token[::-1]) | 1
+
+
+def token_bit_positions(token, filter_bits, hash_count):
+    h1, h2 = token_hashes(token)
+    return [(h1 + i * h2) % filter_bits for i in range(hash_count)]
+
+
+class BloomIndexWriter:
+    '''
+    Maintains the .bloom file while data is being appended to the mirror file.
+    '''
+
+    def __init__(self, path, segment_size=2**20, filter_size=2**14, hash_count=5):
+        self.path = path
+        self.segment_size = segment_size
+        self.filter_size = filter_size
+        self.filter_bits = filter_size * 8
+        self.hash_count = hash_count
+        self.f = None
+        self.indexed_length = 0
+        self.next_offset = 0
+        # unfinished token at the end of the last data chunk and its offset
+        self.carry = b''
+        self.carry_offset = 0
+        self.skip_token_rest = False
+        # the filter of the current (last) segment
+        self.current_segment = None
+        self.current_filter = None
+
+    @classmethod
+    def for_storage(cls, conf, storage):
+        return cls(
+            storage.path.with_name(storage.path.name + bloom_suffix),
+            segment_size=conf.bloom_segment_size,
+            filter_size=conf.bloom_filter_size,
+            hash_count=conf.bloom_hash_count)
+
+    def _header(self):
+        return header_struct.pack(
+            header_magic, self.segment_size, self.filter_size, self.hash_count, self.indexed_length)
+
+    def _filter_position(self, segment):
+        return header_struct.size + segment * self.filter_size
+
+    def open(self, length):
+        try:
+            self.f = self.path.open('rb+')
+        except FileNotFoundError:
+            self.f = self.path.open('wb+')
+        header_bytes = self.f.read(header_struct.size)
+        if len(header_bytes) == header_struct.size:
+            magic, segment_size, filter_size, hash_count, indexed_length = header_struct.unpack(header_bytes)
+            if (magic, segment_size, filter_size, hash_count) != (header_magic, self.segment_size, self.filter_size, self.hash_count):
+                logger.info('Bloom index %s has different parameters, recreating', self.path)
+                indexed_length = 0
+                self.f.truncate(0)
+        else:
+            indexed_length = 0
+            self.f.truncate(0)
+        if indexed_length != length:
+            # Data between indexed_length and length were not indexed -
+            # mark the affected segments as "may contain anything".
+            first = min(indexed_length, length) // self.segment_size
+            for segment in range(first, length // self.segment_size + 1):
+                self.f.seek(self._filter_position(segment))
+                self.f.write(b'\xff' * self.filter_size)
+        self.indexed_length = length
+        self.next_offset = length
+        self.carry_offset = length
+        self.f.seek(0)
+        self.f.write(self._header())
+        self.f.flush()
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def _load_filter(self, segment):
+        self.f.seek(self._filter_position(segment))
+        filter_bytes = self.f.read(self.filter_size)
+        return bytearray(filter_bytes.ljust(self.filter_size, b'\x00'))
+
+    def update(self, offset, data):
+        '''
+        Called with every chunk of data appended to the mirror file at given offset.
+        '''
+        if not data:
+            return
+        self.next_offset, expected_offset = offset + len(data), self.next_offset
+        if offset != expected_offset:
+            # not continuous with the previously indexed data
+            self.carry = b''
+            self.skip_token_rest = False
+        elif self.skip_token_rest:
+            # rest of a long token that was already indexed by its prefix
+            rest_length = token_run_re.match(data).end()
+            data = data[rest_length:]
+            offset += rest_length
+            self.skip_token_rest = not data
+        else:
+            offset = self.carry_offset
+            data = self.carry + data
+        data = data.lower()
+        # the trailing token may continue in the next chunk
+        carry_start = len(data.rstrip(token_chars))
+        end = carry_start
+        if len(data) - carry_start >= max_token_length:
+            # the prefix used for hashing is complete already
+            self.skip_token_rest = True
+            end = carry_start = len(data)
+        first_segment = offset // self.segment_size
+        last_segment = (offset + end) // self.segment_size
+        for segment in range(max(0, first_segment - 1), last_segment + 1):
+            # tokens starting in the segment or in the overlap after it
+            start_pos = max(0, segment * self.segment_size - offset)
+            end_pos = min(end, (segment + 1) * self.segment_size + segment_overlap - offset)
+            if start_pos >= end_pos:
+                continue
+            if start_pos > 0:
+                # skip token that started before this segment
+                start_pos = token_run_re.match(data, start_pos - 1).end() if data[start_pos - 1] in token_chars else start_pos
+            if end_pos < end:
+                # include the whole token crossing the end
+                end_pos = token_run_re.match(data, end_pos).end()
+            tokens = set(token_re.findall(data, start_pos, end_pos))
+            if tokens:
+                self._add_tokens(segment, tokens)
+        self.carry = data[carry_start:]
+        self.carry_offset = offset + carry_start
+        self.indexed_length = self.carry_offset
+        self.f.seek(0)
+        self.f.write(self._header())
+        self.f.flush()
+
+    def invalidate(self, start, end):
+        '''
+        Data between start and end were overwritten - mark the segments as "may contain anything".
+        '''
+        for segment in range(max(0, start // self.segment_size - 1), (end - 1) // self.segment_size + 1):
+            self.f.seek(self._filter_position(segment))
+            self.f.write(b'\xff' * self.filter_size)
+            if segment == self.current_segment:
+                self.current_filter = bytearray(b'\xff' * self.filter_size)
+        self.f.flush()
+
+    def _add_tokens(self, segment, tokens):
+        if segment == self.current_segment:
+            filter_bytes = self.current_filter
+        else:
+            filter_bytes = self._load_filter(segment)
+        filter_bits = self.filter_bits
+        hash_range = range(self.hash_count)
+        for token in tokens:
+            h1, h2 = token_hashes(token)
+            for i in hash_range:
+                bit = (h1 + i * h2) % filter_bits
+                filter_bytes[bit >> 3] |= 1 << (bit & 7)
+        self.f.seek(self._filter_position(segment))
+        self.f.write(filter_bytes)
+        if self.current_segment is None or segment >= self.current_segment:
+            self.current_segment = segment
+            self.current_filter = filter_bytes
+
+
+class BloomIndex:
+    '''
+    Loaded .bloom file, used for searching.
+    '''
+
+    def __init__(self, path):
+        data = path.read_bytes()
+        magic, self.segment_size, self.filter_size, self.hash_count, self.indexed_length = \
+            header_struct.unpack_from(data)
+        if magic != header_magic:
+            raise Exception(f'Not a bloom index file: {path}')
+        self.filter_bits = self.filter_size * 8
+        self.data = data
+        self.segment_count = (len(data) - header_struct.size) // self.filter_size
+
+    def _contains(self, segment, bit_positions):
+        if segment >= self.segment_count:
+            # not indexed at all
+            return True
+        base = header_struct.size + segment * self.filter_size
+        data = self.data
+        return all(data[base + (bit >> 3)] & (1 << (bit & 7)) for bit in bit_positions)
+
+    def candidate_segments(self, term, length):
+        '''
+        Return list of segments in which an occurrence of term can start.
+        '''
+        tokens = tokenize(term)
+        segment_total = length // self.segment_size + 1
+        if not tokens:
+            return list(range(segment_total))
+        positions = [token_bit_positions(t, self.filter_bits, self.hash_count) for t in tokens]
+        if len(term) <= segment_overlap:
+            # all tokens of an occurrence starting in a segment are in its filter
+            return [s for s in range(segment_total) if all(self._contains(s, p) for p in positions)]
+        else:
+            # long term - only its first token is guaranteed to be in the filter
+            return [s for s in range(segment_total) if self._contains(s, positions[0])]
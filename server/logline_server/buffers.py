@@ -0,0 +1,66 @@
+'''
+Accounting of memory used by received data.
+
+asyncio streams do not support reading into preallocated buffers, so instead
+of pooling the buffer objects the server limits their total size: before the
+data of a command are read from the connection, their size must be acquired
+from the global ReceiveBudget, and it is released after the data are written.
+When the budget is exhausted, connections wait (and TCP flow control slows
+the agents down) instead of the server allocating more memory.
+'''
+
+from asyncio import Event
+import os
+import resource
+
+
+class ReceiveBudget:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.peak = 0
+        self.waits = 0
+        self.released = Event()
+
+    def _fits(self, size):
+        # a command larger than the whole budget waits until nothing else is held
+        return self.used + size <= self.max_bytes or self.used == 0
+
+    async def acquire(self, size):
+        '''
+        Wait until size bytes are available.
+        '''
+        if not self._fits(size):
+            self.waits += 1
+            while not self._fits(size):
+                self.released.clear()
+                await self.released.wait()
+        self.charge(size)
+
+    def charge(self, size):
+        '''
+        Account memory without waiting (decompressed data).
+        '''
+        self.used += size
+        self.peak = max(self.peak, self.used)
+
+    def release(self, size):
+        self.used -= size
+        self.released.set()
+
+
+def get_rss():
+    '''
+    Return current resident set size of this process in bytes, or None if not available.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def get_max_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
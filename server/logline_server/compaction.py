@@ -0,0 +1,215 @@
+'''
+Compression of rotated mirror files and retention of old data.
+
+When the agent starts sending a different file for the same path,
+handle_client() renames the old mirror file to `<name>.rotated-<timestamp>`.
+Such files never change again, so they can be recompressed (with higher
+compression level than the live files) into the seekable zst format.
+
+Retention then deletes rotated files (never the live ones) that are too old
+or that make the host directory larger than configured.
+'''
+
+from argparse import ArgumentParser
+from asyncio import gather, get_running_loop, sleep
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from logging import getLogger
+import multiprocessing
+import os
+from time import time
+
+from .storage import SeekableZstdFile, is_sidecar, rename_sidecars, sidecar_suffixes
+from .util import to_thread
+
+
+logger = getLogger(__name__)
+
+compacting_suffix = '.zst.tmp'
+
+
+def compact_main(argv):
+    from .main import setup_logging
+    from .configuration import ToolConfiguration
+    p = ArgumentParser(prog='logline-server compact')
+    p.add_argument('--conf', help='path to configuration file')
+    p.add_argument('--verbose', '-v', action='store_true')
+    p.add_argument('--dest', help='directory with the received logs')
+    p.add_argument('--workers', type=int, help='number of compression worker processes')
+    p.add_argument('--max-age-days', type=float, help='delete rotated files older than this')
+    p.add_argument('--max-bytes-per-host', type=int, help='delete oldest rotated files above this size per host')
+    args = p.parse_args(argv)
+    setup_logging(verbose=args.verbose)
+    conf = ToolConfiguration(args=args)
+    with new_pool(conf) as pool:
+        futures = [
+            pool.submit(compact_file, path, conf.compaction_zst_level)
+            for path in find_compactable_files(conf.destination_directory, conf.compaction_min_age)
+        ]
+        for fut in futures:
+            fut.result()
+    apply_retention(conf)
+
+
+async def run_compaction(conf):
+    '''
+    Background task of the server - periodically compacts rotated files
+    in low priority worker processes and applies retention policies.
+    '''
+    loop = get_running_loop()
+    pool = new_pool(conf)
+    try:
+        while True:
+            try:
+                # walking the destination directory and deleting files must not block the event loop
+                paths = await to_thread(list, find_compactable_files(conf.destination_directory, conf.compaction_min_age))
+                # the pool runs compaction_workers jobs at a time
+                results = await gather(
+                    *[loop.run_in_executor(pool, compact_file, path, conf.compaction_zst_level) for path in paths],
+                    return_exceptions=True)
+                for path, result in zip(paths, results):
+                    if isinstance(result, Exception):
+                        logger.error('Failed to compact %s: %r', path, result)
+                await to_thread(apply_retention, conf)
+            except Exception as e:
+                logger.exception('Compaction failed: %r', e)
+            await sleep(conf.compaction_interval)
+    finally:
+        # do not wait for the running jobs when the server stops, their temporary files are cleaned up later
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def new_pool(conf):
+    # the server process has threads (to_thread), forking it could deadlock the workers
+    return ProcessPoolExecutor(
+        max_workers=conf.compaction_workers,
+        mp_context=multiprocessing.get_context('forkserver'),
+        initializer=_lower_priority)
+
+
+def _lower_priority():
+    os.nice(10)
+
+
+def is_rotated(path):
+    return '.rotated-' in path.name
+
+
+def is_compacting(path):
+    '''
+    Temporary output (or its index) of a compaction job that may be still running.
+    '''
+    return path.name.endswith(compacting_suffix) or path.name.endswith(compacting_suffix + '.idx')
+
+
+def find_compactable_files(destination_directory, min_age):
+    '''
+    Find rotated files that are still stored uncompressed.
+    '''
+    now = time()
+    for host_dir in sorted(destination_directory.iterdir()):
+        if not host_dir.is_dir():
+            continue
+        for path in sorted(host_dir.glob('**/*')):
+            if not is_rotated(path) or not path.is_file():
+                continue
+            if is_compacting(path):
+                if path.stat().st_mtime < now - 86400:
+                    logger.info('Removing stale temporary file: %s', path)
+                    path.unlink()
+                continue
+            if path.name.endswith('.zst') or is_sidecar(path):
+                continue
+            if path.stat().st_mtime > now - min_age:
+                continue
+            yield path
+
+
+def compact_file(path, zst_level=19, frame_size=2**20):
+    '''
+    Compress the rotated file into seekable zst format, verify the result
+    and replace the original file with it.
+    '''
+    tmp_path = path.with_name(path.name + compacting_suffix)
+    dst_path = path.with_name(path.name + '.zst')
+    for p in (tmp_path, tmp_path.with_name(tmp_path.name + '.idx')):
+        if p.exists():
+            p.unlink()
+    src_sha1 = hashlib.sha1()
+    dst = SeekableZstdFile(tmp_path, level=zst_level, frame_size=frame_size)
+    dst.open()
+    try:
+        with path.open('rb') as src:
+            while True:
+                block = src.read(frame_size)
+                if not block:
+                    break
+                src_sha1.update(block)
+                dst.append(block)
+            src_length = src.tell()
+        dst.flush()
+        os.fsync(dst.f.fileno())
+        os.fsync(dst.index_f.fileno())
+        # verify
+        if dst.length != src_length:
+            raise Exception(f'Compacted file {tmp_path} has length {dst.length}, expected {src_length}')
+        dst_sha1 = hashlib.sha1()
+        for offset in range(0, dst.length, frame_size):
+            dst_sha1.update(dst.read_at(offset, frame_size))
+        if dst_sha1.digest() != src_sha1.digest():
+            raise Exception(f'Compacted file {tmp_path} content does not match {path}')
+        compressed_length = dst.compressed_length
+    except BaseException:
+        dst.close()
+        tmp_path.unlink()
+        dst.index_path.unlink()
+        raise
+    dst.close()
+    # keep the original mtime - retention by age depends on it
+    src_stat = path.stat()
+    for p in (tmp_path, dst.index_path):
+        os.utime(p, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    # index first, so that the .zst file never exists without its index
+    dst.index_path.rename(dst_path.with_name(dst_path.name + '.idx'))
+    tmp_path.rename(dst_path)
+    path.unlink()
+    rename_sidecars(path, dst_path)
+    logger.info(
+        'Compacted %s: %d -> %d bytes (%.1fx)',
+        path, src_length, compressed_length, src_length / max(compressed_length, 1))
+    return src_length, compressed_length
+
+
+def apply_retention(conf):
+    max_age_days = conf.retention_max_age_days
+    max_bytes = conf.retention_max_bytes_per_host
+    if max_age_days is None and max_bytes is None:
+        return
+    now = time()
+    for host_dir in sorted(conf.destination_directory.iterdir()):
+        if not host_dir.is_dir():
+            continue
+        files = [(p, p.stat()) for p in host_dir.glob('**/*') if p.is_file()]
+        total_size = sum(st.st_size for p, st in files)
+        # oldest first; only rotated files are ever deleted
+        rotated = sorted(
+            ((p, st) for p, st in files if is_rotated(p) and not is_sidecar(p) and not is_compacting(p)),
+            key=lambda item: item[1].st_mtime)
+        for p, st in rotated:
+            too_old = max_age_days is not None and st.st_mtime < now - max_age_days * 86400
+            too_big = max_bytes is not None and total_size > max_bytes
+            if not too_old and not too_big:
+                continue
+            logger.info('Retention: deleting %s (%s)', p, 'too old' if too_old else 'host over size limit')
+            total_size -= _unlink_with_sidecars(p)
+
+
+def _unlink_with_sidecars(path):
+    deleted_size = 0
+    for p in (path, *(path.with_name(path.name + suffix) for suffix in sidecar_suffixes)):
+        try:
+            deleted_size += p.stat().st_size
+            p.unlink()
+        except FileNotFoundError:
+            pass
+    return deleted_size
@@ -2,6 +2,9 @@ from logging import getLogger
 import os
 from pathlib import Path
 import re
+from tempfile import gettempdir
+
+from .util import event_loops
 
 
 logger = getLogger(__name__)
@@ -21,19 +24,7 @@ class Configuration:
     default_port = 5645
 
     def __init__(self, args):
-        if args.conf:
-            cfg_path = Path(args.conf)
-        elif os.environ.get('CONF_FILE'):
-            cfg_path = Path(os.environ['CONF_FILE'])
-        else:
-            cfg_path = None
-
-        if cfg_path:
-            cfg_dir = cfg_path.parent
-            import yaml
-            cfg = yaml.safe_load(cfg_path.read_text())
-        else:
-            cfg = {}
+        cfg, cfg_dir = load_configuration_file(args)
 
         if args.log:
             self.log_file = Path(args.log)
@@ -42,6 +33,19 @@ class Configuration:
         else:
             self.log_file = None
 
+        # level of messages written to the log file; "info" avoids the cost of debug logging
+        self.log_level = cfg.get('log', {}).get('level', 'debug')
+        if self.log_level not in ('debug', 'info', 'warning', 'error'):
+            raise ConfigurationError(f'Unknown log level: {self.log_level}')
+
+        # on SIGUSR1 the server is profiled for this many seconds, see tracing.py
+        profiler_cfg = cfg.get('profiler') or {}
+        if profiler_cfg.get('directory'):
+            self.profiler_directory = cfg_dir / profiler_cfg['directory']
+        else:
+            self.profiler_directory = Path(gettempdir())
+        self.profiler_duration = profiler_cfg.get('duration', 30)
+
         if args.bind:
             self.bind_host, self.bind_port = parse_address(args.bind)
         elif cfg.get('bind'):
@@ -49,12 +53,7 @@ class Configuration:
         else:
             self.bind_host, self.bind_port = '', self.default_port
 
-        if args.dest:
-            self.destination_directory = Path(args.dest)
-        elif cfg.get('dest'):
-            self.destination_directory = cfg_dir / cfg['dest']
-        else:
-            raise ConfigurationError('Destination directory not configured')
+        self.destination_directory = get_destination_directory(args, cfg, cfg_dir)
 
         if args.tls_cert:
             self.tls_cert_file = args.tls_cert
@@ -90,6 +89,163 @@ class Configuration:
         if not self.client_token_hashes:
             raise ConfigurationError('No client token hashes configured')
 
+        # Storage format of the mirrored files: plain (uncompressed) or zst (seekable zstd)
+        if args.storage:
+            self.storage_format = args.storage
+        elif cfg.get('storage', {}).get('format'):
+            self.storage_format = cfg['storage']['format']
+        else:
+            self.storage_format = 'plain'
+        if self.storage_format not in ('plain', 'zst'):
+            raise ConfigurationError(f'Unknown storage format: {self.storage_format}')
+        self.zst_level = int(cfg.get('storage', {}).get('zst_level', 3))
+        self.zst_frame_size = int(cfg.get('storage', {}).get('zst_frame_size', 2**17)) # in bytes
+        # data buffered for an incomplete zst frame are written after this many seconds,
+        # so that they become visible to query, search and replication
+        self.zst_flush_interval = cfg.get('storage', {}).get('zst_flush_interval', 10)
+        # compare retransmitted data with what is already stored
+        self.verify_overlap = bool(cfg.get('storage', {}).get('verify_overlap', True))
+
+        # "uvloop" (if installed) or the default "asyncio"
+        self.event_loop = cfg.get('event_loop', 'asyncio')
+        if self.event_loop not in event_loops:
+            raise ConfigurationError(f'Unknown event_loop: {self.event_loop}')
+
+        # agent connections without any command for this many seconds are closed;
+        # agents send ping when they have no data to send
+        self.idle_timeout = cfg.get('idle_timeout', 300)
+        # TCP keepalive parameters (idle, interval in seconds, count); None = disabled
+        tcp_keepalive_cfg = cfg.get('tcp_keepalive', {})
+        if tcp_keepalive_cfg is None:
+            self.tcp_keepalive = None
+        else:
+            self.tcp_keepalive = {
+                'idle': int(tcp_keepalive_cfg.get('idle', 60)),
+                'interval': int(tcp_keepalive_cfg.get('interval', 10)),
+                'count': int(tcp_keepalive_cfg.get('count', 6)),
+            }
+
+        load_compaction_configuration(self, args, cfg)
+        load_time_index_configuration(self, cfg)
+        load_bloom_index_configuration(self, cfg)
+
+        # HTTP endpoints /metrics and /status on the agent port; off by default,
+        # because they are not authenticated and list all hosts and log paths
+        self.metrics_enabled = bool((cfg.get('metrics') or {}).get('enabled', False))
+
+        subscriptions_cfg = cfg.get('subscriptions') or {}
+        # buffer of data not yet sent to a live tail subscriber
+        self.subscription_max_buffer_bytes = int(subscriptions_cfg.get('max_buffer_bytes', 2**22))
+        # what to do when the buffer is full: drop (new data) or disconnect
+        self.subscription_overflow = subscriptions_cfg.get('overflow', 'drop')
+
+        limits_cfg = cfg.get('limits') or {}
+        # connection limits; None = unlimited
+        self.limits_max_connections = limits_cfg.get('max_connections')
+        self.limits_max_connections_per_token = limits_cfg.get('max_connections_per_token')
+        self.limits_max_connections_per_host = limits_cfg.get('max_connections_per_host')
+        # rates of the uncompressed data written; None = unlimited
+        self.limits_bytes_per_second_per_token = limits_cfg.get('bytes_per_second_per_token')
+        self.limits_bytes_per_second_per_host = limits_cfg.get('bytes_per_second_per_host')
+        # how long (seconds) a connection over the limit waits for a free slot before rejection
+        self.limits_queue_timeout = limits_cfg.get('queue_timeout', 0)
+        # hint for the rejected agent how long (seconds) to wait before reconnecting
+        self.limits_retry_after = limits_cfg.get('retry_after', 30)
+        # StreamReader limit - maximum length of a command line
+        self.max_line_length = int(limits_cfg.get('max_line_length', 2**16)) # in bytes
+        # maximum size of data in one command, both compressed and decompressed
+        self.max_data_size = int(limits_cfg.get('max_data_size', 2**26)) # in bytes
+        # all connections together hold at most this much received data (approximately)
+        self.receive_budget = int(limits_cfg.get('receive_budget', 2**28)) # in bytes
+
+        replication_cfg = cfg.get('replication') or {}
+        # list of {server, client_token or client_token_file, tls, tls_cert};
+        # the token is read from the file here and the paths are relative to the configuration file
+        self.replication_destinations = []
+        for dest_cfg in replication_cfg.get('destinations') or []:
+            dest_cfg = dict(dest_cfg)
+            if dest_cfg.get('client_token_file'):
+                dest_cfg['client_token'] = (cfg_dir / dest_cfg.pop('client_token_file')).read_text().strip()
+            if not dest_cfg.get('server') or not dest_cfg.get('client_token'):
+                raise ConfigurationError(f'Replication destination needs server and client_token: {dest_cfg.get("server")}')
+            if dest_cfg.get('tls_cert'):
+                dest_cfg['tls_cert'] = cfg_dir / dest_cfg['tls_cert']
+            self.replication_destinations.append(dest_cfg)
+        # gzip, zst or None
+        self.replication_compression = replication_cfg.get('compression', 'gzip')
+        self.replication_batch_size = int(replication_cfg.get('batch_size', 2**20)) # in bytes
+        # number of data commands sent before waiting for the reply
+        self.replication_pipeline_depth = int(replication_cfg.get('pipeline_depth', 4))
+        # connection for a file is closed after this many seconds without new data
+        self.replication_idle_timeout = replication_cfg.get('idle_timeout', 60)
+        self.replication_retry_interval = replication_cfg.get('retry_interval', 10)
+        if self.replication_compression not in ('gzip', 'zst', None):
+            raise ConfigurationError(f'Unknown replication compression: {self.replication_compression}')
+
+
+class ToolConfiguration:
+    '''
+    Configuration for the offline commands working with the destination
+    directory (`logline-server compact`, `logline-server query`...)
+    '''
+
+    def __init__(self, args):
+        cfg, cfg_dir = load_configuration_file(args)
+        self.destination_directory = get_destination_directory(args, cfg, cfg_dir)
+        load_compaction_configuration(self, args, cfg)
+        load_time_index_configuration(self, cfg)
+        load_bloom_index_configuration(self, cfg)
+
+
+def load_configuration_file(args):
+    if args.conf:
+        cfg_path = Path(args.conf)
+    elif os.environ.get('CONF_FILE'):
+        cfg_path = Path(os.environ['CONF_FILE'])
+    else:
+        cfg_path = None
+
+    if cfg_path:
+        import yaml
+        return yaml.safe_load(cfg_path.read_text()), cfg_path.parent
+    else:
+        return {}, None
+
+
+def get_destination_directory(args, cfg, cfg_dir):
+    if args.dest:
+        return Path(args.dest)
+    elif cfg.get('dest'):
+        return cfg_dir / cfg['dest']
+    else:
+        raise ConfigurationError('Destination directory not configured')
+
+
+def load_compaction_configuration(conf, args, cfg):
+    '''
+    Settings for compression of rotated files and their retention.
+    Shared by the server (background compaction) and `logline-server compact`.
+    '''
+    compaction_cfg = cfg.get('compaction') or {}
+    retention_cfg = cfg.get('retention') or {}
+
+    # Interval of the background compaction in the server (seconds); None = disabled
+    conf.compaction_interval = compaction_cfg.get('interval')
+    conf.compaction_workers = int(getattr(args, 'workers', None) or compaction_cfg.get('workers', 1))
+    # Rotated files modified more recently than this (seconds) are left alone
+    conf.compaction_min_age = compaction_cfg.get('min_age', 300)
+    conf.compaction_zst_level = int(compaction_cfg.get('zst_level', 19))
+
+    if getattr(args, 'max_age_days', None) is not None:
+        conf.retention_max_age_days = args.max_age_days
+    else:
+        conf.retention_max_age_days = retention_cfg.get('max_age_days')
+
+    if getattr(args, 'max_bytes_per_host', None) is not None:
+        conf.retention_max_bytes_per_host = args.max_bytes_per_host
+    else:
+        conf.retention_max_bytes_per_host = retention_cfg.get('max_bytes_per_host')
+
 
 def parse_address(s):
     m = re.match(r'^([^:]+):([0-9]+)$', s)
@@ -102,3 +258,18 @@ def parse_address(s):
         return '', int(port)
     raise Exception(f'Unknown address format: {s}')
 
+
+def load_time_index_configuration(conf, cfg):
+    time_index_cfg = cfg.get('time_index') or {}
+    conf.time_index_enabled = bool(time_index_cfg.get('enabled', False))
+    conf.time_index_sample_interval = int(time_index_cfg.get('sample_interval', 2**16)) # in bytes
+    # built-in parser names (iso, syslog, epoch) or "module:function"
+    conf.time_index_parsers = time_index_cfg.get('parsers') or ['iso', 'syslog', 'epoch']
+
+
+def load_bloom_index_configuration(conf, cfg):
+    bloom_cfg = cfg.get('bloom_index') or {}
+    conf.bloom_index_enabled = bool(bloom_cfg.get('enabled', False))
+    conf.bloom_segment_size = int(bloom_cfg.get('segment_size', 2**20)) # in bytes
+    conf.bloom_filter_size = int(bloom_cfg.get('filter_size', 2**14)) # in bytes, per segment
+    conf.bloom_hash_count = int(bloom_cfg.get('hash_count', 5))
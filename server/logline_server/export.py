@@ -0,0 +1,34 @@
+'''
+Export (part of) a mirrored log file - works for both plain and zst storage.
+
+Usage: logline-server export <file> [--offset N] [--length N]
+'''
+
+from argparse import ArgumentParser
+import sys
+
+from .storage import open_for_reading
+
+
+def export_main(argv):
+    p = ArgumentParser(prog='logline-server export')
+    p.add_argument('file', help='path to the mirrored file (plain or .zst)')
+    p.add_argument('--offset', type=int, default=0, help='uncompressed offset to start at')
+    p.add_argument('--length', type=int, help='number of bytes to export (default: until the end)')
+    args = p.parse_args(argv)
+    f = open_for_reading(args.file)
+    try:
+        export_range(f, args.offset, args.length, sys.stdout.buffer)
+    finally:
+        f.close()
+
+
+def export_range(f, offset, length, out, block_size=2**20):
+    end = f.length if length is None else min(f.length, offset + length)
+    while offset < end:
+        data = f.read_at(offset, min(block_size, end - offset))
+        if not data:
+            break
+        out.write(data)
+        offset += len(data)
+    out.flush()
@@ -0,0 +1,52 @@
+'''
+Binary framing of data commands.
+
+When the agent lists `binary-v1` in the `framing` field of its header and the
+server confirms it in the handshake reply, the agent sends data commands as
+a fixed-size binary header followed by the data, instead of a command line
+and JSON metadata:
+
+    type (1 B, = 1 for data), flags, codec, padding,
+    offset (8 B), data length (4 B), CRC32 of the uncompressed data (4 B)
+
+All integers are little-endian. Text commands can still be sent on the same
+connection - they start with a letter, the binary frame type is below 0x20.
+'''
+
+import struct
+
+
+framing_name = 'binary-v1'
+
+frame_header = struct.Struct('<BBBxQII')
+
+frame_type_data = 1
+
+# flags
+flag_crc32 = 1
+
+codec_ids = {None: 0, 'gzip': 1, 'lzma': 2, 'zst': 3}
+codec_names = {v: k for k, v in codec_ids.items()}
+
+
+def is_binary_frame(first_byte):
+    return first_byte[0] < 0x20
+
+
+def encode_data_frame_header(offset, length, compression=None, crc32=None):
+    flags = 0 if crc32 is None else flag_crc32
+    return frame_header.pack(frame_type_data, flags, codec_ids[compression], offset, length, crc32 or 0)
+
+
+def decode_data_frame_header(header_bytes):
+    '''
+    Return (metadata, data length) - metadata in the same form as of the JSON data command.
+    '''
+    frame_type, flags, codec, offset, length, crc32 = frame_header.unpack(header_bytes)
+    if frame_type != frame_type_data or codec not in codec_names:
+        from .main import ProtocolError
+        raise ProtocolError(f'Unsupported binary frame: type {frame_type} codec {codec}')
+    metadata = {'offset': offset, 'compression': codec_names[codec]}
+    if flags & flag_crc32:
+        metadata['crc32'] = crc32
+    return metadata, length
@@ -0,0 +1,324 @@
+'''
+Load generator for benchmarking the Logline Server.
+
+Usage: logline-server loadgen --server HOST:PORT [--hosts N] [--files M] ...
+
+Simulates N hosts x M files - one agent connection per file - speaking the
+logline-agent-v1 protocol directly, without any real log files. Every
+connection sends chunks of generated log lines as fast as the server
+acknowledges them (or at --rate), optionally reconnecting every
+--reconnect-every chunks to simulate churn.
+
+Measured: acknowledged bytes (uncompressed and on the wire), ack latency
+percentiles, handshake latency, errors, and - with --server-pid of a server
+running on the same machine - its CPU time, peak RSS and peak open fd count.
+The report is written as JSON (--report) so that runs of different versions
+can be compared (--compare).
+'''
+
+from argparse import ArgumentParser
+from asyncio import create_task, gather, open_connection, run, sleep, wait_for
+import gzip
+import json
+import lzma
+import os
+from pathlib import Path
+import platform
+import random
+import sys
+from time import monotonic as monotime, time
+
+from .util import to_thread, zst_compress_frame
+
+
+# Number of distinct pre-generated chunks every connection cycles through
+chunk_variants = 16
+
+codecs = ('none', 'gzip', 'lzma', 'zst')
+
+
+def loadgen_main(argv):
+    p = ArgumentParser(prog='logline-server loadgen')
+    p.add_argument('--server', required=True, help='address of the Logline Server (host:port)')
+    p.add_argument('--tls', action='store_true')
+    p.add_argument('--tls-cert', help='path to the file with certificate in PEM format')
+    p.add_argument('--token-file', help='path to the file containing client token')
+    p.add_argument('--hosts', type=int, default=10, help='number of simulated hosts')
+    p.add_argument('--files', type=int, default=5, help='number of simulated files per host')
+    p.add_argument('--chunk-size', type=int, default=2**16, help='uncompressed size of data commands (bytes)')
+    p.add_argument('--compression', choices=codecs, default='gzip')
+    p.add_argument('--rate', type=float, help='chunks per second per file (default: as fast as possible)')
+    p.add_argument('--reconnect-every', type=int, help='reconnect after this many chunks')
+    p.add_argument('--duration', type=float, default=30, help='seconds')
+    p.add_argument('--server-pid', type=int, help='pid of the server process to sample (Linux only)')
+    p.add_argument('--report', help='write JSON report to this file')
+    p.add_argument('--compare', help='JSON report of a previous run to compare with')
+    args = p.parse_args(argv)
+    if args.token_file:
+        client_token = Path(args.token_file).read_text().strip()
+    else:
+        client_token = os.environ['CLIENT_TOKEN']
+    report = run(loadgen(args, client_token))
+    print_report(report, sys.stdout)
+    if args.compare:
+        print_comparison(json.loads(Path(args.compare).read_text()), report, sys.stdout)
+    if args.report:
+        Path(args.report).write_text(json.dumps(report, indent=2) + '\n')
+
+
+def generate_chunks(chunk_size, compression, seed=0):
+    '''
+    Return list of (data, wire data) - chunks of log-like lines and their compressed form.
+    '''
+    rnd = random.Random(seed)
+    chunks = []
+    for i in range(chunk_variants):
+        lines = []
+        size = 0
+        while size < chunk_size:
+            line = '2021-02-22T17:{:02d}:{:02d}.{:06d}Z INFO [worker-{}] request {:08x} {} {} in {} ms\n'.format(
+                rnd.randrange(60), rnd.randrange(60), rnd.randrange(10**6), rnd.randrange(32),
+                rnd.getrandbits(32), rnd.choice(['GET', 'POST', 'PUT']),
+                rnd.choice(['/', '/api/items', '/api/users', '/login', '/static/app.js']),
+                rnd.randrange(1000)).encode()
+            lines.append(line)
+            size += len(line)
+        data = b''.join(lines)[:chunk_size]
+        chunks.append((data, compress(data, compression)))
+    return chunks
+
+
+def compress(data, compression):
+    if compression == 'gzip':
+        return gzip.compress(data)
+    if compression == 'lzma':
+        return lzma.compress(data)
+    if compression == 'zst':
+        return zst_compress_frame(data)
+    return data
+
+
+class Stats:
+
+    def __init__(self):
+        self.bytes_acked = 0
+        self.wire_bytes_acked = 0
+        self.chunks_acked = 0
+        self.ack_latencies = []
+        self.handshake_latencies = []
+        self.connections = 0
+        self.errors = 0
+
+
+async def loadgen(args, client_token):
+    from .configuration import parse_address
+    host, port = parse_address(args.server)
+    if args.tls or args.tls_cert:
+        from ssl import create_default_context, Purpose
+        ssl_context = create_default_context(purpose=Purpose.SERVER_AUTH, cafile=args.tls_cert)
+    else:
+        ssl_context = None
+    chunks = await to_thread(generate_chunks, args.chunk_size, args.compression)
+    run_id = '{:08x}'.format(random.getrandbits(32))
+    stats = Stats()
+    deadline = monotime() + args.duration
+    process_sampler = ProcessSampler(args.server_pid) if args.server_pid else None
+    sampler_task = create_task(process_sampler.run()) if process_sampler else None
+    t0 = monotime()
+    await gather(*[
+        simulate_file(
+            host, port, ssl_context, client_token, args, chunks, stats, deadline,
+            hostname=f'loadgen-{run_id}-host{h}', path=f'/var/log/loadgen/file{f}.log')
+        for h in range(args.hosts)
+        for f in range(args.files)
+    ])
+    duration = monotime() - t0
+    if sampler_task:
+        sampler_task.cancel()
+    report = {
+        'timestamp': time(),
+        'python': platform.python_version(),
+        'parameters': {
+            'server': args.server,
+            'tls': bool(ssl_context),
+            'hosts': args.hosts,
+            'files': args.files,
+            'chunk_size': args.chunk_size,
+            'compression': args.compression,
+            'rate': args.rate,
+            'reconnect_every': args.reconnect_every,
+            'duration': args.duration,
+        },
+        'results': {
+            'duration': duration,
+            'connections': stats.connections,
+            'errors': stats.errors,
+            'chunks_acked': stats.chunks_acked,
+            'bytes_per_second': stats.bytes_acked / duration,
+            'wire_bytes_per_second': stats.wire_bytes_acked / duration,
+            'chunks_per_second': stats.chunks_acked / duration,
+            'ack_latency_ms': percentiles(stats.ack_latencies),
+            'handshake_latency_ms': percentiles(stats.handshake_latencies),
+        },
+    }
+    if process_sampler:
+        report['server_process'] = process_sampler.summary()
+    return report
+
+
+async def simulate_file(host, port, ssl_context, client_token, args, chunks, stats, deadline, hostname, path):
+    from .main import recv_command, send_command, sha1_b64
+    # the file starts with a line unique for the simulated file
+    first_line = f'# logline loadgen {hostname} {path}\n'.encode()
+    prefix = first_line[:50]
+    while monotime() < deadline:
+        writer = None
+        try:
+            t0 = monotime()
+            reader, writer = await open_connection(host, port, ssl=ssl_context)
+            stats.connections += 1
+            send_command(writer, 'logline-agent-v1', {
+                'hostname': hostname,
+                'path': path,
+                'prefix': {'length': len(prefix), 'sha1': sha1_b64(prefix)},
+                'auth': {'client_token': client_token},
+            })
+            await writer.drain()
+            command, metadata, _ = await wait_for(recv_command(reader), 60)
+            if command != 'ok':
+                raise Exception(f'Handshake failed: {command} {metadata}')
+            stats.handshake_latencies.append(monotime() - t0)
+            offset = metadata['length']
+            if offset == 0:
+                await send_chunk(reader, writer, 0, first_line, first_line, None, stats)
+                offset = len(first_line)
+            sent = 0
+            while monotime() < deadline:
+                if args.reconnect_every and sent >= args.reconnect_every:
+                    break
+                t_next = monotime() + 1 / args.rate if args.rate else None
+                data, wire_data = chunks[(offset // args.chunk_size) % len(chunks)]
+                compression = None if args.compression == 'none' else args.compression
+                await send_chunk(reader, writer, offset, data, wire_data, compression, stats)
+                offset += len(data)
+                sent += 1
+                if t_next:
+                    await sleep(max(0, t_next - monotime()))
+        except Exception as e:
+            stats.errors += 1
+            print(f'{hostname} {path}: {e!r}', file=sys.stderr)
+            await sleep(1)
+        finally:
+            if writer:
+                writer.close()
+
+
+async def send_chunk(reader, writer, offset, data, wire_data, compression, stats):
+    from .main import recv_command, send_command
+    t0 = monotime()
+    send_command(writer, 'data', {'offset': offset, 'compression': compression}, wire_data)
+    await writer.drain()
+    command, metadata, _ = await wait_for(recv_command(reader), 60)
+    if command != 'ok':
+        raise Exception(f'Error reply: {command} {metadata}')
+    stats.ack_latencies.append(monotime() - t0)
+    stats.chunks_acked += 1
+    stats.bytes_acked += len(data)
+    stats.wire_bytes_acked += len(wire_data)
+
+
+def percentiles(values):
+    '''
+    Return dict of percentiles of the values (seconds) in milliseconds.
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    result = {}
+    for name, q in ('p50', .5), ('p90', .9), ('p99', .99), ('p999', .999):
+        result[name] = values[min(len(values) - 1, int(q * len(values)))] * 1000
+    result['max'] = values[-1] * 1000
+    return result
+
+
+class ProcessSampler:
+    '''
+    Samples CPU time, RSS and open fd count of a process from /proc.
+    '''
+
+    interval = 0.5
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.first_cpu = self.last_cpu = self.cpu_seconds()
+        self.t0 = self.t1 = monotime()
+        self.max_rss = 0
+        self.max_fds = 0
+
+    def cpu_seconds(self):
+        stat = Path(f'/proc/{self.pid}/stat').read_text()
+        # fields after the command name, which may contain spaces
+        fields = stat[stat.rindex(')') + 2:].split()
+        utime, stime = int(fields[11]), int(fields[12])
+        return (utime + stime) / self.clock_ticks
+
+    def sample(self):
+        self.last_cpu = self.cpu_seconds()
+        self.t1 = monotime()
+        for line in Path(f'/proc/{self.pid}/status').read_text().splitlines():
+            if line.startswith('VmRSS:'):
+                self.max_rss = max(self.max_rss, int(line.split()[1]) * 1024)
+        self.max_fds = max(self.max_fds, len(os.listdir(f'/proc/{self.pid}/fd')))
+
+    async def run(self):
+        while True:
+            self.sample()
+            await sleep(self.interval)
+
+    def summary(self):
+        self.sample()
+        cpu = self.last_cpu - self.first_cpu
+        return {
+            'cpu_seconds': cpu,
+            'cpu_utilization': cpu / max(self.t1 - self.t0, 1e-3),
+            'max_rss_bytes': self.max_rss,
+            'max_open_fds': self.max_fds,
+        }
+
+
+def flatten(report):
+    items = {}
+    for section in 'results', 'server_process':
+        for key, value in (report.get(section) or {}).items():
+            if isinstance(value, dict):
+                for k, v in value.items():
+                    items[f'{key}.{k}'] = v
+            else:
+                items[key] = value
+    return items
+
+
+def print_report(report, out):
+    params = report['parameters']
+    print('Parameters: ' + ' '.join(f'{k}={v}' for k, v in params.items()), file=out)
+    for key, value in flatten(report).items():
+        print(f'  {key:32} {value:14.3f}' if isinstance(value, float) else f'  {key:32} {value:>14}', file=out)
+
+
+def print_comparison(old_report, new_report, out):
+    old_items = flatten(old_report)
+    if old_report['parameters'] != new_report['parameters']:
+        print('Warning: the compared runs have different parameters', file=out)
+    print(f'  {"":32} {"previous":>14} {"current":>14} {"change":>8}', file=out)
+    for key, value in flatten(new_report).items():
+        old_value = old_items.get(key)
+        if isinstance(value, (int, float)) and isinstance(old_value, (int, float)) and old_value:
+            change = f'{(value - old_value) / old_value * 100:+.1f}%'
+        else:
+            change = ''
+        print(f'  {key:32} {_fmt(old_value):>14} {_fmt(value):>14} {change:>8}', file=out)
+
+
+def _fmt(value):
+    return f'{value:.3f}' if isinstance(value, float) else str(value)
@@ -1,24 +1,59 @@
 from argparse import ArgumentParser
-from asyncio import run, sleep, start_server
+from asyncio import IncompleteReadError, create_task, get_running_loop, run, sleep, start_server, wait_for, TimeoutError as AsyncTimeoutError
 from base64 import b64encode
 from datetime import datetime
 from functools import partial
-import gzip
 import hashlib
-from io import SEEK_END
 import json
 from logging import getLogger
-import lzma
 from reprlib import repr as smart_repr
-
+import signal
+import sys
+from time import monotonic as monotime
+from zlib import crc32
+
+from .admission import AdmissionControl, AdmissionRejected
+from .bloom_index import BloomIndexWriter
+from .buffers import ReceiveBudget
 from .configuration import Configuration
-from .util import to_thread, decompress_zst
+from .framing import decode_data_frame_header, frame_header, framing_name, is_binary_frame
+from .metrics import Metrics
+from .prefix_cache import PrefixCache
+from .storage import open_destination
+from .subscriptions import SubscriptionHub, handle_subscriber
+from .time_index import TimeIndexWriter
+from .tracing import Profiler, trace
+from .util import to_thread, decompress_gzip, decompress_lzma, decompress_zst, install_event_loop, set_tcp_keepalive
+from .verification import hash_ranges
 
 
 logger = getLogger(__name__)
 
+max_metadata_size = 2**20
+
+# Maximum number of files in one logline-lengths-v1 query
+max_length_queries = 1000
+
 
 def server_main():
+    if sys.argv[1:2] == ['export']:
+        from .export import export_main
+        return export_main(sys.argv[2:])
+    if sys.argv[1:2] == ['compact']:
+        from .compaction import compact_main
+        return compact_main(sys.argv[2:])
+    if sys.argv[1:2] == ['query']:
+        from .query import query_main
+        return query_main(sys.argv[2:])
+    if sys.argv[1:2] == ['search']:
+        from .search import search_main
+        return search_main(sys.argv[2:])
+    if sys.argv[1:2] == ['tail']:
+        from .subscriptions import tail_main
+        return tail_main(sys.argv[2:])
+    if sys.argv[1:2] == ['loadgen']:
+        from .loadgen import loadgen_main
+        return loadgen_main(sys.argv[2:])
     p = ArgumentParser()
     p.add_argument('--conf', help='path to configuration file')
     p.add_argument('--log', help='path to log file')
@@ -29,10 +64,12 @@ def server_main():
     p.add_argument('--tls-key', help='path to the file with key in PEM format')
     p.add_argument('--tls-key-password-file', help='path to the file with key password in plaintext')
     p.add_argument('--client-token-hash', action='append')
+    p.add_argument('--storage', choices=['plain', 'zst'], help='storage format of the mirrored files')
     args = p.parse_args()
     setup_logging(verbose=args.verbose)
     conf = Configuration(args=args)
-    setup_log_file(conf.log_file)
+    setup_log_file(conf.log_file, conf.log_level)
+    install_event_loop(conf.event_loop)
     run(async_main(conf))
 
 
@@ -52,19 +89,20 @@ def setup_logging(verbose):
     stderr_log_handler = h
 
 
-def setup_log_file(log_file_path):
+def setup_log_file(log_file_path, level='debug'):
     from logging import DEBUG, INFO, ERROR, getLogger, Formatter
     from logging.handlers import WatchedFileHandler
-    if not log_file_path:
-        return
-    h = WatchedFileHandler(str(log_file_path))
-    h.setFormatter(Formatter(log_format))
-    h.setLevel(DEBUG)
-    getLogger('').addHandler(h)
-    if stderr_log_handler:
-        # decrease stderr handler level since we are logging into file instead
-        if stderr_log_handler.level == INFO:
-            stderr_log_handler.setLevel(ERROR)
+    if log_file_path:
+        h = WatchedFileHandler(str(log_file_path))
+        h.setFormatter(Formatter(log_format))
+        h.setLevel(level.upper())
+        getLogger('').addHandler(h)
+        if stderr_log_handler:
+            # decrease stderr handler level since we are logging into file instead
+            if stderr_log_handler.level == INFO:
+                stderr_log_handler.setLevel(ERROR)
+    # when no handler wants debug messages, logger.debug() returns immediately
+    getLogger('').setLevel(min((h.level for h in getLogger('').handlers), default=DEBUG))
 
 
 async def async_main(conf):
@@ -78,35 +116,93 @@ async def async_main(conf):
             password=conf.tls_password)
     else:
         ssl_context = None
+    subscriptions = SubscriptionHub()
+    metrics = Metrics()
+    background_tasks = [create_task(metrics.run_sampler())]
+    profiler = Profiler('logline-server', conf.profiler_directory, conf.profiler_duration)
+    get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.start)
+    admission = AdmissionControl(conf)
+    replication = None
+    if conf.replication_destinations:
+        from .replication import Replication
+        replication = Replication(conf)
+        replication.start()
+    receive_budget = ReceiveBudget(conf.receive_budget)
+    metrics.receive_budget = receive_budget
     server = await start_server(
-        partial(handle_client, conf),
+        partial(
+            handle_client, conf,
+            subscriptions=subscriptions, metrics=metrics, admission=admission, replication=replication,
+            prefix_cache=PrefixCache(), receive_budget=receive_budget),
         conf.bind_host, conf.bind_port,
-        ssl=ssl_context)
+        ssl=ssl_context,
+        limit=conf.max_line_length)
     logger.info('Listening on %s', ' '.join(str(s.getsockname()) for s in server.sockets))
-    async with server:
-        await server.serve_forever()
-
-
-async def handle_client(conf, reader, writer):
+    if conf.compaction_interval:
+        from .compaction import run_compaction
+        background_tasks.append(create_task(run_compaction(conf)))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in background_tasks:
+            task.cancel()
+
+
+async def handle_client(conf, reader, writer, subscriptions=None, metrics=None, admission=None, replication=None, prefix_cache=None, receive_budget=None):
+    if metrics is None:
+        metrics = Metrics()
+    if admission is None:
+        admission = AdmissionControl(conf)
+    if prefix_cache is None:
+        prefix_cache = PrefixCache()
+    if receive_budget is None:
+        receive_budget = ReceiveBudget(conf.receive_budget)
+    held_bytes = 0
     f = None
+    time_index = None
+    bloom_index = None
+    header = None
     try:
         addr = writer.get_extra_info('peername')
         logger.info('New client has connected: %s', addr)
+        metrics.connection_opened()
+        if conf.tcp_keepalive:
+            set_tcp_keepalive(writer.get_extra_info('socket'), **conf.tcp_keepalive)
         try:
-            command, metadata, data = await recv_command(reader, first=True)
+            command, metadata, data = await wait_for(recv_command(reader, first=True), conf.idle_timeout)
         except ReceivedHTTPRequestError as e:
-            logger.info('Received like HTTP request')
-            await send_http_response(writer)
+            logger.info('Received like HTTP request: %s', smart_repr(e.request_line))
+            if conf.metrics_enabled:
+                await handle_http_request(e.request_line, reader, writer, metrics, subscriptions)
+            else:
+                await send_http_response(writer)
+            return
+        if command == 'logline-subscribe-v1' and subscriptions and not data:
+            check_client_auth(conf, metadata.get('auth'))
+            await handle_subscriber(conf, subscriptions, metadata, reader, writer)
+            return
+        if command == 'logline-lengths-v1' and not data:
+            token_hash = check_client_auth(conf, metadata.get('auth'))
+            await admission.admit(token_hash, metadata['hostname'])
+            try:
+                # opens and hashes up to max_length_queries files
+                lengths = await to_thread(query_lengths, conf, prefix_cache, metadata['hostname'], metadata['files'])
+            finally:
+                await admission.release(token_hash, metadata['hostname'])
+            await send_reply(writer, 'ok', {'lengths': lengths})
             return
         if command != 'logline-agent-v1' or data:
             raise Exception(f"Protocol error - received {smart_repr(command)} as first command")
-        header = metadata
-        assert header['hostname']
-        assert header['path']
-        assert header['prefix']
-        assert header['auth']
+        assert metadata['hostname']
+        assert metadata['path']
+        assert metadata['prefix']
+        assert metadata['auth']
 
-        check_client_auth(conf, header.get('auth'))
+        token_hash = check_client_auth(conf, metadata.get('auth'))
+        await admission.admit(token_hash, metadata['hostname'])
+        header = metadata
+        metrics.handshake(header['hostname'])
 
         dst_path = build_destination_path(
             conf.destination_directory, header['hostname'], header['path'])
@@ -118,69 +214,215 @@ async def handle_client(conf, reader, writer):
             logger.debug('Creating directory: %s', dst_path.parent)
             dst_path.parent.mkdir()
 
-        try:
-            f = dst_path.open('rb+')
-        except FileNotFoundError:
-            f = None
-            logger.debug('File does not exist yet: %s', dst_path)
-        else:
-            assert f.tell() == 0
-            f_prefix = f.read(header['prefix']['length'])
-            if f_prefix and sha1_b64(f_prefix) == header['prefix']['sha1']:
+        f = open_destination(conf, dst_path)
+        if f.exists():
+            # loads the zst index
+            await to_thread(f.open)
+            f_prefix_hash = prefix_cache.prefix_hash(f, header['prefix']['length'])
+            if f_prefix_hash and f_prefix_hash == header['prefix']['sha1']:
                 # it's the correct file :)
-                logger.info('File has the correct prefix: %s', dst_path)
+                logger.info('File has the correct prefix: %s', f.path)
             else:
                 # need to create new file
-                logger.info('File has different prefix, rotating: %s', dst_path)
+                logger.info('File has different prefix, rotating: %s', f.path)
                 f.close()
-                f = None
                 iso_dt = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-                dst_path.rename(dst_path.with_name(dst_path.name + f".rotated-{iso_dt}"))
+                rotated_path = f.rotate(f".rotated-{iso_dt}")
+                if replication:
+                    replication.rotated(f.path, rotated_path)
+                prefix_cache.invalidate(f.path)
+                f = open_destination(conf, dst_path)
+                await to_thread(f.open)
+        else:
+            logger.debug('File does not exist yet: %s', f.path)
+            f.open()
+
+        f_length = f.length
 
-        if not f:
-            logger.info('Creating new file: %s', dst_path)
-            f = dst_path.open('wb+')
+        if conf.time_index_enabled:
+            time_index = TimeIndexWriter.for_storage(conf, f)
+            time_index.open(f_length)
 
-        f.seek(0, SEEK_END)
-        f_length = f.tell()
+        if conf.bloom_index_enabled:
+            bloom_index = BloomIndexWriter.for_storage(conf, f)
+            bloom_index.open(f_length)
 
-        await send_reply(writer, 'ok', {'length': f_length})
+        reply = {'length': f_length}
+        binary_framing = framing_name in (header.get('framing') or [])
+        if binary_framing:
+            reply['framing'] = framing_name
+        await send_reply(writer, 'ok', reply)
 
         while True:
-            command, metadata, data = await recv_command(reader)
+            # data of the previous command were written already
+            receive_budget.release(held_bytes)
+            held_bytes = 0
+            # the idle timeout applies only to the reads - waiting for the receive budget is back-pressure
+            command, metadata, data = await recv_command(
+                reader, binary=binary_framing, max_data_size=conf.max_data_size, budget=receive_budget,
+                timeout=conf.idle_timeout)
+            if data is not None:
+                held_bytes = len(data)
+            if command == 'ping':
+                if await flush_old_buffer(conf, f) and replication:
+                    replication.notify(header['hostname'], header['path'], f.path, header['prefix']['length'])
+                await send_reply(writer, 'ok', None)
+                continue
+            if command == 'bye':
+                logger.info('Client said goodbye')
+                await send_reply(writer, 'ok', None)
+                return
+            if command == 'hashes':
+                hashes = await to_thread(hash_ranges, f, metadata['ranges'])
+                await send_reply(writer, 'ok', {'hashes': hashes})
+                continue
             if command != 'data':
                 raise Exception(f"Protocol error - expected 'data', received {smart_repr(command)}")
             assert isinstance(data, bytes)
+            zst_frame = None
+            received_size = len(data)
+            t0 = monotime()
+            t_decompress = trace.start('decompress')
             if metadata.get('compression') == 'gzip':
-                data = await to_thread(gzip.decompress, data)
+                data = await to_thread(decompress_gzip, data, conf.max_data_size)
             elif metadata.get('compression') == 'lzma':
-                data = await to_thread(lzma.decompress, data)
+                data = await to_thread(decompress_lzma, data, conf.max_data_size)
             elif metadata.get('compression') == 'zst':
-                data = await decompress_zst(data)
+                zst_frame = data
+                data = await decompress_zst(data, conf.max_data_size)
             elif metadata.get('compression') != None:
                 raise Exception(f"Unsupported compression method: {metadata['compression']}")
-            assert f.tell() == metadata['offset']
-            logger.debug('Writing %d bytes at offset %s to file %s (fd: %s)', len(data), f.tell(), dst_path, f.fileno())
-            f.write(data)
-            f.flush()
+            trace.stop('decompress', t_decompress)
+            if metadata.get('compression'):
+                receive_budget.charge(len(data))
+                held_bytes += len(data)
+            t_checksum = trace.start('checksum')
+            if metadata.get('crc32') is not None and crc32(data) != metadata['crc32']:
+                raise ProtocolError(f"Checksum mismatch of data at offset {metadata['offset']}")
+            trace.stop('checksum', t_checksum)
+            t1 = monotime()
+            metrics.data_received(metadata.get('compression'), received_size, len(data), t1 - t0)
+            offset = metadata['offset']
+            if offset > f.length:
+                # some data are missing - tell the agent where to continue
+                logger.info('Received data at offset %s, but file %s has only %s bytes', offset, f.path, f.length)
+                await send_reply(writer, 'resync', {'length': f.length})
+                continue
+            if offset < f.length:
+                # retransmitted data - skip what we already have
+                overlap = min(len(data), f.length - offset)
+                repair = metadata.get('repair')
+                if (conf.verify_overlap or repair) and f.read_at(offset, overlap) != data[:overlap]:
+                    if not repair:
+                        logger.warning('Retransmitted data at offset %s differ from file %s', offset, f.path)
+                        await send_reply(writer, 'error', {'error': f'Data at offset {offset} differ from the stored data'})
+                        return
+                    if not hasattr(f, 'write_at'):
+                        # not fatal - the agent would reconnect and find the same difference forever
+                        logger.warning(
+                            'Cannot repair %d bytes at offset %s of file %s - not supported for %s storage',
+                            overlap, offset, f.path, conf.storage_format)
+                        await send_reply(writer, 'ok', {'repaired': False})
+                        continue
+                    logger.info('Repairing %d bytes at offset %s of file %s', overlap, offset, f.path)
+                    await f.write_at(offset, data[:overlap])
+                    prefix_cache.invalidate(f.path)
+                    if bloom_index:
+                        bloom_index.invalidate(offset, offset + overlap)
+                logger.debug('Skipping %d already stored bytes at offset %s of file %s', overlap, offset, f.path)
+                data = data[overlap:]
+                offset += overlap
+                zst_frame = None
+            if data:
+                logger.debug('Writing %d bytes at offset %s to file %s', len(data), f.length, f.path)
+                t_write = trace.start('write')
+                await f.write(data, zst_frame=zst_frame)
+                await flush_old_buffer(conf, f)
+                trace.stop('write', t_write)
+                metrics.data_written(header['hostname'], header['path'], len(data), monotime() - t1)
+                t_index = trace.start('index')
+                if time_index:
+                    time_index.update(offset, data)
+                if bloom_index:
+                    await to_thread(bloom_index.update, offset, data)
+                trace.stop('index', t_index)
+                if subscriptions:
+                    subscriptions.publish(header['hostname'], header['path'], offset, data)
+                if replication:
+                    replication.notify(header['hostname'], header['path'], f.path, header['prefix']['length'])
+            throttled = await admission.throttle(token_hash, header['hostname'], len(data))
+            if throttled:
+                metrics.throttled(throttled)
             await send_reply(writer, 'ok', None)
 
     except ConnectionClosed:
         logger.info('Client closed connection')
+    except IncompleteReadError:
+        logger.info('Client closed connection in the middle of a command')
+    except AsyncTimeoutError:
+        logger.info('Closing connection idle for more than %s s', conf.idle_timeout)
+    except AdmissionRejected as e:
+        logger.info('Connection rejected: %s', e)
+        metrics.rejected()
+        await send_reply(writer, 'error', {'error': str(e), 'retry_after': e.retry_after})
     except Exception as e:
         logger.exception('Failed to handle client: %r', e)
     finally:
         logger.info('Closing connection')
         writer.close()
+        receive_budget.release(held_bytes)
+        if header:
+            metrics.connection_closed(header['hostname'], header['path'])
+            await admission.release(token_hash, header['hostname'])
         if f:
-            f.close()
+            buffered = f.buffered_since is not None
+            try:
+                # writes the buffered data
+                await to_thread(f.close)
+            except Exception as e:
+                logger.exception('Failed to close %s: %r', f.path, e)
+            else:
+                if buffered and replication:
+                    replication.notify(header['hostname'], header['path'], f.path, header['prefix']['length'])
+        if time_index:
+            time_index.close()
+        if bloom_index:
+            bloom_index.close()
 
 
-async def send_http_response(writer):
-    writer.write(b'HTTP/1.0 404 Not Found\r\n')
-    writer.write(b'Content-Type: text/plain\r\n')
+async def handle_http_request(request_line, reader, writer, metrics, subscriptions=None):
+    '''
+    Serve the metrics endpoints (if enabled); the agent port is not a HTTP service otherwise.
+    '''
+    try:
+        method, target, _ = request_line.decode('ascii').split()
+    except ValueError:
+        method, target = None, None
+    # skip request headers
+    for _ in range(100):
+        line = await reader.readline()
+        if not line.strip():
+            break
+    subscriber_count = len(subscriptions.subscribers) if subscriptions else 0
+    path = target.split('?')[0] if target else None
+    if method == 'GET' and path == '/metrics':
+        await send_http_response(
+            writer, '200 OK', 'text/plain; version=0.0.4',
+            metrics.prometheus_text(subscriber_count=subscriber_count).encode())
+    elif method == 'GET' and path == '/status':
+        await send_http_response(
+            writer, '200 OK', 'application/json',
+            metrics.status_json(subscriber_count=subscriber_count).encode())
+    else:
+        await send_http_response(writer)
+
+
+async def send_http_response(writer, status='404 Not Found', content_type='text/plain', body=b'This is not a HTTP service.\n'):
+    writer.write(f'HTTP/1.0 {status}\r\n'.encode())
+    writer.write(f'Content-Type: {content_type}\r\n'.encode())
+    writer.write(f'Content-Length: {len(body)}\r\n'.encode())
     writer.write(b'\r\n')
-    writer.write(b'This is not a HTTP service.\n')
+    writer.write(body)
     await writer.drain()
 
 
@@ -231,6 +473,41 @@ def build_destination_path(destination_directory, hostname, path):
     return dst_path
 
 
+async def flush_old_buffer(conf, f):
+    '''
+    Write data buffered by the storage object (an incomplete zst frame) if they wait too long.
+    Return True if something was written.
+    '''
+    if f.buffered_since is not None and monotime() - f.buffered_since > conf.zst_flush_interval:
+        await to_thread(f.flush)
+        return True
+    return False
+
+
+def query_lengths(conf, prefix_cache, hostname, files):
+    '''
+    Return lengths of the mirror files of the agent files (dicts with path and prefix),
+    None for the files the server does not have with the same prefix.
+    '''
+    if len(files) > max_length_queries:
+        raise ProtocolError(f'Too many files in one query: {len(files)}')
+    lengths = []
+    for item in files:
+        f = open_destination(conf, build_destination_path(conf.destination_directory, hostname, item['path']))
+        if not f.exists():
+            lengths.append(None)
+            continue
+        f.open(readonly=True)
+        try:
+            if prefix_cache.prefix_hash(f, item['prefix']['length']) == item['prefix']['sha1']:
+                lengths.append(f.length)
+            else:
+                lengths.append(None)
+        finally:
+            f.close()
+    return lengths
+
+
 def check_client_auth(conf, header_auth):
     if not header_auth:
         raise Exception('No auth info received in header')
@@ -238,7 +515,7 @@ def check_client_auth(conf, header_auth):
         ct_bytes = header_auth['client_token'].encode('utf-8')
         if sha1_hex(ct_bytes) in conf.client_token_hashes:
             logger.debug('Client token verified with SHA1 hash %s', sha1_hex(ct_bytes))
-            return
+            return sha1_hex(ct_bytes)
         raise Exception(f'Unknown client token; hash: {sha1_hex(ct_bytes)}')
     raise Exception(f'Client token was not received in header')
 
@@ -252,15 +529,36 @@ class ProtocolError (Exception):
 
 
 class ReceivedHTTPRequestError (ProtocolError):
-    pass
+
+    def __init__(self, message, request_line=None):
+        super().__init__(message)
+        self.request_line = request_line
 
 
-async def recv_command(reader, first=False):
-    line = await reader.readline()
+async def recv_command(reader, first=False, binary=False, max_data_size=None, budget=None, timeout=None):
+    '''
+    Receive a command; with budget, the size of its data is acquired from it
+    and the caller must release it. With timeout, every read from the reader
+    must finish in timeout seconds.
+    '''
+    if binary:
+        # binary data frame or a text command
+        first_byte = await with_timeout(reader.read(1), timeout)
+        if not first_byte:
+            raise ConnectionClosed()
+        if is_binary_frame(first_byte):
+            header_bytes = first_byte + await with_timeout(reader.readexactly(frame_header.size - 1), timeout)
+            metadata, data_size = decode_data_frame_header(header_bytes)
+            data = await recv_data(reader, data_size, max_data_size, budget, timeout)
+            logger.debug('Received binary data %r + %d B data', metadata, len(data))
+            return 'data', metadata, data
+        line = first_byte + await with_timeout(reader.readline(), timeout)
+    else:
+        line = await with_timeout(reader.readline(), timeout)
     if not line:
         raise ConnectionClosed()
     if first and b'HTTP/' in line:
-        raise ReceivedHTTPRequestError(f'Invalid command line format: {smart_repr(line)}')
+        raise ReceivedHTTPRequestError(f'Invalid command line format: {smart_repr(line)}', line)
     try:
         parts = line.decode('ascii').split()
     except UnicodeDecodeError:
@@ -282,14 +580,16 @@ async def recv_command(reader, first=False):
         data_size = int(data_size)
     else:
         raise ProtocolError(f"Failed to parse command line: {smart_repr(line)}")
-    metadata_bytes = await reader.readexactly(metadata_size)
+    if metadata_size > max_metadata_size:
+        raise ProtocolError(f'Metadata too large: {metadata_size} bytes')
+    metadata_bytes = await with_timeout(reader.readexactly(metadata_size), timeout)
     metadata = json.loads(metadata_bytes)
     if data_size is None:
         data = None
     elif data_size == 0:
         data = b''
     else:
-        data = await reader.readexactly(data_size)
+        data = await recv_data(reader, data_size, max_data_size, budget, timeout)
     if data is None:
         logger.debug('Received %s %r', command, metadata)
     else:
@@ -297,6 +597,25 @@ async def recv_command(reader, first=False):
     return command, metadata, data
 
 
+async def recv_data(reader, data_size, max_data_size, budget, timeout=None):
+    if max_data_size is not None and data_size > max_data_size:
+        raise ProtocolError(f'Data too large: {data_size} bytes')
+    if budget is None:
+        return await with_timeout(reader.readexactly(data_size), timeout)
+    await budget.acquire(data_size)
+    try:
+        return await with_timeout(reader.readexactly(data_size), timeout)
+    except BaseException:
+        budget.release(data_size)
+        raise
+
+
+async def with_timeout(aw, timeout):
+    if timeout is None:
+        return await aw
+    return await wait_for(aw, timeout)
+
+
 async def send_reply(writer, status, payload):
     assert isinstance(status, str)
     if payload is None:
@@ -310,6 +629,20 @@ async def send_reply(writer, status, payload):
     await writer.drain()
 
 
+def send_command(writer, command, metadata, data=None):
+    '''
+    Write a command (with optional data) without waiting for drain.
+    '''
+    metadata_bytes = json.dumps(metadata).encode('utf-8')
+    if data is None:
+        writer.write(f'{command} {len(metadata_bytes)}\n'.encode('ascii'))
+        writer.write(metadata_bytes)
+    else:
+        writer.write(f'{command} {len(metadata_bytes)} {len(data)}\n'.encode('ascii'))
+        writer.write(metadata_bytes)
+        writer.write(data)
+
+
 def sha1_b64(data):
     return b64encode(hashlib.sha1(data).digest()).decode('ascii')
 
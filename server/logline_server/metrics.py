@@ -0,0 +1,227 @@
+'''
+Server metrics, exported on the agent port via HTTP:
+
+- GET /metrics - Prometheus text format
+- GET /status - JSON summary (with rates over the last minute)
+'''
+
+from asyncio import sleep
+from bisect import bisect_left
+from collections import deque
+import json
+from time import monotonic as monotime, time
+
+from .buffers import get_max_rss, get_rss
+from .tracing import trace
+
+
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Histogram:
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def prometheus_lines(self, name, labels=''):
+        lines = []
+        cumulative = 0
+        sep = ',' if labels else ''
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        labels = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{labels} {self.total}')
+        lines.append(f'{name}_count{labels} {self.count}')
+        return lines
+
+
+class Metrics:
+
+    # seconds between samples used for the rates in /status
+    sample_interval = 10
+
+    def __init__(self):
+        self.start_time = time()
+        self.connections_total = 0
+        self.handshakes_total = 0
+        self.rejected_total = 0
+        self.throttled_seconds = 0
+        self.active_connections = {} # hostname -> count
+        self.bytes_received = 0 # as received, possibly compressed
+        self.bytes_written = 0 # uncompressed
+        self.codec_bytes_received = {} # codec -> bytes
+        self.codec_bytes_decompressed = {} # codec -> bytes
+        self.decompress_latency = {} # codec -> Histogram
+        self.write_latency = Histogram()
+        self.last_write = {} # (hostname, path) -> timestamp, only while connected
+        self.samples = deque(maxlen=7)
+        self.receive_budget = None # ReceiveBudget, set by the server
+
+    def connection_opened(self):
+        self.connections_total += 1
+
+    def handshake(self, hostname):
+        self.handshakes_total += 1
+        self.active_connections[hostname] = self.active_connections.get(hostname, 0) + 1
+
+    def rejected(self):
+        self.rejected_total += 1
+
+    def throttled(self, duration):
+        self.throttled_seconds += duration
+
+    def connection_closed(self, hostname, path):
+        self.last_write.pop((hostname, path), None)
+        self.active_connections[hostname] -= 1
+        if not self.active_connections[hostname]:
+            del self.active_connections[hostname]
+
+    def data_received(self, codec, received_size, decompressed_size, decompress_duration):
+        codec = codec or 'none'
+        self.bytes_received += received_size
+        self.codec_bytes_received[codec] = self.codec_bytes_received.get(codec, 0) + received_size
+        self.codec_bytes_decompressed[codec] = self.codec_bytes_decompressed.get(codec, 0) + decompressed_size
+        if codec not in self.decompress_latency:
+            self.decompress_latency[codec] = Histogram()
+        self.decompress_latency[codec].observe(decompress_duration)
+
+    def data_written(self, hostname, path, size, write_duration):
+        self.bytes_written += size
+        self.write_latency.observe(write_duration)
+        self.last_write[(hostname, path)] = time()
+
+    async def run_sampler(self):
+        while True:
+            self.samples.append((monotime(), self.bytes_received, self.bytes_written, self.handshakes_total))
+            await sleep(self.sample_interval)
+
+    def rates(self):
+        '''
+        Return (received bytes/s, written bytes/s, handshakes/s) over the sampled window.
+        '''
+        if not self.samples:
+            return 0, 0, 0
+        t0, received0, written0, handshakes0 = self.samples[0]
+        duration = max(monotime() - t0, 1e-3)
+        return (
+            (self.bytes_received - received0) / duration,
+            (self.bytes_written - written0) / duration,
+            (self.handshakes_total - handshakes0) / duration)
+
+    def compression_ratios(self):
+        return {
+            codec: self.codec_bytes_decompressed[codec] / received if received else None
+            for codec, received in self.codec_bytes_received.items()
+        }
+
+    def status(self, subscriber_count=0):
+        now = time()
+        received_rate, written_rate, handshake_rate = self.rates()
+        return {
+            'uptime_seconds': now - self.start_time,
+            'connections_total': self.connections_total,
+            'active_connections': sum(self.active_connections.values()),
+            'active_connections_by_host': dict(sorted(self.active_connections.items())),
+            'received_bytes_per_second': received_rate,
+            'written_bytes_per_second': written_rate,
+            'handshakes_per_second': handshake_rate,
+            'rejected_total': self.rejected_total,
+            'throttled_seconds': self.throttled_seconds,
+            'compression_ratios': self.compression_ratios(),
+            'subscribers': subscriber_count,
+            'max_last_write_age_seconds': max((now - t for t in self.last_write.values()), default=None),
+            'memory': self.memory_status(),
+        }
+
+    def memory_status(self):
+        status = {
+            'rss_bytes': get_rss(),
+            'max_rss_bytes': get_max_rss(),
+        }
+        if self.receive_budget:
+            status['receive_buffer_bytes'] = self.receive_budget.used
+            status['receive_buffer_peak_bytes'] = self.receive_budget.peak
+            status['receive_buffer_limit_bytes'] = self.receive_budget.max_bytes
+            status['receive_buffer_waits'] = self.receive_budget.waits
+        return status
+
+    def status_json(self, **kwargs):
+        return json.dumps(self.status(**kwargs), indent=2) + '\n'
+
+    def prometheus_text(self, subscriber_count=0):
+        now = time()
+        lines = [
+            '# TYPE logline_connections_total counter',
+            f'logline_connections_total {self.connections_total}',
+            '# TYPE logline_handshakes_total counter',
+            f'logline_handshakes_total {self.handshakes_total}',
+            '# TYPE logline_rejected_connections_total counter',
+            f'logline_rejected_connections_total {self.rejected_total}',
+            '# TYPE logline_throttled_seconds_total counter',
+            f'logline_throttled_seconds_total {self.throttled_seconds}',
+            '# TYPE logline_active_connections gauge',
+        ]
+        for hostname, count in sorted(self.active_connections.items()):
+            lines.append(f'logline_active_connections{{host={_label(hostname)}}} {count}')
+        lines += [
+            '# TYPE logline_received_bytes_total counter',
+            f'logline_received_bytes_total {self.bytes_received}',
+            '# TYPE logline_written_bytes_total counter',
+            f'logline_written_bytes_total {self.bytes_written}',
+            '# TYPE logline_codec_received_bytes_total counter',
+        ]
+        for codec, size in sorted(self.codec_bytes_received.items()):
+            lines.append(f'logline_codec_received_bytes_total{{codec={_label(codec)}}} {size}')
+        lines.append('# TYPE logline_codec_decompressed_bytes_total counter')
+        for codec, size in sorted(self.codec_bytes_decompressed.items()):
+            lines.append(f'logline_codec_decompressed_bytes_total{{codec={_label(codec)}}} {size}')
+        lines.append('# TYPE logline_decompress_duration_seconds histogram')
+        for codec, histogram in sorted(self.decompress_latency.items()):
+            lines += histogram.prometheus_lines('logline_decompress_duration_seconds', f'codec={_label(codec)}')
+        lines.append('# TYPE logline_write_duration_seconds histogram')
+        lines += self.write_latency.prometheus_lines('logline_write_duration_seconds')
+        lines += [
+            '# TYPE logline_subscribers gauge',
+            f'logline_subscribers {subscriber_count}',
+            '# TYPE logline_destination_last_write_age_seconds gauge',
+        ]
+        for (hostname, path), t in sorted(self.last_write.items()):
+            lines.append(
+                f'logline_destination_last_write_age_seconds{{host={_label(hostname)},path={_label(path)}}} {now - t:.3f}')
+        memory = self.memory_status()
+        if memory['rss_bytes'] is not None:
+            lines += [
+                '# TYPE process_resident_memory_bytes gauge',
+                f'process_resident_memory_bytes {memory["rss_bytes"]}',
+            ]
+        lines += [
+            '# TYPE logline_max_resident_memory_bytes gauge',
+            f'logline_max_resident_memory_bytes {memory["max_rss_bytes"]}',
+        ]
+        if self.receive_budget:
+            lines += [
+                '# TYPE logline_receive_buffer_bytes gauge',
+                f'logline_receive_buffer_bytes {memory["receive_buffer_bytes"]}',
+                '# TYPE logline_receive_buffer_peak_bytes gauge',
+                f'logline_receive_buffer_peak_bytes {memory["receive_buffer_peak_bytes"]}',
+                '# TYPE logline_receive_buffer_limit_bytes gauge',
+                f'logline_receive_buffer_limit_bytes {memory["receive_buffer_limit_bytes"]}',
+                '# TYPE logline_receive_buffer_waits_total counter',
+                f'logline_receive_buffer_waits_total {memory["receive_buffer_waits"]}',
+            ]
+        # sampled trace points of the hot paths
+        lines += trace.prometheus_lines()
+        return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+    return json.dumps(str(value), ensure_ascii=False)
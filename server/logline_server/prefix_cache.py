@@ -0,0 +1,58 @@
+'''
+Cache of the prefix hashes of the mirror files.
+
+Every agent handshake compares the SHA1 of the file prefix sent by the agent
+with the prefix of the mirror file. The mirror files are append-only, so the
+hash of a prefix of given length never changes as long as the file is the same
+(same inode) - it is cached, so that reconnecting agents do not cause random
+reads on the mirror disk.
+
+The cache is used also from threads (lengths queries), the entries are
+guarded by a lock; the prefix itself is read outside of it.
+'''
+
+from collections import OrderedDict
+import os
+from threading import Lock
+
+
+class PrefixCache:
+
+    def __init__(self, max_entries=2**16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # path -> (device and inode, {prefix length: sha1})
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def prefix_hash(self, f, length):
+        '''
+        Return SHA1 (base64) of the first length bytes of the open storage object,
+        or None if the file is shorter.
+        '''
+        from .main import sha1_b64
+        st = os.stat(f.path)
+        file_id = (st.st_dev, st.st_ino)
+        with self.lock:
+            entry = self.entries.get(f.path)
+            if entry is None or entry[0] != file_id:
+                entry = (file_id, {})
+                self.entries[f.path] = entry
+            self.entries.move_to_end(f.path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            hashes = entry[1]
+            if length in hashes:
+                self.hits += 1
+                return hashes[length]
+            self.misses += 1
+        prefix = f.read_at(0, length)
+        if len(prefix) < length:
+            # the file may still grow, do not cache
+            return None
+        hashes[length] = sha1_b64(prefix)
+        return hashes[length]
+
+    def invalidate(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
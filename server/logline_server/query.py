@@ -0,0 +1,84 @@
+'''
+Time range query over the mirrored files of one host and path.
+
+Usage: logline-server query --host HOST --path PATH [--since TIME] [--until TIME]
+'''
+
+from argparse import ArgumentParser
+import mmap
+import sys
+
+from .storage import PlainFile, is_sidecar, open_for_reading
+from .time_index import TimeIndex, get_timestamp_parser, line_head_size, parse_query_time, tidx_suffix
+
+
+def query_main(argv):
+    from .configuration import ToolConfiguration
+    from .main import build_destination_path
+    p = ArgumentParser(prog='logline-server query')
+    p.add_argument('--conf', help='path to configuration file')
+    p.add_argument('--dest', help='directory with the received logs')
+    p.add_argument('--host', required=True)
+    p.add_argument('--path', required=True, help='path of the log file on the host')
+    p.add_argument('--since', help='ISO datetime, HH:MM[:SS] (today, UTC) or Unix time')
+    p.add_argument('--until', help='ISO datetime, HH:MM[:SS] (today, UTC) or Unix time')
+    args = p.parse_args(argv)
+    conf = ToolConfiguration(args=args)
+    since = parse_query_time(args.since) if args.since else None
+    until = parse_query_time(args.until) if args.until else None
+    dst_path = build_destination_path(conf.destination_directory, args.host, args.path)
+    parse_timestamp = get_timestamp_parser(conf.time_index_parsers)
+    out = sys.stdout.buffer
+    for path in find_mirror_files(dst_path):
+        f = open_for_reading(path)
+        try:
+            index = TimeIndex(path.with_name(path.name + tidx_suffix))
+            query_file(f, index, since, until, parse_timestamp, out)
+        finally:
+            f.close()
+    out.flush()
+
+
+def find_mirror_files(dst_path):
+    '''
+    Return the rotated files (oldest first) and the live file for given destination path.
+    '''
+    candidates = sorted(dst_path.parent.glob(dst_path.name + '.rotated-*'))
+    candidates += [dst_path, dst_path.with_name(dst_path.name + '.zst')]
+    # *.tmp are outputs of running compaction jobs
+    return [p for p in candidates if p.is_file() and not is_sidecar(p) and not p.name.endswith('.tmp')]
+
+
+def query_file(f, index, since, until, parse_timestamp, out):
+    '''
+    Write lines of the mirror file f with timestamps between since and until to out.
+    Lines without a timestamp (multiline messages) belong to the preceding timestamped line.
+    '''
+    length = f.length
+    start, end = index.byte_range(since, until, length)
+    if start >= end:
+        return
+    if isinstance(f, PlainFile):
+        if length == 0:
+            return
+        with mmap.mmap(f.f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            _write_matching_lines(m, start, end, since, until, parse_timestamp, out)
+    else:
+        data = f.read_at(start, end - start)
+        _write_matching_lines(data, 0, len(data), since, until, parse_timestamp, out)
+
+
+def _write_matching_lines(buf, start, end, since, until, parse_timestamp, out):
+    current_ts = None
+    pos = start
+    while pos < end:
+        nl = buf.find(b'\n', pos, end)
+        line_end = end if nl == -1 else nl + 1
+        ts = parse_timestamp(buf[pos:min(pos + line_head_size, line_end)])
+        if ts is not None:
+            current_ts = ts
+            if until is not None and ts > until:
+                break
+        if current_ts is not None and (since is None or current_ts >= since):
+            out.write(buf[pos:line_end])
+        pos = line_end
@@ -0,0 +1,357 @@
+'''
+Server-to-server replication.
+
+The server forwards the mirrored files to downstream Logline Servers, acting
+as an agent towards them (`logline-agent-v1`, the same hostname and path).
+Every chunk written by handle_client() marks the file dirty for every
+replication destination; a task per (destination, file) then reads the new
+data from the mirror file and sends them downstream in batches of up to
+`batch_size` bytes, with up to `pipeline_depth` data commands sent before
+waiting for their `ok` replies.
+
+The data are always read back from the mirror file, so nothing is lost when
+a destination is down - the replication just catches up later. Replicated
+offsets are saved periodically to the cursor file `.replication-<destination>.json`
+in the destination directory, so that the catch-up works also after a restart.
+The cursor only decides which files need work; where to continue is
+decided by the length in the handshake reply of the downstream server.
+
+The file task keeps the mirror file open for reading (the zst index is only
+refreshed, not loaded again) and reads it in a thread. The prefix sent in the
+handshake has the length the agent used for the file.
+
+When a mirror file is rotated on this server, its cursor record is moved to
+the `rotated` list of the new record of the same path, together with the
+rotated file name. The file task first drains the rotated files (in the order
+of rotation, also after a restart), then continues with the live file - so a
+downstream outage longer than the rotation interval loses nothing, unless the
+rotated file is deleted by retention first.
+
+Files that existed before replication was enabled are not replicated until
+they receive new data.
+'''
+
+from asyncio import Event, create_task, open_connection, sleep, wait_for, TimeoutError as AsyncTimeoutError
+from collections import deque
+import gzip
+import json
+from logging import getLogger
+import os
+import re
+
+from .storage import open_for_reading
+from .util import to_thread, zst_compress_frame
+
+
+logger = getLogger(__name__)
+
+# Prefix length for files in cursors saved without it - the default prefix length of the agent
+default_prefix_length = 50
+
+# seconds between saves of the cursor files
+cursor_save_interval = 5
+
+
+class Replication:
+
+    def __init__(self, conf):
+        self.destinations = [ReplicationDestination(conf, dest_conf) for dest_conf in conf.replication_destinations]
+
+    def start(self):
+        for destination in self.destinations:
+            destination.start()
+
+    def notify(self, hostname, path, storage_path, prefix_length):
+        '''
+        Called after data were appended to a mirror file; prefix_length is from the agent handshake.
+        '''
+        for destination in self.destinations:
+            destination.notify(hostname, path, storage_path, prefix_length)
+
+    def rotated(self, storage_path, rotated_path):
+        '''
+        Called right after the mirror file was renamed to rotated_path.
+        '''
+        for destination in self.destinations:
+            destination.rotated(storage_path, rotated_path)
+
+
+class ReplicationDestination:
+
+    def __init__(self, conf, dest_conf):
+        from .configuration import parse_address
+        self.conf = conf
+        self.address = dest_conf['server']
+        self.host, self.port = parse_address(dest_conf['server'])
+        self.client_token = dest_conf['client_token']
+        self.use_tls = bool(dest_conf.get('tls') or dest_conf.get('tls_cert'))
+        self.tls_cert_file = dest_conf.get('tls_cert')
+        self.cursor_path = conf.destination_directory / '.replication-{}.json'.format(
+            re.sub(r'[^A-Za-z0-9.-]', '_', self.address))
+        # relative storage path -> {'hostname', 'path', 'offset', 'prefix_length', 'rotated'};
+        # 'rotated' is a list of such records with 'file' - relative path of the rotated file
+        self.cursor = {}
+        self.cursor_dirty = False
+        self.file_tasks = {} # relative storage path -> ReplicationFileTask
+
+    def start(self):
+        try:
+            self.cursor = json.loads(self.cursor_path.read_text())
+        except FileNotFoundError:
+            pass
+        # catch up with data written while this server was down or not replicating
+        for rel_path, item in self.cursor.items():
+            storage_path = self.conf.destination_directory.resolve() / rel_path
+            try:
+                f = open_for_reading(storage_path)
+            except FileNotFoundError:
+                length = None
+            else:
+                try:
+                    length = f.length
+                finally:
+                    f.close()
+            if item.get('rotated') or (length is not None and length > item['offset']):
+                self.notify(item['hostname'], item['path'], storage_path, item.get('prefix_length', default_prefix_length))
+        self.save_task = create_task(self.save_cursor_periodically())
+
+    def notify(self, hostname, path, storage_path, prefix_length):
+        rel_path = str(storage_path.relative_to(self.conf.destination_directory.resolve()))
+        if rel_path not in self.cursor:
+            self.cursor[rel_path] = {'hostname': hostname, 'path': path, 'offset': 0}
+        if self.cursor[rel_path].get('prefix_length') != prefix_length:
+            self.cursor[rel_path]['prefix_length'] = prefix_length
+            self.cursor_dirty = True
+        task = self.file_tasks.get(rel_path)
+        if task is None or task.done:
+            task = ReplicationFileTask(self, rel_path, hostname, path, storage_path)
+            self.file_tasks[rel_path] = task
+            task.start()
+        task.prefix_length = prefix_length
+        task.event.set()
+
+    def rotated(self, storage_path, rotated_path):
+        root = self.conf.destination_directory.resolve()
+        rel_path = str(storage_path.relative_to(root))
+        item = self.cursor.get(rel_path)
+        if item is None:
+            # never replicated
+            return
+        # the same list object - a file task may be draining it
+        rotated = item.pop('rotated', [])
+        item['file'] = str(rotated_path.relative_to(root))
+        rotated.append(item)
+        self.cursor[rel_path] = {
+            'hostname': item['hostname'],
+            'path': item['path'],
+            'offset': 0,
+            'prefix_length': item.get('prefix_length', default_prefix_length),
+            'rotated': rotated,
+        }
+        self.cursor_dirty = True
+
+    def rotated_replicated(self, rel_path, rotated_item):
+        rotated = self.cursor[rel_path]['rotated']
+        rotated.remove(rotated_item)
+        if not rotated:
+            del self.cursor[rel_path]['rotated']
+        self.cursor_dirty = True
+
+    def replicated(self, item, offset):
+        '''
+        Record of the cursor (live or rotated file) was replicated up to offset.
+        '''
+        item['offset'] = offset
+        self.cursor_dirty = True
+
+    async def save_cursor_periodically(self):
+        while True:
+            await sleep(cursor_save_interval)
+            if self.cursor_dirty:
+                self.cursor_dirty = False
+                try:
+                    await to_thread(self.save_cursor, json.dumps(self.cursor, sort_keys=True))
+                except Exception as e:
+                    logger.exception('Failed to save replication cursor %s: %r', self.cursor_path, e)
+
+    def save_cursor(self, cursor_json):
+        tmp_path = self.cursor_path.with_name(self.cursor_path.name + '.tmp')
+        with tmp_path.open('w') as f:
+            f.write(cursor_json)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path.replace(self.cursor_path)
+
+    async def connect(self):
+        if self.use_tls:
+            from ssl import create_default_context, Purpose
+            ssl_context = create_default_context(purpose=Purpose.SERVER_AUTH, cafile=self.tls_cert_file)
+        else:
+            ssl_context = None
+        return await open_connection(self.host, self.port, ssl=ssl_context)
+
+
+def open_rotated(storage_path):
+    '''
+    Open rotated mirror file for reading - it may have been compacted to zst in the meantime.
+    '''
+    try:
+        return open_for_reading(storage_path)
+    except FileNotFoundError:
+        if storage_path.name.endswith('.zst'):
+            raise
+        return open_for_reading(storage_path.with_name(storage_path.name + '.zst'))
+
+
+class ReplicationFileTask:
+    '''
+    Replicates one mirror file to one destination; runs until the file
+    has not received new data for `idle_timeout` seconds.
+    '''
+
+    def __init__(self, destination, rel_path, hostname, path, storage_path):
+        self.destination = destination
+        self.conf = destination.conf
+        self.rel_path = rel_path
+        self.hostname = hostname
+        self.path = path
+        self.storage_path = storage_path
+        self.event = Event()
+        self.done = False
+        self.prefix_length = default_prefix_length
+        self.file = None # mirror file open for reading
+        self.reader = None
+        self.writer = None
+        self.remote_length = None
+
+    def start(self):
+        self.task = create_task(self.run())
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await wait_for(self.event.wait(), self.conf.replication_idle_timeout)
+                except AsyncTimeoutError:
+                    return
+                self.event.clear()
+                try:
+                    await self.sync()
+                except Exception as e:
+                    logger.warning(
+                        'Failed to replicate %s to %s: %r', self.rel_path, self.destination.address, e)
+                    self.disconnect()
+                    await to_thread(self.close_file)
+                    # try again later
+                    self.event.set()
+                    await sleep(self.conf.replication_retry_interval)
+        finally:
+            self.done = True
+            self.disconnect()
+            self.close_file()
+
+    def disconnect(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = self.remote_length = None
+
+    def close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def refresh_file(self):
+        '''
+        Return (current length of the mirror file, whether it was reopened after rotation).
+        Runs in a thread.
+        '''
+        rotated = False
+        if self.file and os.stat(self.storage_path).st_ino != os.fstat(self.file.f.fileno()).st_ino:
+            logger.debug('File %s was rotated, reconnecting', self.rel_path)
+            self.close_file()
+            rotated = True
+        if self.file:
+            self.file.refresh()
+        else:
+            self.file = open_for_reading(self.storage_path)
+        return self.file.length, rotated
+
+    async def sync(self):
+        while True:
+            item = self.destination.cursor[self.rel_path]
+            if item.get('rotated'):
+                # the rest of the rotated files first, so that the data arrive in order
+                self.disconnect()
+                rotated_item = item['rotated'][0]
+                await self.sync_rotated(rotated_item)
+                self.destination.rotated_replicated(self.rel_path, rotated_item)
+                continue
+            length, rotated = await to_thread(self.refresh_file)
+            if rotated:
+                self.disconnect()
+            # the file may have been rotated while it was being refreshed
+            if not self.destination.cursor[self.rel_path].get('rotated'):
+                break
+        await self.send_file(self.file, length, item, self.prefix_length)
+
+    async def sync_rotated(self, rotated_item):
+        storage_path = self.conf.destination_directory.resolve() / rotated_item['file']
+        try:
+            f = await to_thread(open_rotated, storage_path)
+        except FileNotFoundError:
+            logger.warning(
+                'Rotated file %s was deleted before it was replicated to %s', storage_path, self.destination.address)
+            return
+        try:
+            if f.length > rotated_item['offset']:
+                logger.debug('Replicating rotated file %s to %s', f.path, self.destination.address)
+                await self.send_file(f, f.length, rotated_item, rotated_item.get('prefix_length', default_prefix_length))
+        finally:
+            self.disconnect()
+            await to_thread(f.close)
+
+    async def send_file(self, f, length, item, prefix_length):
+        '''
+        Send the file up to length, to a new connection if needed; item is its cursor record.
+        '''
+        from .main import recv_command, send_command, sha1_b64
+        if self.writer is None:
+            prefix = await to_thread(f.read_at, 0, min(length, prefix_length))
+            self.reader, self.writer = await self.destination.connect()
+            send_command(self.writer, 'logline-agent-v1', {
+                'hostname': self.hostname,
+                'path': self.path,
+                'prefix': {'length': len(prefix), 'sha1': sha1_b64(prefix)},
+                'auth': {'client_token': self.destination.client_token},
+            })
+            await self.writer.drain()
+            command, metadata, _ = await recv_command(self.reader)
+            if command != 'ok':
+                raise Exception(f'Handshake failed: {command} {metadata}')
+            self.remote_length = metadata['length']
+            logger.debug('Replicating %s to %s from offset %d', self.rel_path, self.destination.address, self.remote_length)
+        offset = self.remote_length
+        pending = deque() # end offsets of the sent data commands
+        while offset < length or pending:
+            while offset < length and len(pending) < self.conf.replication_pipeline_depth:
+                size = min(self.conf.replication_batch_size, length - offset)
+                data, compression = await to_thread(self.read_chunk, f, offset, size)
+                send_command(self.writer, 'data', {'offset': offset, 'compression': compression}, data)
+                offset += size
+                pending.append(offset)
+            await self.writer.drain()
+            command, metadata, _ = await recv_command(self.reader)
+            if command != 'ok':
+                raise Exception(f'Error reply: {command} {metadata}')
+            self.remote_length = pending.popleft()
+            self.destination.replicated(item, self.remote_length)
+
+    def read_chunk(self, f, offset, size):
+        data = f.read_at(offset, size)
+        assert len(data) == size
+        compression = self.conf.replication_compression
+        if compression == 'gzip':
+            data = gzip.compress(data)
+        elif compression == 'zst':
+            data = zst_compress_frame(data)
+        return data, compression
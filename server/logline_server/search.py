@@ -0,0 +1,117 @@
+'''
+Search for a term in all mirrored files, using the bloom index to skip segments.
+
+Usage: logline-server search TERM [--host GLOB] [--name GLOB] [--workers N]
+
+The term is matched case-insensitively as a sequence of whole tokens
+(alphanumeric runs), the same way the bloom index sees the data.
+'''
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import re
+import sys
+
+from .bloom_index import BloomIndex, bloom_suffix
+from .storage import is_sidecar, open_for_reading
+
+
+# How far before and after the match the line boundaries are looked for
+line_margin = 4096
+
+# Maximum number of consecutive segments searched by one worker task
+segments_per_task = 8
+
+
+def search_main(argv):
+    from .configuration import ToolConfiguration
+    p = ArgumentParser(prog='logline-server search')
+    p.add_argument('--conf', help='path to configuration file')
+    p.add_argument('--dest', help='directory with the received logs')
+    p.add_argument('--host', default='*', help='glob of host names to search')
+    p.add_argument('--name', default='*', help='glob of mirror file names to search')
+    p.add_argument('--workers', type=int, help='number of worker processes')
+    p.add_argument('term')
+    args = p.parse_args(argv)
+    conf = ToolConfiguration(args=args)
+    term = args.term.encode()
+    out = sys.stdout.buffer
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = []
+        for path in find_search_files(conf.destination_directory, args.host, args.name):
+            for ranges in plan_search(path, term):
+                futures.append((path, pool.submit(search_ranges, path, ranges, term)))
+        for path, fut in futures:
+            rel_path = path.relative_to(conf.destination_directory)
+            for offset, line in fut.result():
+                out.write(f'{rel_path}:{offset}: '.encode() + line + b'\n')
+    out.flush()
+
+
+def find_search_files(destination_directory, host_glob, name_glob):
+    for host_dir in sorted(destination_directory.glob(host_glob)):
+        if not host_dir.is_dir():
+            continue
+        for path in sorted(host_dir.glob('**/' + name_glob)):
+            if path.is_file() and not is_sidecar(path) and not path.name.endswith('.tmp'):
+                yield path
+
+
+def plan_search(path, term):
+    '''
+    Return list of tasks - lists of (start, end) byte ranges that need to be searched.
+    '''
+    f = open_for_reading(path)
+    try:
+        length = f.length
+    finally:
+        f.close()
+    if not length:
+        return []
+    bloom_path = path.with_name(path.name + bloom_suffix)
+    if not bloom_path.exists():
+        segment_size = 2**24
+        segments = list(range(length // segment_size + 1))
+    else:
+        index = BloomIndex(bloom_path)
+        segment_size = index.segment_size
+        segments = index.candidate_segments(term, length)
+    tasks = []
+    for i in range(0, len(segments), segments_per_task):
+        ranges = []
+        for segment in segments[i:i + segments_per_task]:
+            start = segment * segment_size
+            end = min(length, start + segment_size)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        tasks.append(ranges)
+    return tasks
+
+
+def search_ranges(path, ranges, term):
+    '''
+    Worker - return list of (line offset, line) for occurrences of term
+    that start in the given byte ranges.
+    '''
+    term_re = re.compile(rb'(?<![A-Za-z0-9])' + re.escape(term) + rb'(?![A-Za-z0-9])', re.IGNORECASE)
+    results = []
+    f = open_for_reading(path)
+    try:
+        for start, end in ranges:
+            read_start = max(0, start - line_margin)
+            data = f.read_at(read_start, end + len(term) + line_margin - read_start)
+            last_line_start = None
+            for m in term_re.finditer(data, start - read_start):
+                if m.start() >= end - read_start:
+                    break
+                line_start = data.rfind(b'\n', 0, m.start()) + 1
+                if line_start == last_line_start:
+                    continue
+                line_end = data.find(b'\n', m.end())
+                results.append((read_start + line_start, data[line_start:None if line_end == -1 else line_end]))
+                last_line_start = line_start
+    finally:
+        f.close()
+    return results
@@ -0,0 +1,363 @@
+'''
+Storage formats of the mirrored log files on the server.
+
+Both storage classes expose the same interface: they are addressed by the
+uncompressed offset of the log content, so the `length` reported to the agent
+in the handshake is always the length of the original log file.
+'''
+
+from array import array
+from bisect import bisect_right
+from io import SEEK_END
+from logging import getLogger
+import os
+from pathlib import Path
+import struct
+from time import monotonic as monotime
+
+from .util import is_single_zst_frame, to_thread, zst_compress_frame, zst_decompress_frame
+
+
+logger = getLogger(__name__)
+
+# Suffixes of the files stored next to the mirror file (indexes etc.);
+# they are renamed together with the mirror file when it is rotated.
+sidecar_suffixes = ('.idx', '.tidx', '.bloom')
+
+
+def is_sidecar(path):
+    return path.name.endswith(sidecar_suffixes)
+
+
+def rename_sidecars(old_path, new_path):
+    for suffix in sidecar_suffixes:
+        old_sidecar = old_path.with_name(old_path.name + suffix)
+        if old_sidecar.exists():
+            old_sidecar.rename(new_path.with_name(new_path.name + suffix))
+
+
+def open_destination(conf, dst_path):
+    '''
+    Return storage object (not opened yet) for given destination path
+    according to the configured storage format.
+    '''
+    if conf.storage_format == 'zst':
+        return SeekableZstdFile(
+            dst_path.with_name(dst_path.name + '.zst'),
+            level=conf.zst_level,
+            frame_size=conf.zst_frame_size)
+    return PlainFile(dst_path)
+
+
+def open_for_reading(path):
+    '''
+    Open existing mirrored file for reading - format is detected by the file name.
+    '''
+    path = os.fspath(path)
+    if path.endswith('.zst.idx'):
+        path = path[:-len('.idx')]
+    if path.endswith('.zst'):
+        storage = SeekableZstdFile(Path(path))
+    else:
+        storage = PlainFile(Path(path))
+    storage.open(readonly=True)
+    return storage
+
+
+class PlainFile:
+    '''
+    Uncompressed mirror file - byte for byte copy of the original log file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.path}>'
+
+    def exists(self):
+        return self.path.exists()
+
+    def open(self, readonly=False):
+        assert self.f is None
+        if readonly:
+            self.f = self.path.open('rb')
+        else:
+            try:
+                self.f = self.path.open('rb+')
+            except FileNotFoundError:
+                logger.info('Creating new file: %s', self.path)
+                self.f = self.path.open('wb+')
+        self.f.seek(0, SEEK_END)
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def rotate(self, suffix):
+        assert self.f is None
+        new_path = self.path.with_name(self.path.name + suffix)
+        self.path.rename(new_path)
+        rename_sidecars(self.path, new_path)
+        return new_path
+
+    @property
+    def length(self):
+        return self.f.seek(0, SEEK_END)
+
+    # PlainFile.write() does not buffer
+    buffered_since = None
+
+    def flush(self):
+        pass
+
+    def refresh(self):
+        '''
+        Nothing to do - the length of the plain file is always current.
+        '''
+
+    def read_at(self, offset, size):
+        if self.f:
+            self.f.seek(offset)
+            data = self.f.read(size)
+            self.f.seek(0, SEEK_END)
+            return data
+        with self.path.open('rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    async def write(self, data, zst_frame=None):
+        self.f.write(data)
+        self.f.flush()
+
+    async def write_at(self, offset, data):
+        '''
+        Overwrite already stored data (repair after verification).
+        '''
+        assert offset + len(data) <= self.length
+        self.f.seek(offset)
+        self.f.write(data)
+        self.f.flush()
+        self.f.seek(0, SEEK_END)
+
+
+class SeekableZstdFile:
+    '''
+    Mirror file stored as a sequence of independent zstd frames
+    plus a sidecar index file (`<name>.zst.idx`).
+
+    The index contains one record per frame: (compressed end, uncompressed end).
+    Random access by uncompressed offset needs to decompress only the frames
+    covering the requested range.
+
+    Appended data are buffered uncompressed until they fill a frame of
+    frame_size, so that small appends while tailing a log do not produce lots
+    of tiny badly compressed frames, and each byte is compressed only once.
+    The buffer (counted in length, readable by read_at) is written as a
+    smaller frame by flush() and close(); written frames never change, so
+    readers of a live file can keep it open (see refresh()). If the server
+    crashes, the buffered data are lost and the agent just sends them again
+    - the handshake length comes from the file.
+    '''
+
+    index_record = struct.Struct('<QQ')
+
+    def __init__(self, path, level=3, frame_size=2**17):
+        self.path = path
+        self.index_path = path.with_name(path.name + '.idx')
+        self.level = level
+        self.frame_size = frame_size
+        self.f = None
+        self.index_f = None
+        self.compressed_ends = array('Q')
+        self.uncompressed_ends = array('Q')
+        self.tail_parts = [] # buffered data not written to a frame yet
+        self.tail_size = 0
+        self.buffered_since = None # monotime of the oldest buffered data
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.path}>'
+
+    def exists(self):
+        return self.path.exists()
+
+    def open(self, readonly=False):
+        assert self.f is None
+        if readonly:
+            self.f = self.path.open('rb')
+            self.index_f = self.index_path.open('rb')
+            self._load_index()
+            return
+        try:
+            self.f = self.path.open('rb+')
+        except FileNotFoundError:
+            logger.info('Creating new file: %s', self.path)
+            self.f = self.path.open('wb+')
+        try:
+            self.index_f = self.index_path.open('rb+')
+        except FileNotFoundError:
+            self.index_f = self.index_path.open('wb+')
+        self._load_index()
+        self._truncate_files()
+
+    def _load_index(self):
+        self._read_index_records()
+        if self.compressed_ends:
+            try:
+                self._read_frame(len(self.compressed_ends) - 1)
+            except Exception as e:
+                logger.warning('Dropping damaged last frame of %s: %r', self.path, e)
+                self.compressed_ends.pop()
+                self.uncompressed_ends.pop()
+
+    def _read_index_records(self):
+        index_bytes = self.index_f.read()
+        record_count = len(index_bytes) // self.index_record.size
+        for i in range(record_count):
+            c_end, u_end = self.index_record.unpack_from(index_bytes, i * self.index_record.size)
+            self.compressed_ends.append(c_end)
+            self.uncompressed_ends.append(u_end)
+        data_size = self.f.seek(0, SEEK_END)
+        # drop records of frames that were not (completely) written
+        while self.compressed_ends and self.compressed_ends[-1] > data_size:
+            self.compressed_ends.pop()
+            self.uncompressed_ends.pop()
+
+    def refresh(self):
+        '''
+        Read the index records written since open by the writer of a live file,
+        so that a reader can be kept open.
+        '''
+        self.index_f.seek(len(self.compressed_ends) * self.index_record.size)
+        self._read_index_records()
+
+    def _truncate_files(self):
+        self.f.truncate(self.compressed_ends[-1] if self.compressed_ends else 0)
+        self.f.flush()
+        self.index_f.truncate(len(self.compressed_ends) * self.index_record.size)
+        self.index_f.flush()
+
+    def close(self):
+        if self.f:
+            self.flush()
+            self.f.close()
+            self.f = None
+        if self.index_f:
+            self.index_f.close()
+            self.index_f = None
+
+    def rotate(self, suffix):
+        assert self.f is None
+        assert self.path.name.endswith('.zst')
+        new_path = self.path.with_name(self.path.name[:-len('.zst')] + suffix + '.zst')
+        self.path.rename(new_path)
+        rename_sidecars(self.path, new_path)
+        return new_path
+
+    @property
+    def length(self):
+        return self.written_length + self.tail_size
+
+    @property
+    def written_length(self):
+        return self.uncompressed_ends[-1] if self.uncompressed_ends else 0
+
+    @property
+    def compressed_length(self):
+        return self.compressed_ends[-1] if self.compressed_ends else 0
+
+    def _frame_bounds(self, i):
+        c_start = self.compressed_ends[i - 1] if i else 0
+        u_start = self.uncompressed_ends[i - 1] if i else 0
+        return c_start, self.compressed_ends[i], u_start, self.uncompressed_ends[i]
+
+    def _read_frame(self, i):
+        c_start, c_end, u_start, u_end = self._frame_bounds(i)
+        self.f.seek(c_start)
+        data = zst_decompress_frame(self.f.read(c_end - c_start))
+        if len(data) != u_end - u_start:
+            raise Exception(f'Frame {i} of {self.path} has unexpected size {len(data)}, expected {u_end - u_start}')
+        return data
+
+    def read_at(self, offset, size):
+        parts = []
+        i = bisect_right(self.uncompressed_ends, offset)
+        end = offset + size
+        while i < len(self.uncompressed_ends) and size > 0:
+            _, _, u_start, u_end = self._frame_bounds(i)
+            frame_data = self._read_frame(i)
+            parts.append(frame_data[offset - u_start:end - u_start])
+            offset = u_end
+            size = end - offset
+            i += 1
+        if size > 0 and self.tail_size:
+            tail_start = self.written_length
+            parts.append(self._tail_data()[offset - tail_start:end - tail_start])
+        return b''.join(parts)
+
+    def _tail_data(self):
+        if len(self.tail_parts) > 1:
+            self.tail_parts = [b''.join(self.tail_parts)]
+        return self.tail_parts[0] if self.tail_parts else b''
+
+    async def write(self, data, zst_frame=None):
+        await to_thread(self.append, data, zst_frame)
+
+    def append(self, data, zst_frame=None):
+        '''
+        Append data. If zst_frame (the same data as received from the agent,
+        already compressed) is given, it may be stored as-is without recompression
+        - but only if it is a single frame, because the index has one record per frame.
+        '''
+        if not data:
+            return
+        if zst_frame is not None and not self.tail_size and len(data) >= self.frame_size:
+            if is_single_zst_frame(zst_frame, len(data)):
+                self._write_frames([zst_frame], [len(data)])
+                return
+        if not self.tail_size:
+            self.buffered_since = monotime()
+        self.tail_parts.append(data)
+        self.tail_size += len(data)
+        if self.tail_size >= self.frame_size:
+            data = self._tail_data()
+            full_size = len(data) - len(data) % self.frame_size
+            pieces = [data[i:i + self.frame_size] for i in range(0, full_size, self.frame_size)]
+            self._write_frames([zst_compress_frame(p, self.level) for p in pieces], [len(p) for p in pieces])
+            rest = data[full_size:]
+            self.tail_parts = [rest] if rest else []
+            self.tail_size = len(rest)
+            self.buffered_since = monotime() if rest else None
+
+    def flush(self):
+        '''
+        Write the buffered data as a (smaller) frame.
+        '''
+        if self.tail_size:
+            data = self._tail_data()
+            self.tail_parts = []
+            self.tail_size = 0
+            self._write_frames([zst_compress_frame(data, self.level)], [len(data)])
+        self.buffered_since = None
+
+    def _write_frames(self, frames, sizes):
+        first_record = len(self.compressed_ends)
+        c_end = self.compressed_length
+        u_end = self.written_length
+        self.f.seek(c_end)
+        records = []
+        for frame, size in zip(frames, sizes):
+            self.f.write(frame)
+            c_end += len(frame)
+            u_end += size
+            self.compressed_ends.append(c_end)
+            self.uncompressed_ends.append(u_end)
+            records.append(self.index_record.pack(c_end, u_end))
+        self.f.truncate()
+        self.f.flush()
+        self.index_f.seek(first_record * self.index_record.size)
+        self.index_f.write(b''.join(records))
+        self.index_f.truncate()
+        self.index_f.flush()
@@ -0,0 +1,194 @@
+'''
+Live tail subscriptions - fan-out of the received data to subscribed clients.
+
+A client connects to the same port as agents and sends `logline-subscribe-v1`
+instead of `logline-agent-v1` (see Protocol.md). Every chunk written by
+handle_client() is then pushed to all subscribers whose host and path globs
+match. Each subscriber has a bounded buffer; when a subscriber cannot keep up,
+the overflow policy decides whether the new data are dropped (and the client
+is told how many bytes it missed) or the subscriber is disconnected.
+Publishing never waits for subscribers, so slow consumers cannot stall ingestion.
+'''
+
+from argparse import ArgumentParser
+from asyncio import Event, FIRST_COMPLETED, create_task, open_connection, run, wait
+from collections import deque
+from fnmatch import fnmatchcase
+from logging import getLogger
+import os
+from pathlib import Path
+import sys
+
+
+logger = getLogger(__name__)
+
+overflow_policies = ('drop', 'disconnect')
+
+
+class SubscriptionHub:
+
+    def __init__(self):
+        self.subscribers = set()
+
+    def publish(self, hostname, path, offset, data):
+        for subscriber in self.subscribers:
+            subscriber.push(hostname, path, offset, data)
+
+
+class Subscriber:
+
+    def __init__(self, host_globs, path_globs, max_buffer_bytes, overflow):
+        assert overflow in overflow_policies
+        self.host_globs = host_globs
+        self.path_globs = path_globs
+        self.max_buffer_bytes = max_buffer_bytes
+        self.overflow = overflow
+        self.buffer = deque()
+        self.buffered_bytes = 0
+        self.dropped_bytes = 0
+        self.overflowed = False
+        self.event = Event()
+        self._match_cache = {}
+
+    def matches(self, hostname, path):
+        key = (hostname, path)
+        if key not in self._match_cache:
+            self._match_cache[key] = \
+                any(fnmatchcase(hostname, g) for g in self.host_globs) and \
+                any(fnmatchcase(path, g) for g in self.path_globs)
+        return self._match_cache[key]
+
+    def push(self, hostname, path, offset, data):
+        if self.overflowed or not self.matches(hostname, path):
+            return
+        if self.buffered_bytes + len(data) > self.max_buffer_bytes:
+            if self.overflow == 'drop':
+                self.dropped_bytes += len(data)
+            else:
+                self.overflowed = True
+                self.event.set()
+            return
+        self.buffer.append((hostname, path, offset, data))
+        self.buffered_bytes += len(data)
+        self.event.set()
+
+    async def get(self):
+        '''
+        Wait for and return list of buffered (hostname, path, offset, data) items.
+        '''
+        while not self.buffer and not self.overflowed:
+            self.event.clear()
+            await self.event.wait()
+        items = list(self.buffer)
+        self.buffer.clear()
+        self.buffered_bytes = 0
+        return items
+
+
+async def handle_subscriber(conf, hub, header, reader, writer):
+    from .main import send_reply, send_command
+    host_globs = header.get('hosts') or ['*']
+    path_globs = header.get('paths') or ['*']
+    overflow = header.get('overflow') or conf.subscription_overflow
+    if overflow not in overflow_policies:
+        await send_reply(writer, 'error', {'error': f'Unknown overflow policy: {overflow}'})
+        return
+    subscriber = Subscriber(host_globs, path_globs, conf.subscription_max_buffer_bytes, overflow)
+    hub.subscribers.add(subscriber)
+    logger.info('Subscribed: hosts %r paths %r overflow %s', host_globs, path_globs, overflow)
+    eof_task = create_task(wait_for_disconnect(reader))
+    try:
+        await send_reply(writer, 'ok', None)
+        while True:
+            get_task = create_task(subscriber.get())
+            done, pending = await wait({get_task, eof_task}, return_when=FIRST_COMPLETED)
+            if eof_task in done:
+                get_task.cancel()
+                logger.info('Subscriber closed connection')
+                return
+            if subscriber.dropped_bytes:
+                dropped_bytes, subscriber.dropped_bytes = subscriber.dropped_bytes, 0
+                send_command(writer, 'dropped', {'bytes': dropped_bytes})
+            for hostname, path, offset, data in get_task.result():
+                send_command(writer, 'data', {'hostname': hostname, 'path': path, 'offset': offset}, data)
+            if subscriber.overflowed:
+                logger.info('Disconnecting slow subscriber')
+                await send_reply(writer, 'error', {'error': 'Subscriber too slow'})
+                return
+            await writer.drain()
+    finally:
+        hub.subscribers.discard(subscriber)
+        eof_task.cancel()
+
+
+async def wait_for_disconnect(reader):
+    '''
+    The subscriber is not expected to send anything - this just detects
+    disconnect; whatever it sends is discarded, not buffered.
+    '''
+    while not reader.at_eof():
+        await reader.read(1)
+
+
+def tail_main(argv):
+    p = ArgumentParser(prog='logline-server tail')
+    p.add_argument('--server', required=True, help='address of the Logline Server (host:port)')
+    p.add_argument('--tls', action='store_true')
+    p.add_argument('--tls-cert', help='path to the file with certificate in PEM format')
+    p.add_argument('--token-file', help='path to the file containing client token')
+    p.add_argument('--host', action='append', help='glob of host names (default: all)')
+    p.add_argument('--path', action='append', help='glob of log file paths (default: all)')
+    p.add_argument('--overflow', choices=overflow_policies)
+    p.add_argument('--raw', action='store_true', help='do not prefix lines with host and path')
+    args = p.parse_args(argv)
+    if args.token_file:
+        client_token = Path(args.token_file).read_text().strip()
+    elif os.environ.get('CLIENT_TOKEN'):
+        client_token = os.environ['CLIENT_TOKEN']
+    else:
+        p.error('Client token is not configured - use --token-file or CLIENT_TOKEN env variable')
+    try:
+        run(tail(args, client_token, sys.stdout.buffer))
+    except KeyboardInterrupt:
+        pass
+
+
+async def tail(args, client_token, out):
+    from .configuration import parse_address
+    from .main import recv_command, send_command
+    host, port = parse_address(args.server)
+    if args.tls or args.tls_cert:
+        from ssl import create_default_context, Purpose
+        ssl_context = create_default_context(purpose=Purpose.SERVER_AUTH, cafile=args.tls_cert)
+    else:
+        ssl_context = None
+    reader, writer = await open_connection(host, port, ssl=ssl_context)
+    header = {
+        'auth': {'client_token': client_token},
+        'hosts': args.host,
+        'paths': args.path,
+    }
+    if args.overflow:
+        header['overflow'] = args.overflow
+    send_command(writer, 'logline-subscribe-v1', header)
+    await writer.drain()
+    partial_lines = {}
+    while True:
+        command, metadata, data = await recv_command(reader)
+        if command == 'data':
+            if args.raw:
+                out.write(data)
+            else:
+                key = (metadata['hostname'], metadata['path'])
+                lines = (partial_lines.pop(key, b'') + data).split(b'\n')
+                if lines[-1]:
+                    partial_lines[key] = lines[-1]
+                prefix = f'{key[0]} {key[1]}: '.encode()
+                out.write(b''.join(prefix + line + b'\n' for line in lines[:-1]))
+            out.flush()
+        elif command == 'dropped':
+            print(f'[{metadata["bytes"]} bytes dropped - too slow]', file=sys.stderr)
+        elif command == 'error':
+            raise Exception(f'Error reply: {metadata}')
+        elif command != 'ok':
+            raise Exception(f'Protocol error - unexpected {command!r}')
@@ -0,0 +1,247 @@
+'''
+Sparse timestamp index of the mirrored files.
+
+While handle_client() appends data, every `sample_interval` bytes the first
+following line with a recognized timestamp is sampled and the pair
+(timestamp, byte offset) is appended to the sidecar file `<name>.tidx`.
+
+A time range query then needs to read only the part of the file between
+the two samples surrounding the requested range. Timestamps in a log file
+are expected to be (mostly) monotonic.
+
+Timestamps without timezone are treated as UTC - the same applies to the
+--since and --until arguments of the query, so they match each other.
+'''
+
+from array import array
+from bisect import bisect_left, bisect_right
+from calendar import timegm
+from datetime import datetime, timezone
+from importlib import import_module
+from logging import getLogger
+import re
+import struct
+
+
+logger = getLogger(__name__)
+
+tidx_suffix = '.tidx'
+
+# How many bytes at the beginning of a line are passed to the parsers
+line_head_size = 64
+
+
+iso_re = re.compile(
+    rb'^\[?(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:[.,](\d{1,9}))?)?\s?(Z|[+-]\d\d:?\d\d)?')
+
+
+def parse_iso_timestamp(line):
+    '''
+    2021-02-22 17:00:00, 2021-02-22T17:00:00.123+01:00, [2021-02-22 17:00:00,123] ...
+    '''
+    m = iso_re.match(line)
+    if not m:
+        return None
+    year, month, day, hour, minute, second, fraction, tz = m.groups()
+    ts = timegm((int(year), int(month), int(day), int(hour), int(minute), int(second or 0)))
+    if fraction:
+        ts += int(fraction) / 10 ** len(fraction)
+    if tz and tz != b'Z':
+        sign = -1 if tz[:1] == b'-' else 1
+        tz = tz[1:].replace(b':', b'')
+        ts -= sign * (int(tz[:2]) * 3600 + int(tz[2:]) * 60)
+    return ts
+
+
+syslog_re = re.compile(rb'^(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) +(\d{1,2}) (\d\d):(\d\d):(\d\d)')
+
+syslog_months = [b'Jan', b'Feb', b'Mar', b'Apr', b'May', b'Jun', b'Jul', b'Aug', b'Sep', b'Oct', b'Nov', b'Dec']
+
+
+def parse_syslog_timestamp(line):
+    '''
+    Feb 22 17:00:00 - the year is not present, so the most recent one is assumed.
+    '''
+    m = syslog_re.match(line)
+    if not m:
+        return None
+    month, day, hour, minute, second = m.groups()
+    now = datetime.now(timezone.utc)
+    t = (syslog_months.index(month) + 1, int(day), int(hour), int(minute), int(second))
+    ts = timegm((now.year, *t))
+    if ts > now.timestamp() + 86400:
+        ts = timegm((now.year - 1, *t))
+    return ts
+
+
+epoch_re = re.compile(rb'^\[?(1\d{9})(?:\.(\d{1,9}))?\b')
+
+
+def parse_epoch_timestamp(line):
+    '''
+    1614013200 or 1614013200.123 (Unix time)
+    '''
+    m = epoch_re.match(line)
+    if not m:
+        return None
+    seconds, fraction = m.groups()
+    ts = int(seconds)
+    if fraction:
+        ts += int(fraction) / 10 ** len(fraction)
+    return ts
+
+
+timestamp_parsers = {
+    'iso': parse_iso_timestamp,
+    'syslog': parse_syslog_timestamp,
+    'epoch': parse_epoch_timestamp,
+}
+
+
+def get_timestamp_parser(names):
+    '''
+    Return function that tries the given parsers in order.
+    Besides the built-in names, a parser can be given as "module:function".
+    '''
+    parsers = []
+    for name in names:
+        if name in timestamp_parsers:
+            parsers.append(timestamp_parsers[name])
+        elif ':' in name:
+            module_name, func_name = name.split(':', 1)
+            parsers.append(getattr(import_module(module_name), func_name))
+        else:
+            raise Exception(f'Unknown timestamp parser: {name}')
+
+    if len(parsers) == 1:
+        return parsers[0]
+
+    def parse_timestamp(line):
+        for parser in parsers:
+            ts = parser(line)
+            if ts is not None:
+                return ts
+        return None
+
+    return parse_timestamp
+
+
+class TimeIndexWriter:
+    '''
+    Maintains the .tidx file while data is being appended to the mirror file.
+    '''
+
+    record = struct.Struct('<dQ')
+
+    def __init__(self, path, parse_timestamp, sample_interval):
+        self.path = path
+        self.parse_timestamp = parse_timestamp
+        self.sample_interval = sample_interval
+        self.f = None
+        self.next_sample_offset = 0
+        self.after_newline = False
+
+    @classmethod
+    def for_storage(cls, conf, storage):
+        return cls(
+            storage.path.with_name(storage.path.name + tidx_suffix),
+            get_timestamp_parser(conf.time_index_parsers),
+            conf.time_index_sample_interval)
+
+    def open(self, length):
+        self.f = self.path.open('ab+')
+        size = self.f.seek(0, 2)
+        size -= size % self.record.size
+        while size:
+            self.f.seek(size - self.record.size)
+            ts, offset = self.record.unpack(self.f.read(self.record.size))
+            if offset < length:
+                self.next_sample_offset = offset + self.sample_interval
+                break
+            # the mirror file is shorter than when this sample was taken (crash recovery)
+            size -= self.record.size
+        self.f.truncate(size)
+        # We do not know whether the data on disk end with a newline;
+        # in that case just the first (possibly partial) line is skipped.
+        self.after_newline = length == 0
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def update(self, offset, data):
+        '''
+        Called with every chunk of data appended to the mirror file at given offset.
+        '''
+        pos = max(0, self.next_sample_offset - offset)
+        records = []
+        while pos < len(data):
+            if pos == 0 and self.after_newline:
+                line_start = 0
+            else:
+                nl = data.find(b'\n', pos - 1 if pos else 0)
+                if nl == -1:
+                    break
+                line_start = nl + 1
+            ts = self.parse_timestamp(data[line_start:line_start + line_head_size])
+            if ts is None:
+                pos = line_start + 1
+                continue
+            records.append(self.record.pack(ts, offset + line_start))
+            self.next_sample_offset = offset + line_start + self.sample_interval
+            pos = self.next_sample_offset - offset
+        if data:
+            self.after_newline = data.endswith(b'\n')
+        if records:
+            self.f.write(b''.join(records))
+            self.f.flush()
+
+
+class TimeIndex:
+    '''
+    Loaded .tidx file, used for queries.
+    '''
+
+    def __init__(self, path):
+        self.timestamps = array('d')
+        self.offsets = array('Q')
+        try:
+            index_bytes = path.read_bytes()
+        except FileNotFoundError:
+            return
+        record = TimeIndexWriter.record
+        for ts, offset in record.iter_unpack(index_bytes[:len(index_bytes) - len(index_bytes) % record.size]):
+            self.timestamps.append(ts)
+            self.offsets.append(offset)
+
+    def byte_range(self, since, until, length):
+        '''
+        Return (start, end) offsets of the part of the file that can contain
+        lines with timestamps between since and until.
+        '''
+        start, end = 0, length
+        if since is not None:
+            i = bisect_left(self.timestamps, since)
+            if i > 0:
+                start = self.offsets[i - 1]
+        if until is not None:
+            i = bisect_right(self.timestamps, until)
+            if i < len(self.offsets):
+                end = min(end, self.offsets[i])
+        return start, max(start, end)
+
+
+def parse_query_time(s, now=None):
+    '''
+    Parse --since/--until value: ISO datetime, HH:MM[:SS] (today) or Unix time.
+    '''
+    if re.match(r'^\d+(\.\d+)?$', s):
+        return float(s)
+    if re.match(r'^\d\d:\d\d(:\d\d)?$', s):
+        now = now or datetime.now(timezone.utc)
+        s = now.strftime('%Y-%m-%d ') + s
+    ts = parse_iso_timestamp(s.encode())
+    if ts is None:
+        raise ValueError(f'Invalid time: {s}')
+    return ts
@@ -0,0 +1,108 @@
+'''
+Low-overhead diagnostics for production.
+
+Trace points: handle_client() calls trace.start(name) and trace.stop(name, t0)
+around the per-chunk work. Every call is counted, but only every
+`sample_every`-th call is timed. The counters are in /metrics.
+
+Profiler: on SIGUSR1 the event loop thread is profiled by cProfile for
+`profiler.duration` seconds and the result is written to
+`profiler.directory` - a .prof file (for pstats, snakeviz...) and a .txt
+summary with the trace counters.
+'''
+
+from asyncio import get_running_loop
+import cProfile
+from datetime import datetime
+from logging import getLogger
+import os
+import pstats
+from time import perf_counter
+
+
+logger = getLogger(__name__)
+
+
+class Trace:
+
+    def __init__(self, sample_every=64):
+        self.sample_every = sample_every
+        self.points = {} # name -> [calls, sampled calls, sampled seconds]
+
+    def start(self, name):
+        '''
+        Count the call; return start time if this call is sampled, otherwise None.
+        '''
+        point = self.points.get(name)
+        if point is None:
+            point = self.points[name] = [0, 0, 0.0]
+        point[0] += 1
+        if point[0] % self.sample_every == 1:
+            return perf_counter()
+        return None
+
+    def stop(self, name, t0):
+        if t0 is not None:
+            point = self.points[name]
+            point[1] += 1
+            point[2] += perf_counter() - t0
+
+    def summary(self):
+        '''
+        Return list of (name, calls, estimated total seconds).
+        '''
+        return [
+            (name, calls, sampled_seconds / sampled * calls if sampled else 0)
+            for name, (calls, sampled, sampled_seconds) in sorted(self.points.items())
+        ]
+
+    def prometheus_lines(self):
+        summary = self.summary()
+        lines = ['# TYPE logline_trace_calls_total counter']
+        for name, calls, seconds in summary:
+            lines.append(f'logline_trace_calls_total{{point="{name}"}} {calls}')
+        lines.append('# TYPE logline_trace_seconds_total counter')
+        for name, calls, seconds in summary:
+            lines.append(f'logline_trace_seconds_total{{point="{name}"}} {seconds:.6f}')
+        return lines
+
+
+trace = Trace()
+
+
+class Profiler:
+
+    def __init__(self, name, directory, duration):
+        self.name = name
+        self.directory = directory
+        self.duration = duration
+        self.profile = None
+
+    def start(self):
+        '''
+        Called from the signal handler in the event loop thread.
+        '''
+        if self.profile:
+            logger.info('Profiler is already running')
+            return
+        logger.info('Profiling for %s s', self.duration)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        get_running_loop().call_later(self.duration, self.stop)
+
+    def stop(self):
+        profile, self.profile = self.profile, None
+        profile.disable()
+        base_path = self.directory / '{}-{}-{}'.format(
+            self.name, os.getpid(), datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'))
+        try:
+            profile.dump_stats(f'{base_path}.prof')
+            with open(f'{base_path}.txt', 'w') as f:
+                for name, calls, seconds in trace.summary():
+                    print(f'{name:20} {calls:12} calls {seconds:12.3f} s', file=f)
+                print(file=f)
+                pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(60)
+        except Exception as e:
+            logger.exception('Failed to write profile %s: %r', base_path, e)
+        else:
+            logger.info('Profile written to %s.prof and %s.txt', base_path, base_path)
@@ -1,5 +1,13 @@
 import asyncio
 from functools import partial
+import io
+from logging import getLogger
+import lzma
+import socket
+import zlib
+
+
+logger = getLogger(__name__)
 
 
 try:
@@ -12,19 +20,145 @@ except ImportError:
         return await loop.run_in_executor(None, partial(func, *args, **kwargs))
 
 
-async def decompress_zst(compressed_data):
+def decompress_gzip(data, max_size):
+    '''
+    Like gzip.decompress(), but fails when the result would be larger than max_size.
+    '''
+    d = zlib.decompressobj(wbits=31)
+    result = d.decompress(data, max_size)
+    if d.unconsumed_tail:
+        raise Exception(f'Decompressed data larger than {max_size} bytes')
+    if not d.eof:
+        raise Exception('Incomplete gzip data')
+    return result
+
+
+def decompress_lzma(data, max_size):
+    d = lzma.LZMADecompressor()
+    result = d.decompress(data, max_size)
+    if not d.eof:
+        raise Exception(f'Incomplete lzma data or decompressed data larger than {max_size} bytes')
+    return result
+
+
+async def decompress_zst(compressed_data, max_size):
     assert isinstance(compressed_data, bytes)
     try:
         # https://python-zstandard.readthedocs.io/
         import zstandard
-        return await to_thread(zstandard.decompress, compressed_data)
     except ImportError:
         pass
+    else:
+        return await to_thread(_decompress_zstandard, compressed_data, max_size)
     try:
         # https://github.com/sergey-dryabzhinsky/python-zstd
         # https://packages.debian.org/bullseye/python3-zstd
         import zstd
-        return await to_thread(zstd.decompress, compressed_data)
     except ImportError:
         pass
+    else:
+        # python-zstd has no way to limit the output size - install zstandard
+        # to stop large decompressed data before they are allocated
+        result = await to_thread(zstd.decompress, compressed_data)
+        if len(result) > max_size:
+            raise Exception(f'Decompressed data larger than {max_size} bytes')
+        return result
     raise Exception('Zstandard decompression is not available - please install zstandard or zstd')
+
+
+def _decompress_zstandard(data, max_size):
+    '''
+    Like zstandard.decompress(), but fails when the result would be larger than max_size.
+    The frame header content size is not trusted, the output is read by a bounded stream reader.
+    '''
+    import zstandard
+    reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True)
+    result = reader.read(max_size + 1)
+    if len(result) > max_size:
+        raise Exception(f'Decompressed data larger than {max_size} bytes')
+    return result
+
+
+event_loops = ('asyncio', 'uvloop')
+
+
+def install_event_loop(name):
+    '''
+    Use uvloop (if name is "uvloop" and it is installed) for the event loops created by asyncio.run().
+    '''
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning('uvloop is not installed, using the default asyncio event loop')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.debug('Using uvloop %s', uvloop.__version__)
+
+
+def zst_compress_frame(data, level=3):
+    '''
+    Compress data into a single, independently decompressible zstd frame.
+    '''
+    assert isinstance(data, bytes)
+    try:
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    except ImportError:
+        pass
+    try:
+        import zstd
+        return zstd.compress(data, level)
+    except ImportError:
+        pass
+    raise Exception('Zstandard compression is not available - please install zstandard or zstd')
+
+
+def zst_decompress_frame(frame):
+    '''
+    Decompress a single zstd frame; works also for frames without content size in header.
+    '''
+    assert isinstance(frame, bytes)
+    try:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(frame)
+    except ImportError:
+        pass
+    try:
+        import zstd
+        return zstd.decompress(frame)
+    except ImportError:
+        pass
+    raise Exception('Zstandard decompression is not available - please install zstandard or zstd')
+
+
+def is_single_zst_frame(data, expected_size):
+    '''
+    Return True if data are exactly one complete zstd frame that decompresses
+    to expected_size bytes - only such data can be stored as one indexed frame.
+    '''
+    try:
+        import zstandard
+    except ImportError:
+        # python-zstd cannot tell where the first frame ends
+        return False
+    dobj = zstandard.ZstdDecompressor().decompressobj()
+    try:
+        result = dobj.decompress(data)
+    except zstandard.ZstdError:
+        return False
+    return dobj.eof and not dobj.unused_data and len(result) == expected_size
+
+
+def set_tcp_keepalive(sock, idle=60, interval=10, count=6):
+    '''
+    Enable TCP keepalive, so that connections from peers that disappeared
+    without closing the connection are detected (options are Linux specific).
+    '''
+    if sock is None:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
@@ -0,0 +1,38 @@
+'''
+Range hashes for verification of the mirrored file against the original.
+
+The agent sends `hashes` with a list of byte ranges and compares the returned
+hashes with hashes of the same ranges of the original file. Ranges that differ
+are split and asked for again (a Merkle tree computed on demand), until the
+divergent regions are small enough to be re-sent with `"repair": true`.
+'''
+
+import hashlib
+
+
+# Maximum number of ranges in one `hashes` command
+max_ranges = 256
+
+read_block_size = 2**20
+
+
+def range_hash(f, start, end):
+    '''
+    Return hex hash of the bytes [start, end) of the storage object (shorter if the file is shorter).
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    pos = start
+    while pos < end:
+        data = f.read_at(pos, min(read_block_size, end - pos))
+        if not data:
+            break
+        h.update(data)
+        pos += len(data)
+    return h.hexdigest()
+
+
+def hash_ranges(f, ranges):
+    from .main import ProtocolError
+    if len(ranges) > max_ranges:
+        raise ProtocolError(f'Too many ranges: {len(ranges)}')
+    return [range_hash(f, start, end) for start, end in ranges]
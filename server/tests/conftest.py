@@ -0,0 +1,69 @@
+from argparse import Namespace
+from asyncio import open_connection, start_server, wait_for
+from contextlib import asynccontextmanager
+from functools import partial
+import hashlib
+
+from pytest import fixture
+
+from logline_server.configuration import Configuration
+from logline_server.main import handle_client, recv_command, send_command
+
+
+client_token = 'topsecret'
+
+
+@fixture
+def make_conf(tmp_path):
+    def make_conf(**kwargs):
+        args = Namespace(
+            conf=None, log=None, bind=None, dest=str(tmp_path),
+            tls_cert=None, tls_key=None, tls_key_password_file=None,
+            client_token_hash=[hashlib.sha1(client_token.encode()).hexdigest()],
+            storage=None)
+        conf = Configuration(args=args)
+        for k, v in kwargs.items():
+            assert hasattr(conf, k)
+            setattr(conf, k, v)
+        return conf
+    return make_conf
+
+
+@fixture
+def serve():
+    '''
+    Run handle_client() on a local port: `async with serve(conf, **handle_client_kwargs) as port`
+    '''
+    @asynccontextmanager
+    async def serve(conf, port=0, **kwargs):
+        server = await start_server(partial(handle_client, conf, **kwargs), '127.0.0.1', port)
+        async with server:
+            yield server.sockets[0].getsockname()[1]
+    return serve
+
+
+async def send(reader, writer, command, metadata, data=None):
+    send_command(writer, command, metadata, data)
+    await writer.drain()
+    return await wait_for(recv_command(reader), 5)
+
+
+async def handshake(port, path='/var/log/app.log', prefix_sha1='x', **header):
+    '''
+    Connect as an agent; return reader, writer and the handshake reply.
+    '''
+    reader, writer = await open_connection('127.0.0.1', port)
+    reply = await send(reader, writer, 'logline-agent-v1', {
+        'hostname': 'host1',
+        'path': path,
+        'prefix': {'length': 1, 'sha1': prefix_sha1},
+        'auth': {'client_token': client_token},
+        **header,
+    })
+    return reader, writer, reply
+
+
+async def connect(port, **kwargs):
+    reader, writer, reply = await handshake(port, **kwargs)
+    assert reply[0] == 'ok', reply
+    return reader, writer
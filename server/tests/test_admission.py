@@ -0,0 +1,56 @@
+from asyncio import create_task, run, sleep, wait_for
+
+from logline_server.admission import AdmissionControl, AdmissionRejected, RateLimiter
+
+from conftest import handshake
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(1000)
+    assert limiter.consume(600) == 0
+    assert limiter.consume(400) == 0
+    assert 0.49 < limiter.consume(500) <= 0.5
+
+
+def test_admission_queue(make_conf):
+    conf = make_conf(limits_max_connections_per_host=1, limits_queue_timeout=0.5)
+
+    async def main():
+        admission = AdmissionControl(conf)
+        await admission.admit('t', 'host1')
+        await admission.admit('t', 'host2')
+        waiting = create_task(admission.admit('t', 'host1'))
+        await sleep(0.05)
+        assert not waiting.done()
+        await admission.release('t', 'host1')
+        await wait_for(waiting, 1)
+        try:
+            await admission.admit('t', 'host1')
+        except AdmissionRejected as e:
+            assert e.retry_after == 30
+        else:
+            assert 0, 'expected AdmissionRejected'
+
+    run(main())
+
+
+def test_connection_limit_error_reply(make_conf, serve):
+    conf = make_conf(limits_max_connections=1, limits_retry_after=5)
+
+    async def main():
+        admission = AdmissionControl(conf)
+        async with serve(conf, admission=admission) as port:
+            reader1, writer1, reply = await handshake(port, path='/var/log/a.log')
+            assert reply[0] == 'ok'
+            reader2, writer2, reply = await handshake(port, path='/var/log/b.log')
+            assert reply == ('error', {'error': 'Too many connections', 'retry_after': 5}, None)
+            writer1.close()
+            for _ in range(100):
+                if not admission.connections:
+                    break
+                await sleep(0.01)
+            reader3, writer3, reply = await handshake(port, path='/var/log/b.log')
+            assert reply[0] == 'ok'
+            writer3.close()
+
+    run(main())
@@ -0,0 +1,63 @@
+from logline_server.bloom_index import BloomIndex, BloomIndexWriter
+from logline_server.search import plan_search, search_ranges
+
+
+def write_indexed_file(tmp_path, content, chunk_size=1000, segment_size=4096):
+    path = tmp_path / 'app.log'
+    path.write_bytes(content)
+    writer = BloomIndexWriter(tmp_path / 'app.log.bloom', segment_size=segment_size, filter_size=1024, hash_count=4)
+    writer.open(0)
+    # chunks do not respect token boundaries
+    for i in range(0, len(content), chunk_size):
+        writer.update(i, content[i:i + chunk_size])
+    writer.close()
+    return path
+
+
+def test_bloom_index_finds_only_relevant_segments(tmp_path):
+    content = b''.join(b'2021-02-22 17:00:00 request req-%08d done\n' % i for i in range(5000))
+    path = write_indexed_file(tmp_path, content)
+    index = BloomIndex(tmp_path / 'app.log.bloom')
+    assert index.segment_count == len(content) // 4096 + 1
+    needle_offset = content.index(b'req-00003227')
+    assert 1000 < needle_offset % 4096 < 3000
+    assert index.candidate_segments(b'REQ-00003227', len(content)) == [needle_offset // 4096]
+    tasks = plan_search(path, b'req-00003227')
+    assert tasks == [[(needle_offset // 4096 * 4096, (needle_offset // 4096 + 1) * 4096)]]
+    assert search_ranges(path, tasks[0], b'req-00003227') == [
+        (content.rindex(b'\n', 0, needle_offset) + 1, b'2021-02-22 17:00:00 request req-00003227 done'),
+    ]
+    # whole tokens only
+    assert search_ranges(path, tasks[0], b'req-0000322') == []
+
+
+def test_bloom_index_marks_unindexed_data(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_bytes(b'x' * 10000)
+    writer = BloomIndexWriter(tmp_path / 'app.log.bloom', segment_size=4096, filter_size=64, hash_count=4)
+    writer.open(10000)
+    writer.update(10000, b' needle\n')
+    writer.close()
+    index = BloomIndex(tmp_path / 'app.log.bloom')
+    # data before the index was created may contain anything
+    assert index.candidate_segments(b'something', 10008) == [0, 1, 2]
+    assert index.candidate_segments(b'needle', 10008) == [0, 1, 2]
+
+
+def test_bloom_index_token_split_across_segments(tmp_path):
+    content = b'a' * 4090 + b' needle-token\n'
+    path = write_indexed_file(tmp_path, content, chunk_size=7)
+    index = BloomIndex(tmp_path / 'app.log.bloom')
+    assert index.candidate_segments(b'needle-token', len(content)) == [0]
+    tasks = plan_search(path, b'needle-token')
+    assert search_ranges(path, tasks[0], b'needle-token') == [(0, content[:-1])]
+
+
+def test_bloom_index_long_token(tmp_path):
+    content = b'x ' + b'A' * 5000 + b' needle\n'
+    path = write_indexed_file(tmp_path, content, chunk_size=100)
+    index = BloomIndex(tmp_path / 'app.log.bloom')
+    assert index.candidate_segments(b'needle', len(content)) == [1]
+    assert index.candidate_segments(b'A' * 100, len(content)) == [0]
+    tasks = plan_search(path, b'needle')
+    assert search_ranges(path, tasks[0], b'needle') == [(0, content[:-1])]
@@ -0,0 +1,49 @@
+from asyncio import create_task, run, sleep
+import gzip
+
+from pytest import importorskip, raises
+
+from logline_server.buffers import ReceiveBudget
+from logline_server.util import decompress_gzip, decompress_zst
+
+
+def test_receive_budget():
+
+    async def main():
+        budget = ReceiveBudget(100)
+        await budget.acquire(60)
+        waiting = create_task(budget.acquire(60))
+        await sleep(0.01)
+        assert not waiting.done()
+        assert budget.waits == 1
+        budget.release(60)
+        await waiting
+        assert budget.used == 60
+        budget.release(60)
+        # larger than the whole budget - allowed when nothing else is held
+        await budget.acquire(500)
+        assert budget.peak == 500
+        budget.release(500)
+        assert budget.used == 0
+
+    run(main())
+
+
+def test_decompress_gzip_limit():
+    data = gzip.compress(b'x' * 10000)
+    assert decompress_gzip(data, 10000) == b'x' * 10000
+    with raises(Exception):
+        decompress_gzip(data, 9999)
+
+
+def test_decompress_zst_limit():
+    zstandard = importorskip('zstandard')
+    # the frame header declares the content size, it must not be trusted
+    bomb = zstandard.ZstdCompressor().compress(b'x' * 10**8)
+    assert len(bomb) < 10**4
+    with raises(Exception, match='larger than'):
+        run(decompress_zst(bomb, 2**20))
+    data = zstandard.ZstdCompressor().compress(b'x' * 10000)
+    assert run(decompress_zst(data, 10000)) == b'x' * 10000
+    with raises(Exception):
+        run(decompress_zst(data, 9999))
@@ -0,0 +1,98 @@
+from asyncio import create_task, run, sleep
+import os
+from types import SimpleNamespace
+
+from pytest import importorskip
+
+from logline_server.compaction import apply_retention, compact_file, find_compactable_files, run_compaction
+from logline_server.storage import open_for_reading
+
+
+def make_conf(tmp_path, max_age_days=None, max_bytes_per_host=None):
+    return SimpleNamespace(
+        destination_directory=tmp_path,
+        retention_max_age_days=max_age_days,
+        retention_max_bytes_per_host=max_bytes_per_host)
+
+
+def set_age(path, days):
+    t = path.stat().st_mtime - days * 86400
+    os.utime(path, (t, t))
+
+
+def test_compact_rotated_file(tmp_path):
+    importorskip('zstandard')
+    (tmp_path / 'host').mkdir()
+    content = b''.join(b'2021-02-22 17:00:00 Line %d\n' % i for i in range(10000))
+    (tmp_path / 'host' / 'app.log').write_bytes(b'live')
+    (tmp_path / 'host' / 'app.log.rotated-20210222T170000Z').write_bytes(content)
+    paths = list(find_compactable_files(tmp_path, min_age=0))
+    assert paths == [tmp_path / 'host' / 'app.log.rotated-20210222T170000Z']
+    compact_file(paths[0])
+    assert sorted(p.name for p in (tmp_path / 'host').iterdir()) == [
+        'app.log',
+        'app.log.rotated-20210222T170000Z.zst',
+        'app.log.rotated-20210222T170000Z.zst.idx',
+    ]
+    f = open_for_reading(tmp_path / 'host' / 'app.log.rotated-20210222T170000Z.zst')
+    assert f.read_at(0, f.length) == content
+    f.close()
+    assert list(find_compactable_files(tmp_path, min_age=0)) == []
+
+
+def test_retention_max_age(tmp_path):
+    (tmp_path / 'host').mkdir()
+    (tmp_path / 'host' / 'app.log').write_bytes(b'live')
+    (tmp_path / 'host' / 'app.log.rotated-1').write_bytes(b'old')
+    (tmp_path / 'host' / 'app.log.rotated-2').write_bytes(b'new')
+    set_age(tmp_path / 'host' / 'app.log', 100)
+    set_age(tmp_path / 'host' / 'app.log.rotated-1', 40)
+    apply_retention(make_conf(tmp_path, max_age_days=30))
+    assert sorted(p.name for p in (tmp_path / 'host').iterdir()) == ['app.log', 'app.log.rotated-2']
+
+
+def test_retention_max_bytes_per_host(tmp_path):
+    (tmp_path / 'host').mkdir()
+    (tmp_path / 'host' / 'app.log').write_bytes(b'x' * 100)
+    for i in range(1, 4):
+        (tmp_path / 'host' / f'app.log.rotated-{i}').write_bytes(b'x' * 100)
+        set_age(tmp_path / 'host' / f'app.log.rotated-{i}', 10 - i)
+    apply_retention(make_conf(tmp_path, max_bytes_per_host=250))
+    assert sorted(p.name for p in (tmp_path / 'host').iterdir()) == ['app.log', 'app.log.rotated-3']
+
+
+def test_retention_keeps_compaction_temporary_files(tmp_path):
+    (tmp_path / 'host').mkdir()
+    for name in 'app.log.rotated-1.zst.tmp', 'app.log.rotated-1.zst.tmp.idx':
+        (tmp_path / 'host' / name).write_bytes(b'x' * 100)
+        set_age(tmp_path / 'host' / name, 40)
+    apply_retention(make_conf(tmp_path, max_age_days=30, max_bytes_per_host=10))
+    assert sorted(p.name for p in (tmp_path / 'host').iterdir()) == [
+        'app.log.rotated-1.zst.tmp', 'app.log.rotated-1.zst.tmp.idx']
+
+
+def test_run_compaction(tmp_path):
+    importorskip('zstandard')
+    (tmp_path / 'host').mkdir()
+    for i in range(4):
+        (tmp_path / 'host' / f'app.log.rotated-{i}').write_bytes(b'Line %d\n' % i * 1000)
+    conf = SimpleNamespace(
+        destination_directory=tmp_path,
+        compaction_workers=2,
+        compaction_zst_level=3,
+        compaction_min_age=0,
+        compaction_interval=60,
+        retention_max_age_days=None,
+        retention_max_bytes_per_host=None)
+
+    async def wait_until_compacted():
+        task = create_task(run_compaction(conf))
+        for _ in range(200):
+            if len(list((tmp_path / 'host').glob('*.zst'))) == 4:
+                break
+            await sleep(0.05)
+        task.cancel()
+
+    run(wait_until_compacted())
+    assert sorted(p.name for p in (tmp_path / 'host').iterdir()) == [
+        name for i in range(4) for name in (f'app.log.rotated-{i}.zst', f'app.log.rotated-{i}.zst.idx')]
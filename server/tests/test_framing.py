@@ -0,0 +1,42 @@
+from asyncio import run, wait_for
+import gzip
+from zlib import crc32
+
+from logline_server.framing import decode_data_frame_header, encode_data_frame_header, frame_header
+from logline_server.main import recv_command
+
+from conftest import handshake, send
+
+
+def test_data_frame_header_roundtrip():
+    header = encode_data_frame_header(2**40, 1234, 'gzip', 0xdeadbeef)
+    assert len(header) == frame_header.size == 20
+    assert decode_data_frame_header(header) == ({'offset': 2**40, 'compression': 'gzip', 'crc32': 0xdeadbeef}, 1234)
+    assert decode_data_frame_header(encode_data_frame_header(5, 0)) == ({'offset': 5, 'compression': None}, 0)
+
+
+def test_binary_framing(make_conf, serve, tmp_path):
+    conf = make_conf()
+
+    async def main():
+        async with serve(conf) as port:
+            reader, writer, reply = await handshake(port, framing=['binary-v1'])
+            assert reply == ('ok', {'length': 0, 'framing': 'binary-v1'}, None)
+            data = b'hello\n'
+            writer.write(encode_data_frame_header(0, len(data), None, crc32(data)) + data)
+            await writer.drain()
+            assert (await wait_for(recv_command(reader), 5))[0] == 'ok'
+            data = gzip.compress(b'world\n')
+            writer.write(encode_data_frame_header(6, len(data), 'gzip', crc32(b'world\n')) + data)
+            await writer.drain()
+            assert (await wait_for(recv_command(reader), 5))[0] == 'ok'
+            # text commands still work
+            assert (await send(reader, writer, 'data', {'offset': 12}, b'text\n'))[0] == 'ok'
+            # wrong checksum closes the connection
+            writer.write(encode_data_frame_header(17, 4, None, 1234) + b'bad\n')
+            await writer.drain()
+            assert await wait_for(reader.read(), 5) == b''
+            writer.close()
+        assert (tmp_path / 'host1/var~log/app.log').read_bytes() == b'hello\nworld\ntext\n'
+
+    run(main())
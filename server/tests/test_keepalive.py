@@ -0,0 +1,74 @@
+from asyncio import run, sleep, wait_for
+
+from pytest import importorskip
+
+from logline_server.buffers import ReceiveBudget
+from logline_server.main import recv_command, send_command
+from logline_server.storage import open_for_reading
+
+from conftest import connect, send
+
+
+def test_ping_keeps_connection_open(make_conf, serve):
+    conf = make_conf(idle_timeout=0.3)
+
+    async def main():
+        async with serve(conf) as port:
+            reader, writer = await connect(port)
+            for _ in range(4):
+                await sleep(0.15)
+                assert (await send(reader, writer, 'ping', {}))[0] == 'ok'
+            assert (await send(reader, writer, 'bye', {}))[0] == 'ok'
+            assert await wait_for(reader.read(), 5) == b''
+
+    run(main())
+
+
+def test_idle_connection_is_closed(make_conf, serve):
+    conf = make_conf(idle_timeout=0.2)
+
+    async def main():
+        async with serve(conf) as port:
+            reader, writer = await connect(port)
+            assert await wait_for(reader.read(), 5) == b''
+
+    run(main())
+
+
+def test_waiting_for_receive_budget_is_not_idle(make_conf, serve):
+    conf = make_conf(idle_timeout=0.2)
+
+    async def main():
+        budget = ReceiveBudget(100)
+        async with serve(conf, receive_budget=budget) as port:
+            reader, writer = await connect(port)
+            # the budget is used up by other connections
+            await budget.acquire(100)
+            send_command(writer, 'data', {'offset': 0, 'compression': None}, b'hello\n')
+            await writer.drain()
+            await sleep(0.5)
+            budget.release(100)
+            assert (await wait_for(recv_command(reader), 5))[0] == 'ok'
+
+    run(main())
+
+
+def test_ping_writes_buffered_zst_data(make_conf, serve, tmp_path):
+    importorskip('zstandard')
+    conf = make_conf(storage_format='zst', zst_flush_interval=0.1)
+
+    async def main():
+        async with serve(conf) as port:
+            reader, writer = await connect(port)
+            assert (await send(reader, writer, 'data', {'offset': 0, 'compression': None}, b'hello\n'))[0] == 'ok'
+            mirror = open_for_reading(tmp_path / 'host1/var~log/app.log.zst')
+            # buffered for an incomplete frame
+            assert mirror.length == 0
+            await sleep(0.2)
+            assert (await send(reader, writer, 'ping', {}))[0] == 'ok'
+            mirror.refresh()
+            assert mirror.read_at(0, mirror.length) == b'hello\n'
+            mirror.close()
+            writer.close()
+
+    run(main())
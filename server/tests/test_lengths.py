@@ -0,0 +1,53 @@
+from asyncio import open_connection, run
+
+from logline_server.admission import AdmissionControl
+from logline_server.main import build_destination_path, sha1_b64
+
+from conftest import client_token, send
+
+
+def test_lengths_query(make_conf, serve, tmp_path):
+    conf = make_conf()
+    for path, content in ('/var/log/app.log', b'hello world\n'), ('/var/log/other.log', b'something else\n'):
+        dst_path = build_destination_path(tmp_path, 'host1', path)
+        dst_path.parent.mkdir(parents=True, exist_ok=True)
+        dst_path.write_bytes(content)
+
+    async def main():
+        async with serve(conf) as port:
+            reader, writer = await open_connection('127.0.0.1', port)
+            command, metadata, _ = await send(reader, writer, 'logline-lengths-v1', {
+                'hostname': 'host1',
+                'files': [
+                    {'path': '/var/log/app.log', 'prefix': {'length': 5, 'sha1': sha1_b64(b'hello')}},
+                    {'path': '/var/log/other.log', 'prefix': {'length': 5, 'sha1': sha1_b64(b'hello')}},
+                    {'path': '/var/log/missing.log', 'prefix': {'length': 5, 'sha1': sha1_b64(b'hello')}},
+                ],
+                'auth': {'client_token': client_token},
+            })
+            assert command == 'ok'
+            assert metadata == {'lengths': [12, None, None]}
+            writer.close()
+
+    run(main())
+
+
+def test_lengths_query_is_admitted(make_conf, serve):
+    conf = make_conf(limits_max_connections_per_host=1, limits_queue_timeout=0, limits_retry_after=5)
+
+    async def main():
+        admission = AdmissionControl(conf)
+        # another connection of the same host is open
+        await admission.admit('t', 'host1')
+        async with serve(conf, admission=admission) as port:
+            reader, writer = await open_connection('127.0.0.1', port)
+            command, metadata, _ = await send(reader, writer, 'logline-lengths-v1', {
+                'hostname': 'host1',
+                'files': [{'path': '/var/log/app.log', 'prefix': {'length': 5, 'sha1': sha1_b64(b'hello')}}],
+                'auth': {'client_token': client_token},
+            })
+            assert command == 'error'
+            assert metadata['retry_after'] == 5
+            writer.close()
+
+    run(main())
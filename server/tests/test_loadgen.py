@@ -0,0 +1,42 @@
+from argparse import Namespace
+from asyncio import run
+import io
+import os
+
+from logline_server.loadgen import loadgen, percentiles, print_comparison, print_report
+
+from conftest import client_token
+
+
+def test_percentiles():
+    p = percentiles([i / 1000 for i in range(1, 101)])
+    assert p['p50'] == 51
+    assert p['p99'] == 100
+    assert p['max'] == 100
+    assert percentiles([]) is None
+
+
+def test_loadgen_against_server(make_conf, serve, tmp_path):
+    conf = make_conf()
+    args = Namespace(
+        server=None, tls=False, tls_cert=None, hosts=2, files=2, chunk_size=4096,
+        compression='gzip', rate=None, reconnect_every=5, duration=0.5, server_pid=os.getpid())
+
+    async def main():
+        async with serve(conf) as port:
+            args.server = f'127.0.0.1:{port}'
+            return await loadgen(args, client_token)
+
+    report = run(main())
+    results = report['results']
+    assert results['errors'] == 0
+    assert results['chunks_acked'] > 0
+    assert results['connections'] > 4
+    assert results['ack_latency_ms']['p50'] <= results['ack_latency_ms']['max']
+    assert report['server_process']['max_open_fds'] > 0
+    host_dirs = sorted(p.name for p in tmp_path.iterdir() if p.is_dir())
+    assert len(host_dirs) == 2
+    out = io.StringIO()
+    print_report(report, out)
+    print_comparison(report, report, out)
+    assert '+0.0%' in out.getvalue()
@@ -0,0 +1,77 @@
+from asyncio import open_connection, run, sleep, wait_for
+import json
+
+from logline_server.metrics import Histogram, Metrics
+
+from conftest import connect, send
+
+
+def test_histogram_prometheus_lines():
+    h = Histogram(buckets=(0.1, 1))
+    h.observe(0.05)
+    h.observe(0.5)
+    h.observe(5)
+    assert h.prometheus_lines('x', 'codec="gzip"') == [
+        'x_bucket{codec="gzip",le="0.1"} 1',
+        'x_bucket{codec="gzip",le="1"} 2',
+        'x_bucket{codec="gzip",le="+Inf"} 3',
+        'x_sum{codec="gzip"} 5.55',
+        'x_count{codec="gzip"} 3',
+    ]
+
+
+async def http_get(port, path):
+    reader, writer = await open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.0\r\nHost: localhost\r\n\r\n'.encode())
+    await writer.drain()
+    response = await wait_for(reader.read(), 5)
+    writer.close()
+    head, body = response.split(b'\r\n\r\n', 1)
+    return head.split(b'\r\n')[0], body
+
+
+def test_metrics_endpoints(make_conf, serve):
+    conf = make_conf(metrics_enabled=True)
+
+    async def main():
+        metrics = Metrics()
+        async with serve(conf, metrics=metrics) as port:
+            reader, writer = await connect(port)
+            assert (await send(reader, writer, 'data', {'offset': 0}, b'hello\n'))[0] == 'ok'
+
+            status_line, body = await http_get(port, '/metrics')
+            assert status_line == b'HTTP/1.0 200 OK'
+            text = body.decode()
+            assert 'logline_active_connections{host="host1"} 1\n' in text
+            assert 'logline_written_bytes_total 6\n' in text
+            assert 'logline_codec_received_bytes_total{codec="none"} 6\n' in text
+            assert 'logline_write_duration_seconds_count 1\n' in text
+            assert 'logline_destination_last_write_age_seconds{host="host1",path="/var/log/app.log"}' in text
+
+            status_line, body = await http_get(port, '/status')
+            assert status_line == b'HTTP/1.0 200 OK'
+            status = json.loads(body)
+            assert status['active_connections_by_host'] == {'host1': 1}
+            assert status['compression_ratios'] == {'none': 1.0}
+
+            status_line, body = await http_get(port, '/other')
+            assert status_line == b'HTTP/1.0 404 Not Found'
+
+            writer.close()
+            await sleep(0.05)
+            assert metrics.active_connections == {}
+            assert metrics.last_write == {}
+
+    run(main())
+
+
+def test_metrics_endpoints_disabled_by_default(make_conf, serve):
+    conf = make_conf()
+
+    async def main():
+        async with serve(conf) as port:
+            for path in '/metrics', '/status':
+                status_line, body = await http_get(port, path)
+                assert status_line == b'HTTP/1.0 404 Not Found'
+
+    run(main())
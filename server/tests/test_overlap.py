@@ -0,0 +1,30 @@
+from asyncio import run
+
+from conftest import connect, send
+
+
+async def send_data(reader, writer, offset, data):
+    return await send(reader, writer, 'data', {'offset': offset}, data)
+
+
+def test_overlapping_and_missing_data(make_conf, serve, tmp_path):
+    conf = make_conf()
+
+    async def main():
+        async with serve(conf) as port:
+            reader, writer = await connect(port)
+            assert await send_data(reader, writer, 0, b'hello\n') == ('ok', None, None)
+            # retransmission of already stored data
+            assert await send_data(reader, writer, 0, b'hello\n') == ('ok', None, None)
+            # partially overlapping
+            assert await send_data(reader, writer, 3, b'lo\nworld\n') == ('ok', None, None)
+            # gap - the agent is told where to continue
+            assert await send_data(reader, writer, 20, b'later\n') == ('resync', {'length': 12}, None)
+            assert await send_data(reader, writer, 12, b'later\n') == ('ok', None, None)
+            # different data
+            reply = await send_data(reader, writer, 0, b'HELLO\n')
+            assert reply[0] == 'error'
+            writer.close()
+        assert (tmp_path / 'host1/var~log/app.log').read_bytes() == b'hello\nworld\nlater\n'
+
+    run(main())
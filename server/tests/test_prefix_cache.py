@@ -0,0 +1,26 @@
+from logline_server.main import sha1_b64
+from logline_server.prefix_cache import PrefixCache
+from logline_server.storage import PlainFile
+
+
+def test_prefix_cache(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_bytes(b'hello world\n')
+    cache = PrefixCache()
+    f = PlainFile(path)
+    f.open()
+    assert cache.prefix_hash(f, 5) == sha1_b64(b'hello')
+    assert cache.prefix_hash(f, 5) == sha1_b64(b'hello')
+    assert (cache.hits, cache.misses) == (1, 1)
+    # file too short - not cached
+    assert cache.prefix_hash(f, 100) is None
+    assert cache.prefix_hash(f, 100) is None
+    assert cache.misses == 3
+    f.close()
+    # different file at the same path
+    path.rename(tmp_path / 'app.log.rotated')
+    path.write_bytes(b'HELLO WORLD\n')
+    f = PlainFile(path)
+    f.open()
+    assert cache.prefix_hash(f, 5) == sha1_b64(b'HELLO')
+    f.close()
@@ -0,0 +1,136 @@
+from argparse import Namespace
+from asyncio import run, sleep
+import json
+
+from pytest import importorskip, mark
+
+from logline_server.configuration import Configuration
+from logline_server.replication import Replication
+
+from conftest import client_token, connect, send
+
+
+@mark.parametrize('storage_format', ['plain', 'zst'])
+def test_replication_to_downstream_server(make_conf, serve, tmp_path, storage_format):
+    if storage_format == 'zst':
+        importorskip('zstandard')
+    downstream_dir = tmp_path / 'downstream'
+    downstream_dir.mkdir()
+    downstream_conf = make_conf()
+    downstream_conf.destination_directory = downstream_dir
+
+    async def main():
+        async with serve(downstream_conf) as downstream_port:
+            conf = make_conf(
+                replication_destinations=[{'server': f'127.0.0.1:{downstream_port}', 'client_token': client_token}],
+                replication_batch_size=1000,
+                replication_pipeline_depth=3,
+                storage_format=storage_format)
+            replication = Replication(conf)
+            replication.start()
+            async with serve(conf, replication=replication) as port:
+                reader, writer = await connect(port)
+                for offset in range(0, len(content), 3000):
+                    reply = await send(reader, writer, 'data', {'offset': offset}, content[offset:offset + 3000])
+                    assert reply[0] == 'ok'
+                writer.close()
+                replica_path = downstream_dir / 'host1/var~log/app.log'
+                for _ in range(200):
+                    if replica_path.exists() and replica_path.stat().st_size == len(content):
+                        break
+                    await sleep(0.01)
+                assert replica_path.read_bytes() == content
+                destination, = replication.destinations
+                destination.save_cursor(json.dumps(destination.cursor))
+                rel_path = 'host1/var~log/app.log' + ('.zst' if storage_format == 'zst' else '')
+                assert json.loads(destination.cursor_path.read_text()) == {
+                    rel_path: {
+                        'hostname': 'host1', 'path': '/var/log/app.log', 'offset': len(content), 'prefix_length': 1,
+                    },
+                }
+                for task in destination.file_tasks.values():
+                    task.task.cancel()
+                destination.save_task.cancel()
+
+    content = b''.join(b'line %d\n' % i for i in range(1000))
+
+    run(main())
+
+
+def test_destination_paths_are_relative_to_configuration_file(tmp_path, monkeypatch):
+    conf_dir = tmp_path / 'etc'
+    conf_dir.mkdir()
+    (conf_dir / 'downstream-token').write_text('downstream-secret\n')
+    (conf_dir / 'logline-server.yaml').write_text(
+        'dest: data\n'
+        'client_token_hashes: [x]\n'
+        'replication:\n'
+        '  destinations:\n'
+        '    - server: downstream:5645\n'
+        '      client_token_file: downstream-token\n'
+        '      tls_cert: downstream.pem\n')
+    args = Namespace(
+        conf=str(conf_dir / 'logline-server.yaml'), log=None, bind=None, dest=None,
+        tls_cert=None, tls_key=None, tls_key_password_file=None, client_token_hash=None, storage=None)
+    # not relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    conf = Configuration(args=args)
+    assert conf.replication_destinations == [
+        {'server': 'downstream:5645', 'client_token': 'downstream-secret', 'tls_cert': conf_dir / 'downstream.pem'},
+    ]
+
+
+def test_rotated_file_is_replicated_after_outage(make_conf, serve, tmp_path):
+    downstream_dir = tmp_path / 'downstream'
+    downstream_dir.mkdir()
+    downstream_conf = make_conf()
+    downstream_conf.destination_directory = downstream_dir
+
+    async def agent_send(port, content):
+        reader, writer = await connect(port)
+        assert (await send(reader, writer, 'data', {'offset': 0}, content))[0] == 'ok'
+        writer.close()
+
+    async def stop(replication):
+        destination, = replication.destinations
+        destination.save_task.cancel()
+        for task in destination.file_tasks.values():
+            # wait_for() in Python < 3.12 may swallow the cancellation
+            while not task.task.done():
+                task.task.cancel()
+                await sleep(0.01)
+        destination.save_cursor(json.dumps(destination.cursor))
+
+    async def main():
+        # the downstream server is down at first
+        async with serve(downstream_conf) as downstream_port:
+            pass
+        conf = make_conf(
+            replication_destinations=[{'server': f'127.0.0.1:{downstream_port}', 'client_token': client_token}],
+            replication_retry_interval=0.05)
+        replication = Replication(conf)
+        replication.start()
+        async with serve(conf, replication=replication) as port:
+            await agent_send(port, b'a first file\n')
+            # different prefix - the mirror file is rotated
+            await agent_send(port, b'b second file\n')
+            await sleep(0.05)
+        await stop(replication)
+        cursor = json.loads(replication.destinations[0].cursor_path.read_text())
+        assert cursor['host1/var~log/app.log']['rotated'][0]['file'].startswith('host1/var~log/app.log.rotated-')
+        # restart of this server, the downstream server is up again
+        async with serve(downstream_conf, port=downstream_port):
+            replication = Replication(conf)
+            replication.start()
+            replica_path = downstream_dir / 'host1/var~log/app.log'
+            for _ in range(200):
+                if replica_path.exists() and replica_path.read_bytes() == b'b second file\n':
+                    break
+                await sleep(0.01)
+            assert replica_path.read_bytes() == b'b second file\n'
+            rotated_replica, = downstream_dir.glob('host1/var~log/app.log.rotated-*')
+            assert rotated_replica.read_bytes() == b'a first file\n'
+            await stop(replication)
+        assert 'rotated' not in replication.destinations[0].cursor['host1/var~log/app.log']
+
+    run(main())
@@ -0,0 +1,143 @@
+from asyncio import run
+from io import BytesIO
+
+from pytest import importorskip
+
+from logline_server.export import export_range
+from logline_server.storage import PlainFile, SeekableZstdFile, open_for_reading
+
+
+def test_plain_file_write_and_read(tmp_path):
+    f = PlainFile(tmp_path / 'app.log')
+    assert not f.exists()
+    f.open()
+    run(f.write(b'Hello world!\n'))
+    run(f.write(b'Second line\n'))
+    assert f.length == 25
+    assert f.read_at(6, 5) == b'world'
+    f.close()
+    assert (tmp_path / 'app.log').read_bytes() == b'Hello world!\nSecond line\n'
+
+
+def test_seekable_zst_write_and_read(tmp_path):
+    importorskip('zstandard')
+    lines = b''.join(b'2021-02-22 17:00:%02d Line number %d\n' % (i % 60, i) for i in range(5000))
+    f = SeekableZstdFile(tmp_path / 'app.log.zst', frame_size=4096)
+    f.open()
+    for i in range(0, len(lines), 1000):
+        run(f.write(lines[i:i + 1000]))
+    assert f.length == len(lines)
+    assert f.read_at(0, 50) == lines[:50]
+    assert f.read_at(12345, 10000) == lines[12345:22345]
+    assert f.read_at(len(lines) - 10, 100) == lines[-10:]
+    f.close()
+    assert (tmp_path / 'app.log.zst').stat().st_size < len(lines) / 5
+    # reopen - the length and the open tail frame are recovered from the index
+    f = SeekableZstdFile(tmp_path / 'app.log.zst', frame_size=4096)
+    f.open()
+    assert f.length == len(lines)
+    run(f.write(b'Last line\n'))
+    assert f.read_at(0, f.length) == lines + b'Last line\n'
+    f.close()
+
+
+def test_seekable_zst_buffers_incomplete_frame(tmp_path):
+    importorskip('zstandard')
+    f = SeekableZstdFile(tmp_path / 'app.log.zst', frame_size=100)
+    f.open()
+    content = b''.join(b'line %02d\n' % i for i in range(30))
+    for i in range(0, len(content), 8):
+        run(f.write(content[i:i + 8]))
+    # 240 bytes - two full frames, the rest is buffered
+    assert list(f.uncompressed_ends) == [100, 200]
+    assert f.length == 240
+    # across the written frames and the buffer
+    assert f.read_at(190, 20) == content[190:210]
+    f.flush()
+    assert list(f.uncompressed_ends) == [100, 200, 240]
+    f.close()
+
+
+def test_seekable_zst_reader_refresh(tmp_path):
+    importorskip('zstandard')
+    writer = SeekableZstdFile(tmp_path / 'app.log.zst', frame_size=100)
+    writer.open()
+    run(writer.write(b'first line\n'))
+    writer.flush()
+    reader = open_for_reading(tmp_path / 'app.log.zst')
+    assert reader.length == 11
+    run(writer.write(b'x' * 250 + b'\n'))
+    assert reader.length == 11
+    reader.refresh()
+    assert reader.length == 211
+    writer.close()
+    reader.refresh()
+    assert reader.length == 262
+    assert reader.read_at(0, reader.length) == b'first line\n' + b'x' * 250 + b'\n'
+    reader.close()
+
+
+def test_seekable_zst_reuses_received_frame(tmp_path):
+    zstandard = importorskip('zstandard')
+    data = b'Hello world!\n' * 100
+    frame = zstandard.ZstdCompressor().compress(data)
+    f = SeekableZstdFile(tmp_path / 'app.log.zst', frame_size=1000)
+    f.open()
+    run(f.write(data, zst_frame=frame))
+    assert f.compressed_length == len(frame)
+    assert f.read_at(0, f.length) == data
+    f.close()
+
+
+def test_seekable_zst_recompresses_received_multiple_frames(tmp_path):
+    zstandard = importorskip('zstandard')
+    data = b'Hello world!\n' * 100
+    frames = zstandard.ZstdCompressor().compress(data[:600]) + zstandard.ZstdCompressor().compress(data[600:])
+    f = SeekableZstdFile(tmp_path / 'app.log.zst', frame_size=1000)
+    f.open()
+    run(f.write(data, zst_frame=frames))
+    assert f.read_at(0, f.length) == data
+    f.close()
+    f = SeekableZstdFile(tmp_path / 'app.log.zst', frame_size=1000)
+    f.open()
+    assert f.length == len(data)
+    assert f.read_at(0, f.length) == data
+    f.close()
+
+
+def test_seekable_zst_drops_incomplete_frame(tmp_path):
+    importorskip('zstandard')
+    f = SeekableZstdFile(tmp_path / 'app.log.zst', frame_size=16)
+    f.open()
+    run(f.write(b'0123456789abcdef' * 2))
+    f.close()
+    # simulate crash in the middle of writing the last frame
+    with (tmp_path / 'app.log.zst').open('rb+') as raw:
+        raw.truncate(raw.seek(0, 2) - 3)
+    f = SeekableZstdFile(tmp_path / 'app.log.zst', frame_size=16)
+    f.open()
+    assert f.length == 16
+    assert f.read_at(0, 100) == b'0123456789abcdef'
+    f.close()
+
+
+def test_seekable_zst_rotate(tmp_path):
+    importorskip('zstandard')
+    f = SeekableZstdFile(tmp_path / 'app.log.zst')
+    f.open()
+    run(f.write(b'Hello world!\n'))
+    f.close()
+    f.rotate('.rotated-20210222T170000Z')
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'app.log.rotated-20210222T170000Z.zst',
+        'app.log.rotated-20210222T170000Z.zst.idx',
+    ]
+
+
+def test_export_range(tmp_path):
+    (tmp_path / 'app.log').write_bytes(b'Hello world!\nSecond line\n')
+    f = open_for_reading(tmp_path / 'app.log')
+    out = BytesIO()
+    export_range(f, 13, 6, out)
+    f.close()
+    assert out.getvalue() == b'Second'
@@ -0,0 +1,73 @@
+from asyncio import open_connection, run, sleep, wait_for
+
+from pytest import raises
+
+from logline_server.main import recv_command
+from logline_server.subscriptions import Subscriber, SubscriptionHub, tail_main
+
+from conftest import client_token, connect, send
+
+
+def test_subscriber_matches_globs():
+    s = Subscriber(['web*'], ['/var/log/nginx/*'], 1000, 'drop')
+    assert s.matches('web1', '/var/log/nginx/access.log')
+    assert not s.matches('db1', '/var/log/nginx/access.log')
+    assert not s.matches('web1', '/var/log/syslog')
+
+
+def test_subscriber_drop_policy():
+    s = Subscriber(['*'], ['*'], 10, 'drop')
+    s.push('h', '/p', 0, b'12345678')
+    s.push('h', '/p', 8, b'12345678')
+    assert s.buffered_bytes == 8
+    assert s.dropped_bytes == 8
+    assert not s.overflowed
+
+
+def test_subscriber_disconnect_policy():
+    s = Subscriber(['*'], ['*'], 10, 'disconnect')
+    s.push('h', '/p', 0, b'12345678')
+    s.push('h', '/p', 8, b'12345678')
+    assert s.overflowed
+
+
+def test_subscriber_receives_appended_data(make_conf, serve):
+    conf = make_conf()
+
+    async def main():
+        hub = SubscriptionHub()
+        async with serve(conf, subscriptions=hub) as port:
+            sub_reader, sub_writer = await open_connection('127.0.0.1', port)
+            reply = await send(sub_reader, sub_writer, 'logline-subscribe-v1', {
+                'auth': {'client_token': client_token},
+                'hosts': ['host*'],
+            })
+            assert reply[0] == 'ok'
+            agent_reader, agent_writer = await connect(port)
+            reply = await send(agent_reader, agent_writer, 'data', {'offset': 0, 'compression': None}, b'Hello!\n')
+            assert reply[0] == 'ok'
+            command, metadata, data = await wait_for(recv_command(sub_reader), 5)
+            assert command == 'data'
+            assert metadata == {'hostname': 'host1', 'path': '/var/log/app.log', 'offset': 0}
+            assert data == b'Hello!\n'
+            agent_writer.close()
+            # whatever the subscriber sends is ignored until it disconnects
+            sub_writer.write(b'garbage' * 1000)
+            await sub_writer.drain()
+            await sleep(0.05)
+            assert len(hub.subscribers) == 1
+            sub_writer.close()
+            for _ in range(100):
+                if not hub.subscribers:
+                    break
+                await sleep(0.01)
+            assert not hub.subscribers
+
+    run(main())
+
+
+def test_tail_without_client_token(monkeypatch, capsys):
+    monkeypatch.delenv('CLIENT_TOKEN', raising=False)
+    with raises(SystemExit):
+        tail_main(['--server', '127.0.0.1:5645'])
+    assert 'Client token is not configured' in capsys.readouterr().err
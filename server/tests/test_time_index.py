@@ -0,0 +1,81 @@
+from datetime import datetime, timezone
+from io import BytesIO
+
+from logline_server.storage import PlainFile
+from logline_server.time_index import (
+    TimeIndex, TimeIndexWriter, get_timestamp_parser,
+    parse_epoch_timestamp, parse_iso_timestamp, parse_query_time, parse_syslog_timestamp)
+from logline_server.query import find_mirror_files, query_file
+
+
+def ts(s):
+    return datetime.fromisoformat(s).replace(tzinfo=timezone.utc).timestamp()
+
+
+def test_parse_iso_timestamp():
+    assert parse_iso_timestamp(b'2021-02-22 17:00:00 Hello') == ts('2021-02-22 17:00:00')
+    assert parse_iso_timestamp(b'2021-02-22T17:00:00.250Z Hello') == ts('2021-02-22 17:00:00.250')
+    assert parse_iso_timestamp(b'[2021-02-22 17:00:00,5] Hello') == ts('2021-02-22 17:00:00.5')
+    assert parse_iso_timestamp(b'2021-02-22T18:00:00+01:00 Hello') == ts('2021-02-22 17:00:00')
+    assert parse_iso_timestamp(b'Hello 2021-02-22 17:00:00') is None
+
+
+def test_parse_syslog_and_epoch_timestamp():
+    assert parse_syslog_timestamp(b'Jan  1 00:00:00 host app: Hello') is not None
+    assert parse_syslog_timestamp(b'2021-02-22 17:00:00') is None
+    assert parse_epoch_timestamp(b'1614013200.5 Hello') == 1614013200.5
+    assert parse_epoch_timestamp(b'12345 Hello') is None
+
+
+def test_parse_query_time():
+    assert parse_query_time('2021-02-22T17:00:00') == ts('2021-02-22 17:00:00')
+    assert parse_query_time('1614013200') == 1614013200
+    now = datetime(2021, 2, 22, 20, 0, tzinfo=timezone.utc)
+    assert parse_query_time('14:02', now=now) == ts('2021-02-22 14:02:00')
+
+
+def test_time_index_and_query(tmp_path):
+    lines = []
+    for i in range(3600):
+        lines.append(b'2021-02-22 %02d:%02d:%02d request %d\n' % (14 + i // 3600, (i // 60) % 60, i % 60, i))
+        if i % 10 == 0:
+            lines.append(b'    continuation of request %d\n' % i)
+    content = b''.join(lines)
+    f = PlainFile(tmp_path / 'app.log')
+    f.open()
+    writer = TimeIndexWriter(tmp_path / 'app.log.tidx', get_timestamp_parser(['iso']), sample_interval=4096)
+    writer.open(0)
+    # append in chunks that do not respect line boundaries
+    for i in range(0, len(content), 1000):
+        f.f.write(content[i:i + 1000])
+        writer.update(i, content[i:i + 1000])
+    writer.close()
+    f.f.flush()
+
+    index = TimeIndex(tmp_path / 'app.log.tidx')
+    assert len(index.offsets) > 20
+    for t, offset in zip(index.timestamps, index.offsets):
+        assert offset == 0 or content[offset - 1:offset] == b'\n'
+        assert parse_iso_timestamp(content[offset:offset + 64]) == t
+
+    since, until = ts('2021-02-22 14:20:00'), ts('2021-02-22 14:20:59')
+    start, end = index.byte_range(since, until, len(content))
+    assert end - start < 4096 * 3
+
+    out = BytesIO()
+    query_file(f, index, since, until, get_timestamp_parser(['iso']), out)
+    f.close()
+    result = out.getvalue().splitlines()
+    assert result[0] == b'2021-02-22 14:20:00 request 1200'
+    assert result[1] == b'    continuation of request 1200'
+    assert result[-1] == b'2021-02-22 14:20:59 request 1259'
+    assert len(result) == 60 + 6
+
+
+def test_find_mirror_files(tmp_path):
+    for name in [
+            'app.log', 'app.log.rotated-1.zst', 'app.log.rotated-1.zst.idx',
+            'app.log.rotated-2', 'app.log.rotated-2.zst.tmp', 'app.log.rotated-2.zst.tmp.idx']:
+        (tmp_path / name).write_bytes(b'x')
+    assert find_mirror_files(tmp_path / 'app.log') == [
+        tmp_path / 'app.log.rotated-1.zst', tmp_path / 'app.log.rotated-2', tmp_path / 'app.log']
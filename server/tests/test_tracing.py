@@ -0,0 +1,22 @@
+from asyncio import run, sleep
+
+from logline_server.tracing import Profiler, trace
+
+
+def test_profiler_writes_profile(tmp_path):
+    t0 = trace.start('test')
+    trace.stop('test', t0)
+
+    async def main():
+        profiler = Profiler('logline-server', tmp_path, 0.1)
+        profiler.start()
+        # second signal while running is ignored
+        profiler.start()
+        await sleep(0.3)
+        assert profiler.profile is None
+
+    run(main())
+    prof_path, = tmp_path.glob('logline-server-*.prof')
+    txt_path, = tmp_path.glob('logline-server-*.txt')
+    assert prof_path.stat().st_size > 0
+    assert any(line.startswith('test ') for line in txt_path.read_text().splitlines())
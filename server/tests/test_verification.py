@@ -0,0 +1,46 @@
+from asyncio import run
+import hashlib
+
+from pytest import importorskip
+
+from conftest import connect, send
+
+
+def test_hashes_and_repair(make_conf, serve, tmp_path):
+    conf = make_conf()
+
+    async def main():
+        async with serve(conf) as port:
+            reader, writer = await connect(port)
+            assert (await send(reader, writer, 'data', {'offset': 0}, b'hello world\n'))[0] == 'ok'
+            reply = await send(reader, writer, 'hashes', {'ranges': [[0, 6], [6, 100]]})
+            assert reply == ('ok', {'hashes': [
+                hashlib.blake2b(b'hello ', digest_size=16).hexdigest(),
+                hashlib.blake2b(b'world\n', digest_size=16).hexdigest(),
+            ]}, None)
+            # the original was changed - without repair flag it is an error...
+            assert (await send(reader, writer, 'data', {'offset': 6}, b'WORLD\n'))[0] == 'error'
+            reader, writer = await connect(port, prefix_sha1='J9VILuvQdd5EOJd0/OKMafRcinU=')
+            # ...with repair flag the stored data are overwritten
+            assert (await send(reader, writer, 'data', {'offset': 6, 'repair': True}, b'WORLD\n'))[0] == 'ok'
+            writer.close()
+        assert (tmp_path / 'host1/var~log/app.log').read_bytes() == b'hello WORLD\n'
+
+    run(main())
+
+
+def test_repair_not_supported_for_zst(make_conf, serve):
+    importorskip('zstandard')
+    conf = make_conf(storage_format='zst')
+
+    async def main():
+        async with serve(conf) as port:
+            reader, writer = await connect(port)
+            assert (await send(reader, writer, 'data', {'offset': 0}, b'hello world\n'))[0] == 'ok'
+            # the difference is reported, the connection continues
+            reply = await send(reader, writer, 'data', {'offset': 6, 'repair': True}, b'WORLD\n')
+            assert reply == ('ok', {'repaired': False}, None)
+            assert (await send(reader, writer, 'data', {'offset': 12}, b'more\n'))[0] == 'ok'
+            writer.close()
+
+    run(main())